@@ -0,0 +1,38 @@
+import numpy as np
+from percentile_rank_kernel_statsbomb import rank_percentiles
+
+
+# Age bands as label -> age cutoff, players younger than the cutoff are in the band.
+# Ages are season start year minus birth year, so 'u21' matches the age < 22 check used by the plots.
+AGE_BANDS = {'u21': 22, 'u23': 24}
+
+
+def rank_age_bands(ranking_df, age_bands=AGE_BANDS):
+    '''
+    Function to rank players within age bands of an already ranked cohort, one vectorized pass per band.
+
+    Parameters:
+    ranking_df (DataFrame): Ranked cohort with 'age' and 'average_rank', e.g. from calculate_percentiles.
+    age_bands (dict): Band label -> age cutoff (exclusive), defaults to AGE_BANDS.
+
+    Returns:
+    age_band_df (DataFrame): Copy of ranking_df with, for every band:
+        '{band}_rank': rank within the band, 1 = highest average_rank, ties share the lowest rank (NaN outside the band)
+        '{band}_total': number of players in the band
+        '{band}_percentile': average_rank percentile within the band (NaN outside the band)
+    '''
+    age_band_df = ranking_df.copy()
+    average_rank = age_band_df['average_rank']
+
+    for band, cutoff in age_bands.items():
+        in_band = (age_band_df['age'] < cutoff).to_numpy()
+
+        # Ranking only the band's values is the same as ranking a filtered band frame
+        age_band_df[f'{band}_rank'] = average_rank.where(in_band).rank(method='min', ascending=False)
+        age_band_df[f'{band}_total'] = int(in_band.sum())
+
+        band_percentiles = np.full(len(age_band_df), np.nan)
+        band_percentiles[in_band] = rank_percentiles(average_rank.to_numpy(dtype=np.float64)[in_band])
+        age_band_df[f'{band}_percentile'] = band_percentiles
+
+    return age_band_df
@@ -0,0 +1,146 @@
+'''
+Command-line entry point for the aggregate ranking reports, replacing the hard-coded paths and player_id in
+aggregate_ranking.ipynb for scheduled runs.
+
+The pre-processed data and ranking cube are cached next to the CSV (or in --cache-dir), the percentiles as a
+memory-mapped matrix that report workers open without loading, and reused by every later invocation until the CSV,
+the metric groups or the pipeline version change, e.g.
+
+    python aggregate_rank_cli_statsbomb.py warm --data data/player_season_stats.csv \
+        --metric-groups cross_platform/statsbomb_metric_groups.csv
+
+    python aggregate_rank_cli_statsbomb.py report --data data/player_season_stats.csv \
+        --metric-groups cross_platform/statsbomb_metric_groups.csv \
+        --season-information cross_platform/season_information.csv \
+        --player-id 31663 12345 --out aggregate_ranking/output
+
+'serve' keeps the data in memory behind a local HTTP/JSON API, see ranking_service_statsbomb.
+'''
+import argparse
+import sys
+import time
+import pandas as pd
+from get_position_specific_metrics_statsbomb import MetricGroupRegistry
+from preprocessed_cache_statsbomb import load_mapped_season_stats
+from batch_reports_statsbomb import generate_player_reports
+from season_index_statsbomb import SeasonIndex
+from ranking_service_statsbomb import RankingService, serve as serve_ranking_service
+
+
+def read_player_ids(player_ids=None, player_id_file=None):
+    # Player ids from the command line and/or a file with one id per line (blank lines and '#' comments ignored)
+    player_ids = list(player_ids or [])
+    if player_id_file:
+        with open(player_id_file) as f:
+            player_ids += [int(line.split('#')[0]) for line in f if line.split('#')[0].strip()]
+
+    return list(dict.fromkeys(player_ids))
+
+
+def load_pipeline_inputs(args):
+    '''
+    Load the metric groups and the cached (or freshly built) pre-processed data and ranking cube.
+    '''
+    start = time.perf_counter()
+    metric_grouping_information = MetricGroupRegistry.from_csv(args.metric_groups)
+    df, ranking_cube = load_mapped_season_stats(args.data, metric_grouping_information, args.cache_dir,
+                                                args.hash_contents, args.processes)
+    print(f'Loaded {len(df)} rows and {len(ranking_cube)} ranked cohorts in {time.perf_counter() - start:.1f}s',
+          file=sys.stderr)
+
+    return df, metric_grouping_information, ranking_cube
+
+
+def warm(args):
+    # Build the caches only, e.g. straight after a new export lands
+    load_pipeline_inputs(args)
+
+    return 0
+
+
+def report(args):
+    player_ids = read_player_ids(args.player_id, args.player_id_file)
+    if not player_ids:
+        print('No player ids given, use --player-id and/or --player-id-file', file=sys.stderr)
+        return 2
+
+    df, metric_grouping_information, ranking_cube = load_pipeline_inputs(args)
+
+    chronological_season_ids = None
+    if args.season_information:
+        chronological_season_ids = pd.read_csv(args.season_information)['statsbomb_season_id']
+
+    start = time.perf_counter()
+    errors = generate_player_reports(player_ids, df, metric_grouping_information, args.out, chronological_season_ids,
+                                     processes=args.processes, ranking_cube=ranking_cube,
+                                     image_format=args.format, dpi=args.dpi, season_index=SeasonIndex(df),
+                                     seasons_per_page=args.seasons_per_page)
+    print(f'Rendered reports for {len(player_ids) - len(errors)} of {len(player_ids)} players in '
+          f'{time.perf_counter() - start:.1f}s', file=sys.stderr)
+
+    for player_id, error in errors.items():
+        print(f'{player_id}: {error}', file=sys.stderr)
+
+    return 1 if errors else 0
+
+
+def serve(args):
+    ranking_service = RankingService(args.data, args.metric_groups, args.season_information, args.cache_dir,
+                                     args.hash_contents, args.reload_interval, args.processes)
+    print(f'Serving rankings on http://{args.host}:{args.port}', file=sys.stderr)
+    serve_ranking_service(ranking_service, args.host, args.port)
+
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Aggregate ranking reports for StatsBomb player season stats.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    # Options shared by every command
+    data_parser = argparse.ArgumentParser(add_help=False)
+    data_parser.add_argument('--data', required=True, help='Path to player_season_stats.csv.')
+    data_parser.add_argument('--metric-groups', required=True, help='Path to statsbomb_metric_groups.csv.')
+    data_parser.add_argument('--cache-dir', help="Cache directory, defaults to a '.cache' folder next to --data.")
+    data_parser.add_argument('--hash-contents', action='store_true',
+                             help='Key the cache on the CSV contents rather than its size and modification time.')
+    data_parser.add_argument('--processes', type=int,
+                             help='Worker processes for ranking (and rendering reports), defaults to the number of CPUs.')
+
+    warm_parser = subparsers.add_parser('warm', parents=[data_parser],
+                                        help='Pre-process, de-duplicate and rank the data into the cache.')
+    warm_parser.set_defaults(handler=warm)
+
+    report_parser = subparsers.add_parser('report', parents=[data_parser],
+                                          help='Render the own league, League One and all leagues reports.')
+    report_parser.add_argument('--player-id', type=int, nargs='+', action='extend', help='StatsBomb player ids.')
+    report_parser.add_argument('--player-id-file', help='File with one StatsBomb player id per line.')
+    report_parser.add_argument('--out', required=True, help='Output directory, one sub-folder per player.')
+    report_parser.add_argument('--season-information', help='Path to season_information.csv, for the League One report.')
+    report_parser.add_argument('--format', default='png', help="Image format, e.g. 'png', 'pdf' or 'svg'.")
+    report_parser.add_argument('--dpi', type=float, help="Resolution of raster formats, defaults to matplotlib's.")
+    report_parser.add_argument('--seasons-per-page', type=int,
+                               help='Write long reports as pages of this many seasons (a multi-page PDF with '
+                                    '--format pdf, numbered images otherwise), defaults to one image per report.')
+    report_parser.set_defaults(handler=report)
+
+    serve_parser = subparsers.add_parser('serve', parents=[data_parser],
+                                         help='Answer rank, percentile and U21 queries over local HTTP/JSON.')
+    serve_parser.add_argument('--season-information', help='Path to season_information.csv, for League One plots.')
+    serve_parser.add_argument('--host', default='127.0.0.1', help='Address to bind, defaults to localhost only.')
+    serve_parser.add_argument('--port', type=int, default=8050, help='Port to listen on.')
+    serve_parser.add_argument('--reload-interval', type=float, default=5.0,
+                              help='Seconds between checks for a changed data or metric groups file.')
+    serve_parser.set_defaults(handler=serve)
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+
+    return args.handler(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
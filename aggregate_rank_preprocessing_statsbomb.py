@@ -1,3 +1,33 @@
+import numpy as np
+import pandas as pd
+from instrumentation_statsbomb import instrument_stage
+
+
+# Bump whenever preprocess_df or remove_duplicate_rows changes its output, so cached frames are rebuilt
+PREPROCESSING_VERSION = 3
+
+# Raw metrics preprocess_df derives or inverts metrics from, read whatever the metric groups use
+PREPROCESSING_METRICS = ['npga_90', 'assists_90', 'np_xg_90', 'dribbled_past_90', 'errors_90']
+
+
+def normalize_values(values):
+  # Strip, lowercase and add underscores where spaces exist between words, once per distinct value rather than
+  # once per row, then map the cleaned values back to every row (same values and dtype as the per-row version)
+  codes, uniques = pd.factorize(values, use_na_sentinel=False)
+  normalized = pd.Series(uniques, dtype=values.dtype).str.strip().str.lower().str.replace(' ', '_')
+
+  return pd.Series(normalized.take(codes).to_numpy(), index=values.index, dtype=normalized.dtype, name=values.name)
+
+
+def get_leading_year(values, separator):
+  # Integer before the first separator ('2023/2024' -> 2023, '1999-05-01' -> 1999), parsed once per distinct value
+  codes, uniques = pd.factorize(values, use_na_sentinel=False)
+  years = pd.Series(uniques, dtype=values.dtype).str.split(separator).str[0].astype(int).to_numpy()
+
+  return years[codes]
+
+
+@instrument_stage
 def preprocess_df(df):
 
   # pre-processing
@@ -9,16 +39,18 @@ def preprocess_df(df):
   df.rename(columns=lambda x: x.replace('player_season_', ''), inplace=True)
 
   # # Filter df for rows with minutes > 900
-  df = df[df['minutes'] > 700]
+  # take returns a new frame (the only copy of the data made here) that columns can be set on without
+  # chained-assignment warnings
+  df = df.take(np.flatnonzero((df['minutes'] > 700).to_numpy()))
 
   # Strip and lowercase and add underscores where spaces exists between words for values in 'primary_position'
-  df['primary_position'] = df['primary_position'].str.strip().str.lower().str.replace(' ', '_')
+  df['primary_position'] = normalize_values(df['primary_position'])
 
   # Strip and lowercase values in competition_name, also replace spaces with '_'
-  df['competition_name'] = df['competition_name'].str.strip().str.lower().str.replace(' ', '_')
+  df['competition_name'] = normalize_values(df['competition_name'])
 
   # Team name-clean
-  df['team_name'] = df['team_name'].str.strip().str.lower().str.replace(' ', '_')
+  df['team_name'] = normalize_values(df['team_name'])
 
   # Create goals - Xg fetaure
   df['np_goals_less_xg_90'] = df['npga_90']-df['assists_90']-df['np_xg_90']
@@ -27,9 +59,10 @@ def preprocess_df(df):
   metrics_to_invert = ['dribbled_past_90','errors_90']
 
   # Invert metrics
-  df[metrics_to_invert] = df[metrics_to_invert].apply(lambda x: -x)
+  df[metrics_to_invert] = -df[metrics_to_invert]
 
-  # calculate age from season_name.split('/')[0] - datetime(birth_date)
-  df['age'] = df['season_name'].str.split('/').str[0].astype(int) - df['birth_date'].str.split('-').str[0].astype(int)
+  # calculate age from season_name.split('/')[0] - datetime(birth_date), from the years of every distinct season and
+  # birth date
+  df['age'] = get_leading_year(df['season_name'], '/') - get_leading_year(df['birth_date'], '-')
 
   return df
@@ -6,11 +6,18 @@ from matplotlib.colors import Normalize
 from matplotlib.cm import ScalarMappable
 from aggregate_rank_league_one_statsbomb import calculate_percentiles_league_one
 from get_position_specific_metrics_statsbomb import get_player_metrics
+from age_band_ranking_statsbomb import rank_age_bands
 from scipy.stats import rankdata
 import os
+from plot_output_statsbomb import render_season_report, use_headless_backend
+from season_index_statsbomb import SeasonIndex
+from cohort_density_statsbomb import compute_cohort_density, plot_cohort_histogram
+from instrumentation_statsbomb import record_stage, stage_tags
 
 
-def plot_distribution_all_leagues(player_df, df, metric_grouping_information, save_path):
+def plot_distribution_all_leagues(player_df, df, metric_grouping_information, save_path,
+                                  headless=False, image_format='png', dpi=None, season_index=None,
+                                  seasons_per_page=None, processes=1):
     """
     Generate a distribution plot of player rankings in all leagues, including annotations for specific players
     with an additional focus on players under 21.
@@ -19,73 +26,93 @@ def plot_distribution_all_leagues(player_df, df, metric_grouping_information, sa
     player_df (DataFrame): DataFrame containing player data.
     df (DataFrame): DataFrame with general league data.
     metric_grouping_information (dict): Dictionary containing metrics for grouping players.
+    headless (bool): Use the Agg backend and close the figure instead of showing it, for batch and server runs.
+    image_format (str): Image format passed to savefig, e.g. 'png', 'pdf' or 'svg'.
+    dpi (float, optional): Resolution of raster formats, defaults to matplotlib's savefig.dpi.
+    season_index (SeasonIndex, optional): Season lookups for df, built here if not given.
+    processes (int, optional): Worker processes for ranking large cohorts, see calculate_percentiles_league_one.
+    seasons_per_page (int, optional): Draw this many seasons per page, writing each page as soon as it is drawn (one
+                                      multi-page PDF, or numbered images for other formats) so memory stays bounded
+                                      for long careers. Defaults to every season on one figure.
 
     Returns:
-    None. This function saves and displays the plot.
+    file_paths (list): Paths of the saved images. This function saves and displays the plot.
 
     Note:
     - This function assumes 'get_player_metrics', 'calculate_percentiles_all' are defined elsewhere.
     - The plot shows histograms with vertical lines for specific player rankings.
     """
 
-          # Ensure axes is always iterable by wrapping single axis in a list
-    fig, axes = plt.subplots(len(player_df), 1, figsize=(8, 4.5 * len(player_df)))  # Increased figure size for annotations
-    if not isinstance(axes, np.ndarray):  # If only one subplot, wrap in a list
-        axes = [axes]
+    # Never open a GUI window in headless mode
+    if headless:
+        use_headless_backend()
+
+    # Index df by season once, rather than scanning it for every subplot
+    if season_index is None:
+        season_index = SeasonIndex(df)
 
     norm = Normalize(vmin=0, vmax=100)
     cmap = plt.get_cmap('viridis')
 
+    # Rank one season: its all leagues cohort and everything drawn from it
+    def rank_season(index, row):
+        season_name = row['season_name']
 
-    for i, (index, row) in enumerate(player_df.iterrows()):
+        # Tag the lookup and ranking stages with the player and season (instrumentation only)
+        with stage_tags(player_id=row['player_id'], season_name=season_name):
+            position_group, general_metrics, comparable_positions = get_player_metrics(metric_grouping_information, row)
 
-        lines_all = []
-        labels_all = []
+            # Ensure both summer and other leagues are included, looked up in the season index
+            season_df = season_index.get_calendar_rows(season_name)
 
-    
-        season_id = row['season_id']
-        season_name = row['season_name']
-        competition_id = row['competition_id']
-        competition_name = row['competition_name']
-        player_name = row['player_name']
-        player_position = row['primary_position']
-        player_age = row['age']  # Assuming 'age' is in player_df
+            # Calculate rankings
+            ranking_df = calculate_percentiles_league_one(season_df, comparable_positions, general_metrics, processes)
 
+            # Sort ranking_df by 'average_rank' for accurate ranking
+            sorted_ranking_df = ranking_df.sort_values('average_rank', ascending=False)
 
-        position_group, general_metrics, comparable_positions = get_player_metrics(metric_grouping_information, row)
+            # Histogram and KDE of the cohort, ranked for this report so computed here
+            with record_stage('cohort_density', cohort_size=len(sorted_ranking_df)):
+                cohort_density = compute_cohort_density(sorted_ranking_df['average_rank'])
 
-        # Ensure both summer and other leagues are included
-        if '/' not in season_name:
-            other_season_name = season_name + '/' + str(int(season_name) + 1)
+            # Rank players under 21 once
+            age_band_df = rank_age_bands(sorted_ranking_df) if row['age'] < 22 else None
 
-        else: 
-            other_season_name = season_name.split('/')[0]
+        return dict(position_group=position_group, sorted_ranking_df=sorted_ranking_df, cohort_density=cohort_density,
+                    age_band_df=age_band_df)
 
-        
-        season_df = df[(df['season_name'] == season_name) | (df['season_name'] == other_season_name)].copy()
+    # Draw one season's subplot
+    def draw_season(ax, index, row, season):
 
-        # Calculate rankings
-        ranking_df = calculate_percentiles_league_one(season_df, comparable_positions, general_metrics)
+        lines_all = []
+        labels_all = []
+
+        season_name = row['season_name']
+        player_name = row['player_name']
+        player_age = row['age']  # Assuming 'age' is in player_df
+        position_group = season['position_group']
+        sorted_ranking_df = season['sorted_ranking_df']
+
+        # Season played over the same calendar year in the other kind of league
+        summer_season_name, winter_season_name = season_index.get_paired_season_names(season_name)
+        other_season_name = winter_season_name if season_name == summer_season_name else summer_season_name
 
         # General plot
         title_general = f"{position_group.replace('_', ' ').title()}s: All Leagues, {season_name} & {other_season_name}"
         # title_general = f"{row['competition_name'].replace('_', ' ').title()}, {row['season_name']}"
 
-        # Sort ranking_df by 'average_rank' for accurate ranking
-        sorted_ranking_df = ranking_df.sort_values('average_rank', ascending=False)
-
         # Plot distribution of 'average_rank' for general_df
-        sns.histplot(sorted_ranking_df['average_rank'], kde=True, ax=axes[i])
-        axes[i].set_title(title_general)
-        axes[i].set_xlabel('Player Score')
-        axes[i].set_ylabel('Number of Players')
+        plot_cohort_histogram(ax, season['cohort_density'])
+        ax.set_title(title_general)
+        ax.set_xlabel('Player Score')
+        ax.set_ylabel('Number of Players')
 
         # Highlight Lincoln City players for all players plot
         lincoln_df = sorted_ranking_df[sorted_ranking_df['team_name'] == 'lincoln_city'].copy()
         for index_1, row_1 in lincoln_df.iterrows():
             percentile = 100-sorted_ranking_df.loc[index_1, 'average_rank_percentile']
             color = cmap(norm(percentile))
-            line = axes[i].axvline(sorted_ranking_df.loc[index_1, 'average_rank'], color=color, linestyle='--')
+            line = ax.axvline(sorted_ranking_df.loc[index_1, 'average_rank'], color=color, linestyle='--')
             label = f"{row_1['player_name']} ({percentile:.2f}%)"
             lines_all.append(line)
             labels_all.append((percentile, label))
@@ -94,7 +121,7 @@ def plot_distribution_all_leagues(player_df, df, metric_grouping_information, sa
         player_ranking_row = sorted_ranking_df[sorted_ranking_df['player_name'] == player_name]
         player_percentile = 100 - player_ranking_row.iloc[0]['average_rank_percentile']
         player_label = f"{player_name} ({player_percentile:.2f}%)"
-        player_line = axes[i].axvline(player_ranking_row.iloc[0]['average_rank'], color='r', linestyle='--')
+        player_line = ax.axvline(player_ranking_row.iloc[0]['average_rank'], color='r', linestyle='--')
         
         #Add player line and label for legend
         lines_all.append(player_line)
@@ -109,7 +136,7 @@ def plot_distribution_all_leagues(player_df, df, metric_grouping_information, sa
         # Add legends
         sorted_labels_all = sorted(labels_all, key=lambda x: x[0], reverse=False)
         sorted_handles_all = [lines_all[labels_all.index(item)] for item in sorted_labels_all]
-        axes[i].legend(sorted_handles_all, [item[1] for item in sorted_labels_all], loc='center left', bbox_to_anchor=(1, 0.5), title=f"Percentiles: {player_name.replace('_', ' ').title()} & Lincoln Players")
+        ax.legend(sorted_handles_all, [item[1] for item in sorted_labels_all], loc='center left', bbox_to_anchor=(1, 0.5), title=f"Percentiles: {player_name.replace('_', ' ').title()} & Lincoln Players")
         
 
 
@@ -117,8 +144,9 @@ def plot_distribution_all_leagues(player_df, df, metric_grouping_information, sa
         u21_lines = []
         u21_labels = []
         if player_age < 22:
-            # Filter for players under 21
-            u21_df = sorted_ranking_df[sorted_ranking_df['age'] < 22]
+            # Filter for the players under 21
+            age_band_df = season['age_band_df']
+            u21_df = age_band_df[age_band_df['u21_rank'].notna()]
 
             # Sort U21 players by rank for legend
             sorted_u21_df = u21_df.sort_values(by='average_rank', ascending=False)
@@ -128,7 +156,7 @@ def plot_distribution_all_leagues(player_df, df, metric_grouping_information, sa
             u21_player_index = u21_player_ranking_row.index[0]
 
             # Recalculate rank percentile for the specific U21 player
-            u21_player_rank = u21_df['average_rank'].rank(method='min', ascending=False).loc[u21_player_index]
+            u21_player_rank = u21_df.loc[u21_player_index, 'u21_rank']
             u21_total_players = len(u21_df)
             u21_player_percentile = int(100- (u21_player_rank *100 / u21_total_players))
             u21_text = f"\nRanked {int(u21_player_rank)} out of {u21_total_players} U21 players"
@@ -136,22 +164,12 @@ def plot_distribution_all_leagues(player_df, df, metric_grouping_information, sa
         else:
             combined_text = general_text
 
-        axes[i].text(0.02, 0.95, combined_text, transform=axes[i].transAxes, verticalalignment='top',
-                     bbox=dict(boxstyle='round', facecolor='white', alpha=0.5))
-
-    # # Adjust layout to prevent overlap
-    plt.tight_layout()
-
-    # Save plot as png with a player-specific filename
-    full_path = f'{save_path}/{row["player_name"].replace(" ", "_")}'
-    
-    # Create the directory if it doesn't exist
-    if not os.path.exists(full_path):
-        os.makedirs(full_path)
-        
-    plt.savefig(f"{full_path}/all_league_year_by_year_ranking_.png")
+        ax.text(0.02, 0.95, combined_text, transform=ax.transAxes, verticalalignment='top',
+                bbox=dict(boxstyle='round', facecolor='white', alpha=0.5))
 
-    plt.show()
+    # One subplot per season, on one figure or streamed seasons_per_page at a time, then saved
+    return render_season_report(player_df, rank_season, draw_season, save_path, 'all_league_year_by_year_ranking_',
+                                headless, image_format, dpi, seasons_per_page, report='all_leagues')
 
 
     # player_position_groups = []
@@ -0,0 +1,145 @@
+import multiprocessing
+import sys
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from get_position_specific_metrics_statsbomb import as_metric_group_registry
+from ranking_cube_statsbomb import build_ranking_cube, lookup_cohort_density
+from season_index_statsbomb import SeasonIndex
+from own_league_plot import plot_stacked_distribution_u21_flag
+from league_one_plot import plot_distribution_league_one_u21
+from all_league_plot import plot_distribution_all_leagues
+from plot_output_statsbomb import closing_new_figures, use_headless_backend, rendering_in_process
+
+
+# Data shared by every report in a worker process, set once per process rather than sent with every task
+_worker_state = {}
+
+
+def _init_worker(*state):
+    # Forked workers inherit _worker_state from the parent, spawned workers receive it once here
+    if state:
+        _set_worker_state(*state)
+
+    # Workers never have a display to show figures on
+    use_headless_backend()
+
+
+def _set_worker_state(df, metric_grouping_information, ranking_cube, season_index, save_path, chronological_season_ids,
+                      render_options):
+    _worker_state.update(
+        df=df,
+        metric_grouping_information=metric_grouping_information,
+        ranking_cube=ranking_cube,
+        season_index=season_index,
+        save_path=save_path,
+        chronological_season_ids=chronological_season_ids,
+        render_options=render_options,
+    )
+
+
+def _render_player_reports(player_id):
+    '''
+    Render the own league, League One and all leagues reports for one player from _worker_state.
+
+    Returns (player_id, error), where error is None on success or a short description of what went wrong.
+    '''
+    df = _worker_state['df']
+    metric_grouping_information = _worker_state['metric_grouping_information']
+    save_path = _worker_state['save_path']
+    render_options = _worker_state['render_options']
+    season_index = _worker_state['season_index']
+
+    player_df = season_index.get_player_rows(player_id)
+    if player_df.empty:
+        return player_id, 'no rows for player_id'
+
+    # Free any figure left open by a failed report
+    try:
+        with closing_new_figures():
+            plot_stacked_distribution_u21_flag(player_df, df, metric_grouping_information, save_path,
+                                               ranking_cube=_worker_state['ranking_cube'], **render_options)
+            plot_distribution_league_one_u21(player_df, df, metric_grouping_information, save_path,
+                                             _worker_state['chronological_season_ids'], season_index=season_index,
+                                             **render_options)
+            plot_distribution_all_leagues(player_df, df, metric_grouping_information, save_path,
+                                          season_index=season_index, **render_options)
+    except Exception as e:
+        return player_id, f'{type(e).__name__}: {e}'
+
+    return player_id, None
+
+
+def generate_player_reports(player_ids, df, metric_grouping_information, save_path, chronological_season_ids,
+                            processes=None, ranking_cube=None, image_format='png', dpi=None, season_index=None,
+                            seasons_per_page=None):
+    '''
+    Render all three reports for every player in player_ids across a process pool.
+
+    Cohorts are ranked and seasons indexed once up front (build_ranking_cube, SeasonIndex) and shared with the
+    workers together with df, as are the histograms and KDEs of the players' own league cohorts, stored with the
+    cube. On Linux workers are forked and inherit the data copy-on-write, elsewhere it is pickled once per worker,
+    never per task.
+
+    Parameters:
+    player_ids (list): Player ids to report on, e.g. a shortlist or a rival squad.
+    df (DataFrame): Pre-processed, de-duplicated league data.
+    metric_grouping_information (DataFrame or MetricGroupRegistry): Metrics for grouping players.
+    save_path (str): Output directory, each player gets a sub-folder as with the single player plots.
+    chronological_season_ids (Series): Season ids in chronological order, passed to the League One plot.
+    processes (int, optional): Number of worker processes, defaults to the number of CPUs. 1 renders in-process.
+    ranking_cube (dict, optional): Pre-ranked cohorts from build_ranking_cube, built here if not given. A
+                                   MappedRankingCube (load_mapped_season_stats) reaches spawned workers as the path
+                                   of its percentile matrix, which they map rather than unpickle.
+    image_format (str): Image format passed to savefig, e.g. 'png', 'pdf' or 'svg'.
+    dpi (float, optional): Resolution of raster formats, defaults to matplotlib's savefig.dpi.
+    season_index (SeasonIndex, optional): Season lookups for df, built here if not given.
+    seasons_per_page (int, optional): Stream every report as pages of this many seasons, see the plot functions.
+
+    Returns:
+    errors (dict): player_id -> error description for every player whose reports failed.
+    '''
+    registry = as_metric_group_registry(metric_grouping_information)
+    if ranking_cube is None:
+        ranking_cube = build_ranking_cube(df, registry)
+    if season_index is None:
+        season_index = SeasonIndex(df)
+
+    # Reports are always rendered headless, figures are closed as soon as they are saved
+    render_options = dict(headless=True, image_format=image_format, dpi=dpi, seasons_per_page=seasons_per_page)
+    state = (df, registry, ranking_cube, season_index, save_path, chronological_season_ids, render_options)
+    player_ids = list(dict.fromkeys(player_ids))
+
+    # Own league histograms and KDEs of the players' cohorts, stored with the cube before forking so every worker
+    # inherits them
+    empty = np.empty(0, dtype=np.intp)
+    player_rows = season_index.get_rows(np.concatenate(
+        [empty] + [season_index.player_positions.get(player_id, empty) for player_id in player_ids]))
+    cohort_keys = zip(player_rows['season_id'], player_rows['competition_id'],
+                      registry.map_position_groups(player_rows['primary_position'].to_numpy()))
+    for key in set(cohort_keys):
+        lookup_cohort_density(ranking_cube, *key)
+
+    try:
+        # Render in-process, keeping the caller's backend and open figures
+        if processes == 1:
+            _set_worker_state(*state)
+            with rendering_in_process():
+                results = list(map(_render_player_reports, player_ids))
+
+        # Fork is only safe with matplotlib on Linux, spawned workers get the state through the initializer
+        else:
+            if sys.platform.startswith('linux'):
+                mp_context = multiprocessing.get_context('fork')
+                _set_worker_state(*state)
+                initargs = ()
+            else:
+                mp_context = multiprocessing.get_context('spawn')
+                initargs = state
+
+            with ProcessPoolExecutor(max_workers=processes, mp_context=mp_context,
+                                     initializer=_init_worker, initargs=initargs) as executor:
+                results = list(executor.map(_render_player_reports, player_ids))
+    finally:
+        _worker_state.clear()
+
+    return {player_id: error for player_id, error in results if error is not None}
@@ -0,0 +1,147 @@
+'''
+Benchmark suite for the aggregate ranking pipeline, run on synthetic StatsBomb-shaped data.
+
+Times preprocess_df, remove_duplicate_rows, the three calculate_percentiles* functions and the three plot entry
+points at each requested size, and writes one JSON line per (size, stage) so results can be compared across
+versions, e.g.
+
+    python benchmark_statsbomb.py --sizes 10000 100000 1000000 --output benchmark_results.jsonl
+'''
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from aggregate_rank_preprocessing_statsbomb import preprocess_df
+from remove_duplicate_rows_statsbomb import remove_duplicate_rows
+from get_position_specific_metrics_statsbomb import get_player_metrics
+from aggregate_rank_statsbomb import calculate_percentiles
+from aggregate_rank_league_one_statsbomb import calculate_percentiles_league_one
+from aggregate_rank_all_leagues_statsbomb import calculate_percentiles_all
+from own_league_plot import plot_stacked_distribution_u21_flag
+from league_one_plot import plot_distribution_league_one_u21
+from all_league_plot import plot_distribution_all_leagues
+from synthetic_data_statsbomb import (generate_player_season_stats, generate_metric_grouping_information,
+                                      generate_chronological_season_ids)
+
+
+DEFAULT_SIZES = [10_000, 100_000, 1_000_000]
+
+
+def time_stage(function, repeat, setup=None):
+    # Run function repeat times, setup (untimed) provides fresh arguments for functions that mutate their input
+    timings = []
+    for _ in range(repeat):
+        args = setup() if setup is not None else ()
+        start = time.perf_counter()
+        function(*args)
+        timings.append(time.perf_counter() - start)
+
+    return timings
+
+
+def get_version_info():
+    # Identify the code and library versions a result was produced with
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'machine': platform.machine(),
+    }
+
+
+def run_benchmarks(sizes=DEFAULT_SIZES, repeat=3, seed=0):
+    '''
+    Function to benchmark every pipeline stage at each size.
+
+    Returns a list of result dicts with the size, stage, number of input rows, and the best, median and all
+    timings in seconds.
+    '''
+    version_info = get_version_info()
+    metric_grouping_information = generate_metric_grouping_information()
+    chronological_season_ids = generate_chronological_season_ids()
+    results = []
+
+    for size in sizes:
+        raw_df = generate_player_season_stats(size, seed=seed)
+        preprocessed_df = preprocess_df(raw_df.copy())
+        df = remove_duplicate_rows(preprocessed_df)
+
+        # Report on the player with the most seasons, as the notebook does for one player
+        player_id = df['player_id'].value_counts().index[0]
+        player_df = df[df['player_id'] == player_id]
+        row = player_df.iloc[0]
+        position_group, general_metrics, comparable_positions = get_player_metrics(metric_grouping_information, row)
+        league_one_df = df[(df['competition_name'] == 'league_one') & (df['season_id'] == row['season_id'])]
+
+        with tempfile.TemporaryDirectory() as save_path:
+            stages = {
+                'preprocess_df': (preprocess_df, lambda: (raw_df.copy(),), len(raw_df)),
+                'remove_duplicate_rows': (remove_duplicate_rows, lambda: (preprocess_df(raw_df.copy()),),
+                                          len(preprocessed_df)),
+                'calculate_percentiles': (lambda: calculate_percentiles(df, row['season_id'], row['competition_id'],
+                                                                        comparable_positions, general_metrics), None, len(df)),
+                'calculate_percentiles_league_one': (lambda: calculate_percentiles_league_one(
+                    league_one_df, comparable_positions, general_metrics), None, len(league_one_df)),
+                'calculate_percentiles_all': (lambda: calculate_percentiles_all(df, player_df, comparable_positions,
+                                                                                general_metrics), None, len(df)),
+                'plot_stacked_distribution_u21_flag': (lambda: plot_stacked_distribution_u21_flag(
+                    player_df, df, metric_grouping_information, save_path, headless=True), None, len(df)),
+                'plot_distribution_league_one_u21': (lambda: plot_distribution_league_one_u21(
+                    player_df, df, metric_grouping_information, save_path, chronological_season_ids, headless=True),
+                    None, len(df)),
+                'plot_distribution_all_leagues': (lambda: plot_distribution_all_leagues(
+                    player_df, df, metric_grouping_information, save_path, headless=True), None, len(df)),
+            }
+
+            for stage, (function, setup, n_rows) in stages.items():
+                timings = time_stage(function, repeat, setup)
+                result = {
+                    'size': size,
+                    'stage': stage,
+                    'rows': n_rows,
+                    'player_rows': len(player_df),
+                    'best_seconds': min(timings),
+                    'median_seconds': statistics.median(timings),
+                    'timings': timings,
+                    **version_info,
+                }
+                results.append(result)
+                print(f"{size:>9} {stage:<36} best {result['best_seconds']:.4f}s", file=sys.stderr)
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the aggregate ranking pipeline on synthetic data.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='Synthetic row counts.')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed runs per stage.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed for the synthetic data.')
+    parser.add_argument('--output', help='JSON lines file to append results to, defaults to stdout.')
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.sizes, args.repeat, args.seed)
+    lines = ''.join(json.dumps(result) + '\n' for result in results)
+
+    if args.output:
+        with open(args.output, 'a') as f:
+            f.write(lines)
+    else:
+        sys.stdout.write(lines)
+
+
+if __name__ == '__main__':
+    main()
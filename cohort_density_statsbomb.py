@@ -0,0 +1,104 @@
+'''
+Cohort-level histogram and KDE curve of average_rank for the report plots, computed once per cohort.
+
+compute_cohort_density bins a cohort with numpy's 'auto' bins and estimates the same KDE sns.histplot(..., kde=True)
+drew, and plot_cohort_histogram draws both with matplotlib's bar and plot. Own league cohorts' densities are stored
+with the ranking cube (see lookup_cohort_density), so they are computed once per cube rather than once per report;
+League One and all leagues cohorts are ranked by every report and have their densities computed along with them.
+
+Cohorts up to EXACT_KDE_MAX_ROWS use scipy's gaussian_kde. Larger cohorts (all leagues) use a binned KDE: the values
+are linearly binned onto a fine grid and convolved with the Gaussian kernel by FFT, which is indistinguishable at plot
+resolution and costs O(grid) instead of O(rows x support points).
+'''
+import math
+import numpy as np
+from scipy.stats import gaussian_kde
+
+
+# Points the KDE curve is evaluated at, as seaborn does
+KDE_GRIDSIZE = 200
+
+# Larger cohorts use the binned FFT KDE
+EXACT_KDE_MAX_ROWS = 20_000
+
+# Grid points of the binned KDE
+BINNED_KDE_GRIDSIZE = 4096
+
+
+def get_binned_kde(values, support, bandwidth, gridsize=BINNED_KDE_GRIDSIZE):
+    '''
+    Function to evaluate a Gaussian KDE at support from values linearly binned onto a grid spanning the values,
+    convolved with the kernel by FFT.
+    '''
+    low, high = values.min(), values.max()
+    delta = (high - low) / (gridsize - 1)
+
+    # Linear binning: every value is split between its two neighbouring grid points
+    positions = (values - low) / delta
+    lower = np.minimum(np.floor(positions).astype(np.intp), gridsize - 2)
+    upper_weight = positions - lower
+    grid_counts = (np.bincount(lower, weights=1 - upper_weight, minlength=gridsize)
+                   + np.bincount(lower + 1, weights=upper_weight, minlength=gridsize))
+
+    # Kernel out to 5 bandwidths (or the whole grid), wrapped for a circular convolution with enough padding
+    half_width = min(int(math.ceil(5 * bandwidth / delta)), gridsize - 1)
+    fft_size = 1 << int(math.ceil(math.log2(gridsize + 2 * half_width + 1)))
+    offsets = np.arange(-half_width, half_width + 1) * delta
+    kernel = np.zeros(fft_size)
+    kernel[np.arange(-half_width, half_width + 1) % fft_size] = np.exp(-0.5 * (offsets / bandwidth) ** 2)
+
+    grid_density = np.fft.irfft(np.fft.rfft(grid_counts, fft_size) * np.fft.rfft(kernel), fft_size)[:gridsize]
+    grid_density /= len(values) * bandwidth * math.sqrt(2 * math.pi)
+
+    return np.interp(support, low + np.arange(gridsize) * delta, np.maximum(grid_density, 0))
+
+
+def compute_cohort_density(average_rank):
+    '''
+    Function to compute a cohort's histogram and KDE curve.
+
+    Parameters:
+    average_rank (Series or array): average_rank of every player in the cohort.
+
+    Returns:
+    cohort_density (dict): 'edges' (bins + 1) and 'counts' (bins) of the histogram, 'support' and 'density' of the
+                           KDE curve scaled to the counts (None if the values have no variance).
+    '''
+    values = np.asarray(average_rank, dtype=np.float64)
+    values = values[~np.isnan(values)]
+
+    # Histogram with numpy's 'auto' bins
+    counts, edges = np.histogram(values, 'auto')
+    cohort_density = {'edges': edges, 'counts': counts, 'support': None, 'density': None}
+
+    variance = np.nan_to_num(np.var(values, ddof=1)) if len(values) > 1 else 0
+    if len(values) < 2 or math.isclose(variance, 0):
+        return cohort_density
+
+    # Scott's rule bandwidth, the curve spans the data only
+    kde = gaussian_kde(values)
+    bandwidth = np.sqrt(kde.covariance.squeeze())
+    support = np.linspace(values.min(), values.max(), KDE_GRIDSIZE)
+
+    if len(values) <= EXACT_KDE_MAX_ROWS:
+        density = kde(support)
+    else:
+        density = get_binned_kde(values, support, bandwidth)
+
+    # Scale the curve to the histogram, so its area matches the bars'
+    cohort_density['support'] = support
+    cohort_density['density'] = density * (counts * np.diff(edges)).sum()
+
+    return cohort_density
+
+
+def plot_cohort_histogram(ax, cohort_density, color='C0'):
+    '''
+    Function to draw a cohort's histogram bars at half opacity and its KDE curve on ax.
+    '''
+    edges = cohort_density['edges']
+    ax.bar(edges[:-1], cohort_density['counts'], width=np.diff(edges), align='edge', color=color, alpha=.5,
+           edgecolor='black', linewidth=.5)
+
+    if cohort_density['density'] is not None:
+        ax.plot(cohort_density['support'], cohort_density['density'], color=color)
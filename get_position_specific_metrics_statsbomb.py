@@ -1,3 +1,8 @@
+import pandas as pd
+from instrumentation_statsbomb import instrument_stage
+
+
+@instrument_stage
 def get_player_metrics(metric_grouping_information, row):
     '''
     Function to get metric information specific to the player based on the position they play in.
@@ -7,7 +12,12 @@ def get_player_metrics(metric_grouping_information, row):
     general_metrics: key metrics chosen by Metin for each position group
     lincoln_metrics: key metrics chosen by Lincoln for each position group
     comparable_positions: list of positions that are included in the player's position group
+
+    metric_grouping_information can also be a MetricGroupRegistry, in which case the lookups are dict accesses.
     '''
+    if isinstance(metric_grouping_information, MetricGroupRegistry):
+        return metric_grouping_information.get_player_metrics(row)
+
     # Find player position group
     position_group = metric_grouping_information.loc[
     (metric_grouping_information['positions_statsbomb'].apply(lambda x: row['primary_position'] in x)) &
@@ -34,4 +44,99 @@ def get_player_metrics(metric_grouping_information, row):
     ].iloc[0]
 
     # return position_group, general_metrics, lincoln_metrics, comparable_positions
-    return position_group, general_metrics, comparable_positions
\ No newline at end of file
+    return position_group, general_metrics, comparable_positions
+
+
+def parse_metric_group_list(value):
+    # Split a comma separated cell from statsbomb_metric_groups.csv into a list of stripped names
+    if isinstance(value, str):
+        return [item.strip().strip("'\"") for item in value.split(',') if item.strip()]
+    return [item.strip() for item in value]
+
+
+class MetricGroupRegistry:
+    '''
+    Compiled lookups for metric_grouping_information, built once so that every lookup is a dict access.
+
+    Holds the following:
+    position_to_group: primary_position -> position group (the first group containing the position, excluding 'all')
+    group_to_metrics: position group -> statsbomb metrics
+    group_to_positions: position group -> comparable statsbomb positions
+    '''
+
+    def __init__(self, metric_grouping_information):
+        # Validate the table
+        missing_columns = {'position_groups', 'positions_statsbomb', 'statsbomb_metrics'} - set(metric_grouping_information.columns)
+        if missing_columns:
+            raise ValueError(f"metric_grouping_information is missing columns: {sorted(missing_columns)}")
+
+        duplicated_groups = metric_grouping_information['position_groups'][metric_grouping_information['position_groups'].duplicated()]
+        if not duplicated_groups.empty:
+            raise ValueError(f"Duplicated position groups: {sorted(duplicated_groups)}")
+
+        self.metric_grouping_information = metric_grouping_information
+        self.position_to_group = {}
+        self.group_to_metrics = {}
+        self.group_to_positions = {}
+
+        for _, group_row in metric_grouping_information.iterrows():
+            position_group = group_row['position_groups']
+            comparable_positions = parse_metric_group_list(group_row['positions_statsbomb'])
+            general_metrics = parse_metric_group_list(group_row['statsbomb_metrics'])
+
+            if not comparable_positions or not general_metrics:
+                raise ValueError(f"Position group '{position_group}' has no positions or no metrics")
+
+            self.group_to_positions[position_group] = comparable_positions
+            self.group_to_metrics[position_group] = general_metrics
+
+            # Match get_player_metrics: the first group listing the position wins and 'all' is never assigned
+            if position_group != 'all':
+                for position in comparable_positions:
+                    self.position_to_group.setdefault(position, position_group)
+
+    @classmethod
+    def from_csv(cls, path):
+        '''
+        Load statsbomb_metric_groups.csv, splitting the comma separated position and metric cells into lists.
+        '''
+        metric_grouping_information = pd.read_csv(path)
+        for column in ['positions_statsbomb', 'statsbomb_metrics']:
+            metric_grouping_information[column] = metric_grouping_information[column].apply(parse_metric_group_list)
+
+        return cls(metric_grouping_information)
+
+    @property
+    def position_groups(self):
+        # Position groups players can be assigned to
+        return [group for group in self.group_to_positions if group != 'all']
+
+    def get_group_metrics(self, position_group):
+        '''
+        Returns position_group, general_metrics and comparable_positions for a position group.
+        '''
+        return position_group, self.group_to_metrics[position_group], self.group_to_positions[position_group]
+
+    def get_player_metrics(self, row):
+        '''
+        Returns position_group, general_metrics and comparable_positions for a player row, see get_player_metrics.
+        '''
+        try:
+            position_group = self.position_to_group[row['primary_position']]
+        except KeyError:
+            raise KeyError(f"No position group contains primary_position '{row['primary_position']}'") from None
+
+        return self.get_group_metrics(position_group)
+
+    def map_position_groups(self, primary_positions):
+        '''
+        Map a whole primary_position column to position groups in one call, unknown positions map to NaN.
+        '''
+        return pd.Series(primary_positions).map(self.position_to_group)
+
+
+def as_metric_group_registry(metric_grouping_information):
+    # Accept either the parsed metric_grouping_information frame or an existing registry
+    if isinstance(metric_grouping_information, MetricGroupRegistry):
+        return metric_grouping_information
+    return MetricGroupRegistry(metric_grouping_information)
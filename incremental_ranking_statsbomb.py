@@ -0,0 +1,203 @@
+from collections.abc import Mapping
+import numpy as np
+import pandas as pd
+from aggregate_rank_preprocessing_statsbomb import preprocess_df, normalize_values
+from remove_duplicate_rows_statsbomb import remove_duplicate_rows
+from aggregate_rank_statsbomb import calculate_percentiles
+from get_position_specific_metrics_statsbomb import as_metric_group_registry
+from ranking_cube_statsbomb import lookup_cohort_density
+from cohort_density_statsbomb import compute_cohort_density
+
+
+# Columns identifying a player-season row, as used by remove_duplicate_rows
+ROW_KEYS = ['player_id', 'season_id', 'competition_id', 'team_name']
+
+RANK_CHANGE_COLUMNS = ['season_id', 'competition_id', 'position_group', 'old_rank', 'new_rank', 'old_percentile',
+                       'new_percentile', 'player_id', 'player_name']
+
+
+class UpdatedRankingCube(Mapping):
+    '''
+    Ranking cube with some cohorts re-ranked or removed, reading every other cohort from the cube it was updated from.
+    The original cube is neither copied nor modified, so updating a MappedRankingCube never builds its other cohorts.
+
+    Holds the following:
+    ranking_cube: the cube the update was applied to
+    cohorts: cohort key -> re-ranked cohort DataFrame
+    removed_keys: keys of cohorts left empty by the update
+    densities: cohort key -> density of a re-ranked cohort (see compute_cohort_density)
+    '''
+
+    def __init__(self, ranking_cube, cohorts, removed_keys):
+        self.ranking_cube = ranking_cube
+        self.cohorts = cohorts
+        self.removed_keys = removed_keys
+        self.densities = {}
+
+    def __getitem__(self, key):
+        if key in self.cohorts:
+            return self.cohorts[key]
+        if key in self.removed_keys:
+            raise KeyError(key)
+
+        return self.ranking_cube[key]
+
+    def __iter__(self):
+        # The original cube's order, then cohorts new to the cube
+        for key in self.ranking_cube:
+            if key not in self.removed_keys:
+                yield key
+        for key in self.cohorts:
+            if key not in self.ranking_cube:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __contains__(self, key):
+        return key in self.cohorts or (key not in self.removed_keys and key in self.ranking_cube)
+
+    def get_cohort_density(self, season_id, competition_id, position_group):
+        # Densities of re-ranked cohorts are computed once, the others come from the original cube
+        key = (season_id, competition_id, position_group)
+        if key not in self.cohorts:
+            return lookup_cohort_density(self.ranking_cube, season_id, competition_id, position_group)
+        if key not in self.densities:
+            self.densities[key] = compute_cohort_density(self.cohorts[key]['average_rank'])
+
+        return self.densities[key]
+
+
+def get_raw_row_keys(raw_df):
+    # ROW_KEYS of raw export rows cleaned as preprocess_df cleans them, including rows its minutes filter drops
+    keys = raw_df.rename(columns=lambda column: column.strip().replace(' ', '_').lower())[ROW_KEYS]
+    return keys.assign(team_name=normalize_values(keys['team_name']))
+
+
+def get_affected_cohorts(rows, registry):
+    # Every (season_id, competition_id, position_group) cohort a set of rows belongs to
+    affected_cohorts = set()
+    for position_group in registry.position_groups:
+        in_group = rows['primary_position'].isin(registry.group_to_positions[position_group])
+        for season_id, competition_id in rows.loc[in_group, ['season_id', 'competition_id']].drop_duplicates().itertuples(index=False):
+            affected_cohorts.add((season_id, competition_id, position_group))
+
+    return affected_cohorts
+
+
+def compare_cohort_ranks(old_cohort_df, new_cohort_df):
+    # Overall rank (1 = best) and average_rank_percentile of every player before and after an update
+    columns = {}
+    for label, cohort_df in [('old', old_cohort_df), ('new', new_cohort_df)]:
+        if cohort_df is None or cohort_df.empty:
+            columns[f'{label}_rank'] = pd.Series(dtype=np.float64)
+            columns[f'{label}_percentile'] = pd.Series(dtype=np.float64)
+        else:
+            columns[f'{label}_rank'] = cohort_df['average_rank'].rank(method='min', ascending=False)
+            columns[f'{label}_percentile'] = cohort_df['average_rank_percentile']
+
+    return pd.DataFrame(columns)[['old_rank', 'new_rank', 'old_percentile', 'new_percentile']]
+
+
+def apply_season_stats_delta(df, ranking_cube, delta_df, metric_grouping_information, preprocessed=False):
+    '''
+    Function to fold new or changed player-season rows into df and re-rank only the cohorts they touch.
+
+    Rows in delta_df replace rows of df with the same player, season, competition and team (keeping their integer
+    index label) and any other rows are appended with new labels. A row whose refreshed version preprocess_df filters
+    out (700 minutes or fewer) is removed from df, as a full re-run would drop it. Only the (season, competition,
+    position group) cohorts containing an old or new version of a delta row are re-ranked, everything else in
+    ranking_cube is reused as is.
+
+    Parameters:
+    df (DataFrame): Pre-processed, de-duplicated league data the cube was built from.
+    ranking_cube (dict): Ranked cohorts from build_ranking_cube.
+    delta_df (DataFrame): New or changed rows, raw StatsBomb export rows unless preprocessed is True. It is not
+                          modified.
+    metric_grouping_information (DataFrame or MetricGroupRegistry): Metrics for grouping players.
+    preprocessed (bool): Whether delta_df has already been through preprocess_df (then rows it filtered out are not
+                         in delta_df, and their old versions are kept).
+
+    Returns the following:
+    updated_df: df with the delta applied
+    updated_cube: UpdatedRankingCube with the affected cohorts re-ranked, reading the others from ranking_cube
+                  (which is not modified)
+    rank_changes: one row per player whose rank or percentile changed, with the cohort, old and new rank and
+                  old and new average_rank_percentile (old values are NaN for players new to a cohort)
+    '''
+    registry = as_metric_group_registry(metric_grouping_information)
+
+    # Keys of every delta row, taken before the minutes filter so refreshed rows it drops still replace their old rows
+    if preprocessed:
+        refreshed_keys = delta_df[ROW_KEYS]
+    else:
+        refreshed_keys = get_raw_row_keys(delta_df)
+        delta_df = preprocess_df(delta_df.copy())
+    delta_df = remove_duplicate_rows(delta_df)
+
+    # Match delta rows to existing rows, existing rows whose refreshed version was filtered out are removed
+    existing_keys = pd.MultiIndex.from_frame(df[ROW_KEYS])
+    delta_keys = pd.MultiIndex.from_frame(delta_df[ROW_KEYS])
+    replaced_mask = existing_keys.isin(pd.MultiIndex.from_frame(refreshed_keys))
+    replaced_df = df[replaced_mask]
+
+    # Changed rows keep their index label, new rows get fresh labels after the current maximum
+    label_for_key = pd.Series(replaced_df.index, index=existing_keys[replaced_mask])
+    delta_labels = label_for_key.reindex(delta_keys).to_numpy(dtype=np.float64, copy=True)
+    new_rows = np.isnan(delta_labels)
+    next_label = (df.index.max() + 1) if len(df) else 0
+    delta_labels[new_rows] = np.arange(next_label, next_label + new_rows.sum())
+    delta_df = delta_df.set_axis(delta_labels.astype(np.int64))
+
+    updated_df = pd.concat([df[~replaced_mask], delta_df])
+
+    # Cohorts touched by either the old or the new version of a row
+    affected_cohorts = get_affected_cohorts(replaced_df, registry) | get_affected_cohorts(delta_df, registry)
+
+    # Restrict to the affected seasons and competitions once rather than scanning the full frame per cohort
+    affected_pairs = {(season_id, competition_id) for season_id, competition_id, _ in affected_cohorts}
+    candidate_df = updated_df[pd.MultiIndex.from_frame(updated_df[['season_id', 'competition_id']]).isin(list(affected_pairs))]
+
+    # Successive updates stack on the cube they started from rather than on each other
+    if isinstance(ranking_cube, UpdatedRankingCube):
+        updated_cohorts, removed_keys = dict(ranking_cube.cohorts), set(ranking_cube.removed_keys)
+        base_cube = ranking_cube.ranking_cube
+    else:
+        updated_cohorts, removed_keys, base_cube = {}, set(), ranking_cube
+    rank_changes = []
+
+    for season_id, competition_id, position_group in sorted(affected_cohorts, key=str):
+        _, general_metrics, comparable_positions = registry.get_group_metrics(position_group)
+        cohort_key = (season_id, competition_id, position_group)
+
+        # Re-rank the cohort
+        new_cohort_df = calculate_percentiles(candidate_df, season_id, competition_id, comparable_positions, general_metrics)
+        old_cohort_df = ranking_cube.get(cohort_key)
+
+        if new_cohort_df.empty:
+            updated_cohorts.pop(cohort_key, None)
+            removed_keys.add(cohort_key)
+        else:
+            updated_cohorts[cohort_key] = new_cohort_df
+            removed_keys.discard(cohort_key)
+
+        # Record players whose rank or percentile moved
+        comparison = compare_cohort_ranks(old_cohort_df, new_cohort_df)
+        changed = comparison[(comparison['old_rank'] != comparison['new_rank']) |
+                             (comparison['old_percentile'] != comparison['new_percentile'])]
+        if changed.empty:
+            continue
+
+        players = pd.concat([new_cohort_df, old_cohort_df]) if old_cohort_df is not None else new_cohort_df
+        players = players[~players.index.duplicated()]
+        changed = changed.join(players[['player_id', 'player_name']])
+        changed.insert(0, 'position_group', position_group)
+        changed.insert(0, 'competition_id', competition_id)
+        changed.insert(0, 'season_id', season_id)
+        rank_changes.append(changed)
+
+    rank_changes = pd.concat(rank_changes) if rank_changes else pd.DataFrame(columns=RANK_CHANGE_COLUMNS)
+
+    updated_cube = UpdatedRankingCube(base_cube, updated_cohorts, removed_keys)
+
+    return updated_df, updated_cube, rank_changes
@@ -0,0 +1,177 @@
+import functools
+import json
+import time
+import tracemalloc
+from contextlib import contextmanager
+import pandas as pd
+
+
+# Opt-in state, nothing is recorded until enable_instrumentation is called
+_state = {'enabled': False, 'trace_memory': False, 'records': [], 'stack': [], 'tags': {}}
+
+
+def enable_instrumentation(trace_memory=True):
+    '''
+    Start recording wall time, CPU time and (if trace_memory) peak Python allocation for every pipeline stage.
+
+    Memory tracing uses tracemalloc, which slows allocation-heavy code down, so it can be switched off.
+    '''
+    _state.update(enabled=True, trace_memory=trace_memory, stack=[], tags={})
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def disable_instrumentation():
+    # Stop recording, already recorded stages are kept
+    if _state['trace_memory'] and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _state.update(enabled=False, trace_memory=False, stack=[], tags={})
+
+
+def is_instrumentation_enabled():
+    return _state['enabled']
+
+
+def get_stage_records():
+    # Recorded stages, one dict per stage run
+    return list(_state['records'])
+
+
+def clear_stage_records():
+    _state['records'].clear()
+
+
+def start_stage(stage, **tags):
+    '''
+    Start timing a stage, returns a handle for stop_stage (None when instrumentation is disabled).
+
+    Stages nest: tags of enclosing stages and stage_tags blocks are added to every stage started inside them.
+    '''
+    if not _state['enabled']:
+        return None
+
+    frame = {'stage': stage, 'tags': {**_state['tags'], **tags}, 'peak': 0, 'start_current': 0,
+             'parent': _state['stack'][-1]['stage'] if _state['stack'] else None}
+
+    # Carry the running peak up to the enclosing stage before resetting it for this one
+    if _state['trace_memory']:
+        current, peak = tracemalloc.get_traced_memory()
+        if _state['stack']:
+            _state['stack'][-1]['peak'] = max(_state['stack'][-1]['peak'], peak)
+        tracemalloc.reset_peak()
+        frame['start_current'] = current
+
+    _state['stack'].append(frame)
+    frame['wall_start'] = time.perf_counter()
+    frame['cpu_start'] = time.process_time()
+
+    return frame
+
+
+def stop_stage(frame, **tags):
+    # Finish a stage started with start_stage and record it, extra tags (e.g. cohort_size) can be added here
+    if frame is None or not _state['enabled']:
+        return
+
+    wall_seconds = time.perf_counter() - frame['wall_start']
+    cpu_seconds = time.process_time() - frame['cpu_start']
+
+    # Unwind any stage left open inside this one (e.g. by an exception)
+    stack = _state['stack']
+    while stack and stack[-1] is not frame:
+        stack.pop()
+    if stack:
+        stack.pop()
+
+    peak_bytes = None
+    if _state['trace_memory']:
+        peak = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+        peak_bytes = peak - frame['start_current']
+        if stack:
+            stack[-1]['peak'] = max(stack[-1]['peak'], peak)
+
+    _state['records'].append({
+        'stage': frame['stage'],
+        'parent': frame['parent'],
+        'wall_seconds': wall_seconds,
+        'cpu_seconds': cpu_seconds,
+        'peak_bytes': peak_bytes,
+        **frame['tags'],
+        **tags,
+    })
+
+
+@contextmanager
+def record_stage(stage, **tags):
+    '''
+    Record the enclosed block as a stage. Yields a dict, anything added to it is stored as a tag on the record.
+    '''
+    frame = start_stage(stage, **tags)
+    extra_tags = {}
+    try:
+        yield extra_tags
+    finally:
+        stop_stage(frame, **extra_tags)
+
+
+@contextmanager
+def stage_tags(**tags):
+    # Add tags (e.g. player_id and season_name) to every stage recorded inside the block
+    previous_tags = _state['tags']
+    _state['tags'] = {**previous_tags, **tags}
+    try:
+        yield
+    finally:
+        _state['tags'] = previous_tags
+
+
+def instrument_stage(function):
+    '''
+    Decorator recording every call of a pipeline function as a stage named after the function.
+
+    The number of input rows (first DataFrame argument) and, for functions returning a DataFrame, the number of
+    output rows as cohort_size are added as tags.
+    '''
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not _state['enabled']:
+            return function(*args, **kwargs)
+
+        input_rows = next((len(arg) for arg in args if isinstance(arg, pd.DataFrame)), None)
+        frame = start_stage(function.__name__, input_rows=input_rows)
+        result = None
+        try:
+            result = function(*args, **kwargs)
+        finally:
+            stop_stage(frame, **({'cohort_size': len(result)} if isinstance(result, pd.DataFrame) else {}))
+
+        return result
+
+    return wrapper
+
+
+def export_stage_records(path):
+    # Append recorded stages to a JSON lines file
+    with open(path, 'a') as f:
+        for record in _state['records']:
+            f.write(json.dumps(record, default=str) + '\n')
+
+
+def summarize_stage_records():
+    '''
+    Summary table of recorded stages: number of runs, total and mean wall and CPU time and the largest peak
+    allocation per stage, slowest stages first.
+    '''
+    records_df = pd.DataFrame(_state['records'])
+    if records_df.empty:
+        return records_df
+
+    summary_df = records_df.groupby('stage').agg(
+        runs=('wall_seconds', 'size'),
+        total_wall_seconds=('wall_seconds', 'sum'),
+        mean_wall_seconds=('wall_seconds', 'mean'),
+        total_cpu_seconds=('cpu_seconds', 'sum'),
+        max_peak_bytes=('peak_bytes', 'max'),
+    )
+
+    return summary_df.sort_values('total_wall_seconds', ascending=False)
@@ -0,0 +1,140 @@
+import numpy as np
+import pandas as pd
+from ranking_cube_statsbomb import lookup_cohort
+
+
+class CohortLeaderboard:
+    '''
+    Leaderboard queries over one ranked cohort (e.g. a ranking cube cohort or a calculate_percentiles output)
+    without sorting the whole cohort for every query.
+
+    Every pool of players (the whole cohort, or the players younger than an age cutoff) has its average_rank values
+    sorted once and cached, so the rank of any player is a binary search. Top-N queries pick the N best rows with
+    np.argpartition and only sort those.
+
+    Ranks match average_rank.rank(method='min', ascending=False) within the pool: 1 = highest average_rank and ties
+    share the lowest rank. Rows without an average_rank are not ranked. Age cutoffs are exclusive as in AGE_BANDS,
+    so the plots' U21 pool (age < 22) is age_cutoff=22.
+    '''
+
+    def __init__(self, ranking_df):
+        self.ranking_df = ranking_df
+        self.average_rank = ranking_df['average_rank'].to_numpy(dtype=np.float64)
+        self.ages = ranking_df['age'].to_numpy(dtype=np.float64, na_value=np.nan)
+
+        self.team_positions = None
+
+        # column -> values of ranking_df, taken out of the frame once
+        self.column_values = {}
+
+        # age_cutoff -> average_rank of the pool, ascending
+        self.sorted_average_ranks = {}
+
+    def get_pool_mask(self, age_cutoff=None):
+        # Ranked rows in the pool
+        mask = ~np.isnan(self.average_rank)
+        if age_cutoff is not None:
+            mask &= self.ages < age_cutoff
+
+        return mask
+
+    def get_sorted_average_ranks(self, age_cutoff=None):
+        if age_cutoff not in self.sorted_average_ranks:
+            self.sorted_average_ranks[age_cutoff] = np.sort(self.average_rank[self.get_pool_mask(age_cutoff)])
+
+        return self.sorted_average_ranks[age_cutoff]
+
+    def get_total(self, age_cutoff=None):
+        # Number of ranked players in the pool
+        return len(self.get_sorted_average_ranks(age_cutoff))
+
+    def get_ranks(self, average_ranks, age_cutoff=None):
+        # Rank each average_rank value would have within the pool, 1 + the number of higher values
+        sorted_average_ranks = self.get_sorted_average_ranks(age_cutoff)
+        return len(sorted_average_ranks) - np.searchsorted(sorted_average_ranks, average_ranks, side='right') + 1
+
+    def get_team_positions(self, team_name):
+        # Row positions of every team, grouped once
+        if self.team_positions is None:
+            self.team_positions = dict(self.ranking_df.groupby('team_name', sort=False, observed=True).indices)
+
+        return self.team_positions.get(team_name, np.empty(0, dtype=np.intp))
+
+    def get_rank(self, index, age_cutoff=None):
+        '''
+        Function to look up the rank of a row of the cohort.
+
+        Parameters:
+        index: Index label of the row in ranking_df.
+        age_cutoff (int, optional): Rank among the players younger than this only.
+
+        Returns:
+        rank (int): 1 = highest average_rank, None if the row is not in the pool.
+        total (int): Number of ranked players in the pool.
+        '''
+        position = self.ranking_df.index.get_loc(index)
+        total = self.get_total(age_cutoff)
+        if not self.get_pool_mask(age_cutoff)[position]:
+            return None, total
+
+        return int(self.get_ranks(self.average_rank[position], age_cutoff)), total
+
+    def top(self, n=10, age_cutoff=None, team_name=None, columns=None):
+        '''
+        Function to get the N highest ranked players of the cohort.
+
+        Parameters:
+        n (int): Number of players, None for all of them.
+        age_cutoff (int, optional): Only players younger than this, ranked among themselves.
+        team_name (str, optional): Only players of this team, keeping their rank within the whole pool.
+        columns (list, optional): Columns of ranking_df to return, defaults to all. Selecting the few columns a
+                                  leaderboard shows is much cheaper, the cohort frame is never copied.
+
+        Returns:
+        leaderboard_df (DataFrame): Rows of ranking_df by descending average_rank (ties in cohort order), with their
+                                    'rank' within the pool (see get_total for the pool size).
+        '''
+        mask = self.get_pool_mask(age_cutoff)
+        positions = np.flatnonzero(mask) if team_name is None else self.get_team_positions(team_name)
+        if team_name is not None:
+            positions = positions[mask[positions]]
+
+        average_ranks = self.average_rank[positions]
+        if n is not None and n < len(positions):
+            best = np.argpartition(-average_ranks, n - 1)[:n] if n > 0 else np.empty(0, dtype=np.intp)
+            positions, average_ranks = positions[best], average_ranks[best]
+
+        order = np.lexsort((positions, -average_ranks))
+        positions, average_ranks = positions[order], average_ranks[order]
+
+        ranks = self.get_ranks(average_ranks, age_cutoff)
+        if columns is None:
+            return self.ranking_df.take(positions).assign(rank=ranks)
+
+        # One DataFrame built from the cached column values, much cheaper than taking and extending a wide frame
+        for column in columns:
+            if column not in self.column_values:
+                self.column_values[column] = self.ranking_df[column].array
+
+        return pd.DataFrame({**{column: self.column_values[column][positions] for column in columns}, 'rank': ranks},
+                            index=self.ranking_df.index[positions])
+
+
+class LeaderboardIndex:
+    '''
+    Cohort leaderboards of a ranking cube, built the first time each cohort is queried and kept, e.g.
+
+        leaderboards = LeaderboardIndex(ranking_cube)
+        leaderboards.get_leaderboard(season_id, competition_id, 'winger').top(10, age_cutoff=22)
+    '''
+
+    def __init__(self, ranking_cube):
+        self.ranking_cube = ranking_cube
+        self.leaderboards = {}
+
+    def get_leaderboard(self, season_id, competition_id, position_group):
+        key = (season_id, competition_id, position_group)
+        if key not in self.leaderboards:
+            self.leaderboards[key] = CohortLeaderboard(lookup_cohort(self.ranking_cube, *key))
+
+        return self.leaderboards[key]
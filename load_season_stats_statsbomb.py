@@ -0,0 +1,132 @@
+import pandas as pd
+from pandas.api.types import union_categoricals, is_float_dtype
+from aggregate_rank_preprocessing_statsbomb import PREPROCESSING_METRICS
+from get_position_specific_metrics_statsbomb import as_metric_group_registry
+from instrumentation_statsbomb import instrument_stage
+
+
+# Declared schema for player_season_stats.csv, keyed on cleaned column names (see clean_column_name).
+# Metrics are read next to these columns, see get_column_dtypes.
+SEASON_STATS_SCHEMA = {
+    'player_id': 'int32',
+    'player_name': 'str',
+    'team_name': 'category',
+    'competition_id': 'int32',
+    'competition_name': 'category',
+    'season_id': 'int32',
+    'season_name': 'category',
+    'birth_date': 'str',
+    'primary_position': 'category',
+    'minutes': 'float64',
+    'appearances': 'float32',
+}
+
+# dtype for every metric
+METRIC_DTYPE = 'float32'
+
+# Rows read to tell metric (float) columns from the rest when no metric groups are given
+DTYPE_SAMPLE_ROWS = 1000
+
+
+def clean_column_name(column):
+    # Same cleaning preprocess_df applies to column names
+    return column.strip().replace(' ', '_').lower().replace('player_season_', '')
+
+
+def get_metric_columns(metric_grouping_information):
+    # Cleaned names of every metric the metric groups rank on, plus the raw metrics preprocess_df needs
+    registry = as_metric_group_registry(metric_grouping_information)
+    return {*PREPROCESSING_METRICS, *(metric for metrics in registry.group_to_metrics.values() for metric in metrics)}
+
+
+def get_column_dtypes(csv_path, schema=SEASON_STATS_SCHEMA, metric_grouping_information=None):
+    '''
+    Function to map the raw column names in a season stats export to the dtypes they are read with.
+
+    Schema columns get their declared dtypes. With metric groups, their metrics (and the ones preprocess_df needs)
+    are read as METRIC_DTYPE and every other column is left out. Without them nothing is left out: columns holding
+    floats in the first DTYPE_SAMPLE_ROWS rows are read as METRIC_DTYPE, any other column with pandas' inferred dtype.
+
+    Returns a dict of raw column name -> dtype (None for inferred) for every column that should be read.
+    '''
+    if metric_grouping_information is None:
+        sample_df = pd.read_csv(csv_path, nrows=DTYPE_SAMPLE_ROWS)
+        metric_columns = {clean_column_name(column) for column in sample_df.columns if is_float_dtype(sample_df[column])}
+        keep_unknown = True
+    else:
+        metric_columns = get_metric_columns(metric_grouping_information)
+        keep_unknown = False
+
+    column_dtypes = {}
+    for column in pd.read_csv(csv_path, nrows=0).columns:
+        cleaned = clean_column_name(column)
+        if cleaned in schema:
+            column_dtypes[column] = schema[cleaned]
+        elif cleaned in metric_columns:
+            column_dtypes[column] = METRIC_DTYPE
+        elif keep_unknown:
+            column_dtypes[column] = None
+
+    return column_dtypes
+
+
+@instrument_stage
+def read_player_season_stats(csv_path, metric_grouping_information=None, schema=SEASON_STATS_SCHEMA):
+    '''
+    Function to read player_season_stats.csv against a declared schema.
+
+    Names, teams, competitions, positions and seasons are read as categoricals, ids as integers and metrics as
+    float32, and with metric groups the columns they do not use are never parsed (see get_column_dtypes). pandas'
+    C parser reads the file in chunks, converting each to these dtypes as it goes and concatenating them column by
+    column, so peak memory stays close to the size of the compact frame rather than an object/float64 one.
+
+    Parameters:
+    csv_path (str): Path to player_season_stats.csv.
+    metric_grouping_information (DataFrame or MetricGroupRegistry, optional): Metric groups whose metrics are
+                                                                              read, defaults to every column.
+    schema (dict): Cleaned column name -> dtype, defaults to SEASON_STATS_SCHEMA.
+
+    Returns:
+    df (DataFrame): Raw season stats (original column names) with compact dtypes.
+    '''
+    column_dtypes = get_column_dtypes(csv_path, schema, metric_grouping_information)
+
+    return pd.read_csv(csv_path, usecols=list(column_dtypes),
+                       dtype={column: dtype for column, dtype in column_dtypes.items() if dtype is not None})
+
+
+def concat_with_aligned_categories(frames):
+    '''
+    Function to concatenate frames (chunks or separate exports) with a fresh index, keeping categorical columns
+    categorical by aligning their categories first. Columns missing from some frames are filled with NaN.
+    '''
+    frames = [frame.copy(deep=False) for frame in frames]
+
+    categorical_columns = {column for frame in frames for column in frame.columns
+                           if isinstance(frame[column].dtype, pd.CategoricalDtype)}
+    for column in categorical_columns:
+        columns = [frame[column] for frame in frames if column in frame.columns]
+        if all(isinstance(values.dtype, pd.CategoricalDtype) for values in columns):
+            categories = union_categoricals(columns).categories
+            for frame in frames:
+                if column in frame.columns:
+                    frame[column] = frame[column].cat.set_categories(categories)
+
+    return pd.concat(frames, ignore_index=True)
+
+
+def report_memory_savings(csv_path, metric_grouping_information=None):
+    '''
+    Function to compare the memory used by a plain pd.read_csv frame and the schema-driven frame.
+
+    Returns a dict with the deep memory usage (bytes) of each frame, the bytes saved and the fraction saved.
+    '''
+    default_bytes = int(pd.read_csv(csv_path).memory_usage(deep=True).sum())
+    schema_bytes = int(read_player_season_stats(csv_path, metric_grouping_information).memory_usage(deep=True).sum())
+
+    return {
+        'default_bytes': default_bytes,
+        'schema_bytes': schema_bytes,
+        'saved_bytes': default_bytes - schema_bytes,
+        'saved_fraction': (default_bytes - schema_bytes) / default_bytes,
+    }
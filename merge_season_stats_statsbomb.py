@@ -0,0 +1,69 @@
+import numpy as np
+import pandas as pd
+from aggregate_rank_preprocessing_statsbomb import preprocess_df
+from load_season_stats_statsbomb import read_player_season_stats, concat_with_aligned_categories
+from remove_duplicate_rows_statsbomb import get_key_codes, get_deduplicated_positions
+from instrumentation_statsbomb import instrument_stage
+
+
+@instrument_stage
+def merge_season_stats(sources, source_names=None, preprocessed=False):
+    '''
+    Function to merge several season stats exports (e.g. the legacy CCFC and subscribed LCFC ones) into one
+    de-duplicated frame, keeping the highest-minutes row per player, season, competition and team.
+
+    Gives the same rows in the same order as concatenating the sources and calling remove_duplicate_rows, but the
+    kept rows are found by hashing (see get_max_minutes_positions) and the frame is never sorted. The index is
+    reset, so rows from different sources never share a label.
+
+    Parameters:
+    sources (list): DataFrames and/or paths to player_season_stats CSV exports, earlier sources win ties on minutes.
+    source_names (list, optional): Name of every source in the report, defaults to the path or 'source_<i>'.
+    preprocessed (bool): Whether DataFrame sources have already been through preprocess_df (paths never have).
+
+    Returns the following:
+    df: The pre-processed, de-duplicated season stats
+    source_report: one row per source with the rows it was read with (raw_rows), the rows left after
+                   preprocess_df (rows), the rows kept in df (kept), the rows dropped as duplicates (lost) and how
+                   many of those lost to a row from another source (lost_to_other_sources)
+    '''
+    if source_names is None:
+        source_names = [source if isinstance(source, str) else f'source_{i}' for i, source in enumerate(sources)]
+
+    frames = []
+    raw_rows = []
+    for source in sources:
+        if isinstance(source, str):
+            frame = read_player_season_stats(source)
+            raw_rows.append(len(frame))
+            frame = preprocess_df(frame)
+        else:
+            raw_rows.append(len(source))
+            frame = source if preprocessed else preprocess_df(source.copy())
+        frames.append(frame)
+
+    rows = np.array([len(frame) for frame in frames])
+    source_ids = np.repeat(np.arange(len(frames)), rows)
+    df = concat_with_aligned_categories(frames)
+
+    # Keep the highest-minutes row per key, ordered as remove_duplicate_rows orders them
+    key_codes = get_key_codes(df)
+    positions = get_deduplicated_positions(df, key_codes)
+
+    # Source of the row every key kept, to tell duplicates within a source from ones lost to another source
+    is_kept = np.zeros(len(df), dtype=bool)
+    is_kept[positions] = True
+    winning_source = pd.Series(source_ids[positions], index=key_codes[positions]).reindex(key_codes).to_numpy()
+    lost_to_other_sources = ~is_kept & (winning_source != source_ids)
+
+    kept = np.bincount(source_ids[positions], minlength=len(frames))
+    source_report = pd.DataFrame({
+        'source': source_names,
+        'raw_rows': raw_rows,
+        'rows': rows,
+        'kept': kept,
+        'lost': rows - kept,
+        'lost_to_other_sources': np.bincount(source_ids[lost_to_other_sources], minlength=len(frames)),
+    })
+
+    return df.iloc[positions], source_report
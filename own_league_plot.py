@@ -5,10 +5,16 @@ from matplotlib.colors import Normalize
 from matplotlib.cm import get_cmap
 from get_position_specific_metrics_statsbomb import get_player_metrics
 from aggregate_rank_statsbomb import calculate_percentiles
+from ranking_cube_statsbomb import lookup_cohort, lookup_cohort_density
+from age_band_ranking_statsbomb import rank_age_bands
 from scipy.stats import rankdata
 import os
+from plot_output_statsbomb import render_season_report, use_headless_backend
+from cohort_density_statsbomb import compute_cohort_density, plot_cohort_histogram
+from instrumentation_statsbomb import record_stage, stage_tags
 
-def plot_stacked_distribution_u21_flag(player_df, df, metric_grouping_information, save_path):
+def plot_stacked_distribution_u21_flag(player_df, df, metric_grouping_information, save_path, ranking_cube=None,
+                                       headless=False, image_format='png', dpi=None, seasons_per_page=None):
 
     """
     Generate a distribution plot of player rankings in their own league, including annotations for specific players
@@ -18,9 +24,16 @@ def plot_stacked_distribution_u21_flag(player_df, df, metric_grouping_informatio
     player_df (DataFrame): DataFrame containing player data.
     df (DataFrame): DataFrame with general league data.
     metric_grouping_information (dict): Dictionary containing metrics for grouping players.
+    ranking_cube (dict, optional): Pre-ranked cohorts from build_ranking_cube, looked up instead of re-ranking df.
+    headless (bool): Use the Agg backend and close the figure instead of showing it, for batch and server runs.
+    image_format (str): Image format passed to savefig, e.g. 'png', 'pdf' or 'svg'.
+    dpi (float, optional): Resolution of raster formats, defaults to matplotlib's savefig.dpi.
+    seasons_per_page (int, optional): Draw this many seasons per page, writing each page as soon as it is drawn (one
+                                      multi-page PDF, or numbered images for other formats) so memory stays bounded
+                                      for long careers. Defaults to every season on one figure.
 
     Returns:
-    None. This function saves and displays the plot.
+    file_paths (list): Paths of the saved images. This function saves and displays the plot.
 
     Note:
     - This function assumes 'get_player_metrics', 'calculate_percentiles' are defined elsewhere.
@@ -28,58 +41,71 @@ def plot_stacked_distribution_u21_flag(player_df, df, metric_grouping_informatio
     """
     
 
-    # Ensure axes is always iterable by wrapping single axis in a list
-    fig, axes = plt.subplots(len(player_df), 1, figsize=(8, 4.5 * len(player_df)))  # Increased figure size for annotations
-    if not isinstance(axes, np.ndarray):  # If only one subplot, wrap in a list
-        axes = [axes]
+    # Never open a GUI window in headless mode
+    if headless:
+        use_headless_backend()
+
+    # Rank one season: look up (or calculate) its cohort and everything drawn from it
+    def rank_season(index, row):
+        # Tag the lookup and ranking stages with the player and season (instrumentation only)
+        with stage_tags(player_id=row['player_id'], season_name=row['season_name']):
+            position_group, general_metrics, comparable_positions = get_player_metrics(metric_grouping_information, row)
+
+            # Calculate rankings, or look them up if the cohorts have already been ranked
+            if ranking_cube is not None:
+                general_df = lookup_cohort(ranking_cube, row['season_id'], row['competition_id'], position_group)
+            else:
+                general_df = calculate_percentiles(df, row['season_id'], row['competition_id'], comparable_positions, general_metrics)
+
+            # Sort general_df by 'average_rank' for accurate ranking
+            sorted_general_df = general_df.sort_values('average_rank', ascending=False)
+
+            # Histogram and KDE of the cohort, stored with the ranking cube's cohorts
+            with record_stage('cohort_density', cohort_size=len(sorted_general_df)):
+                if ranking_cube is not None:
+                    cohort_density = lookup_cohort_density(ranking_cube, row['season_id'], row['competition_id'],
+                                                           position_group)
+                else:
+                    cohort_density = compute_cohort_density(sorted_general_df['average_rank'])
+
+            # Rank players under 21 once
+            age_band_df = rank_age_bands(sorted_general_df) if row['age'] < 22 else None
 
-    for i, (index, row) in enumerate(player_df.iterrows()):
-        season_id = row['season_id']
-        competition_id = row['competition_id']
+        return dict(position_group=position_group, sorted_general_df=sorted_general_df, cohort_density=cohort_density,
+                    age_band_df=age_band_df)
+
+    # Draw one season's subplot
+    def draw_season(ax, index, row, season):
         competition_name = row['competition_name']
         player_name = row['player_name']
         player_position = row['primary_position']
         player_age = row['age']  # Assuming 'age' is in player_df
-
-
-        position_group, general_metrics, comparable_positions = get_player_metrics(metric_grouping_information, row)
-
-
-        # Calculate rankings
-        general_df = calculate_percentiles(df, season_id, competition_id, comparable_positions, general_metrics)
-
-
-        column_list = general_df.columns.tolist()
-
-        # Check if 'season' is in any column name
-        season_columns = [col for col in general_df.columns if 'season' in col]
+        position_group = season['position_group']
+        sorted_general_df = season['sorted_general_df']
 
         # General plot
         title_general = f"{position_group.replace('_', ' ').title()}s: {row['competition_name'].replace('_', ' ').title()}, {row['season_name']}"
         # title_general = f"{row['competition_name'].replace('_', ' ').title()}, {row['season_name']}"
 
-        # Sort general_df by 'average_rank' for accurate ranking
-        sorted_general_df = general_df.sort_values('average_rank', ascending=False)
-
         # Plot distribution of 'average_rank' for general_df
-        sns.histplot(sorted_general_df['average_rank'], kde=True, ax=axes[i])
-        axes[i].set_title(title_general)
-        axes[i].set_xlabel('Player Score')
-        axes[i].set_ylabel('Number of Players')
+        plot_cohort_histogram(ax, season['cohort_density'])
+        ax.set_title(title_general)
+        ax.set_xlabel('Player Score')
+        ax.set_ylabel('Number of Players')
 
         # Plot distribution of 'average_rank' for general_df
-        # sns.histplot(sorted_general_df['average_rank'], kde=True, ax=axes[i])
-        # axes[i].set_title(title_general)
-        # axes[i].set_xlabel('Player Score')
-        # axes[i].set_ylabel('Number of Players')
+        # sns.histplot(sorted_general_df['average_rank'], kde=True, ax=ax)
+        # ax.set_title(title_general)
+        # ax.set_xlabel('Player Score')
+        # ax.set_ylabel('Number of Players')
 
         # # Set custom x-axis labels to plot ten percentile values
         # percentiles = np.linspace(0, 100, 10)
-        # axes[i].set_xticks(np.linspace(sorted_general_df['average_rank'].min(), sorted_general_df['average_rank'].max(), 10))
-        # axes[i].set_xticklabels([f'{p:.0f}%' for p in percentiles])
+        # ax.set_xticks(np.linspace(sorted_general_df['average_rank'].min(), sorted_general_df['average_rank'].max(), 10))
+        # ax.set_xticklabels([f'{p:.0f}%' for p in percentiles])
 
         # Draw vertical line for the player's average_rank for general_df - Bobby Wales in red
-        axes[i].axvline(sorted_general_df.loc[index, 'average_rank'], color='r', linestyle='--', label=player_name)
+        ax.axvline(sorted_general_df.loc[index, 'average_rank'], color='r', linestyle='--', label=player_name)
 
         # Add text box for player's rank information
         total_players = len(sorted_general_df)
@@ -89,13 +115,13 @@ def plot_stacked_distribution_u21_flag(player_df, df, metric_grouping_informatio
 
         # Check if player is under 21
         if player_age < 22:
-            # Filter for players under 21
-            u21_df = sorted_general_df[sorted_general_df['age'] < 22]
+            # Filter for the players under 21
+            age_band_df = season['age_band_df']
+            u21_df = age_band_df[age_band_df['u21_rank'].notna()]
 
             # Define color mapping for U21 players based on rank
             cmap = get_cmap('viridis')
-            norm = Normalize(vmin=u21_df['average_rank'].rank(method='min', ascending=False).min(),
-                             vmax=u21_df['average_rank'].rank(method='min', ascending=False).max())
+            norm = Normalize(vmin=u21_df['u21_rank'].min(), vmax=u21_df['u21_rank'].max())
 
             # Sort U21 players by rank for legend
             sorted_u21_df = u21_df.sort_values(by='average_rank', ascending=False)
@@ -104,7 +130,7 @@ def plot_stacked_distribution_u21_flag(player_df, df, metric_grouping_informatio
             labels = []
 
             for u21_index, u21_row in sorted_u21_df.iterrows():
-                u21_player_rank = u21_df['average_rank'].rank(method='min', ascending=False).loc[u21_index]
+                u21_player_rank = u21_row['u21_rank']
                 u21_total_players = len(u21_df)
                 u21_player_name = u21_row['player_name']
 
@@ -112,21 +138,21 @@ def plot_stacked_distribution_u21_flag(player_df, df, metric_grouping_informatio
                 if u21_player_name == player_name:
                     color = 'red'
                 else:
-                    color = cmap(norm(u21_df['average_rank'].rank(method='min', ascending=False).loc[u21_index]))
-
-                line = axes[i].axvline(u21_row['average_rank'], color=color, linestyle=':', alpha=0.5)
-                # axes[i].annotate(f"{u21_player_name}\nU21 Rank: {int(u21_player_rank)}/{u21_total_players}",
-                #                  xy=(u21_row['average_rank'], axes[i].get_ylim()[1] * 0.8),
-                #                  xytext=(5, 5), textcoords='offset points',
-                #                  ha='center', va='bottom',
-                #                  fontsize=8, color=color, alpha=0.8)
+                    color = cmap(norm(u21_player_rank))
+
+                line = ax.axvline(u21_row['average_rank'], color=color, linestyle=':', alpha=0.5)
+                # ax.annotate(f"{u21_player_name}\nU21 Rank: {int(u21_player_rank)}/{u21_total_players}",
+                #             xy=(u21_row['average_rank'], ax.get_ylim()[1] * 0.8),
+                #             xytext=(5, 5), textcoords='offset points',
+                #             ha='center', va='bottom',
+                #             fontsize=8, color=color, alpha=0.8)
                 lines.append(line)
                 # labels.append(f"{u21_player_name} (U21 Rank: {int(u21_player_rank)})")
                 labels.append(f"{u21_player_name} (Percentile: {int(100-u21_row['average_rank_percentile'])})")
                 # labels.append(f"{u21_player_name}")
 
             # Recalculate rank percentile for the specific U21 player
-            u21_player_rank = u21_df['average_rank'].rank(method='min', ascending=False).loc[index] if index in u21_df.index else "Not in U21"
+            u21_player_rank = u21_df.loc[index, 'u21_rank'] if index in u21_df.index else "Not in U21"
             u21_total_players = len(u21_df)
             u21_text = f"\nRanked {int(u21_player_rank)} out of {u21_total_players} U21 players"
             combined_text = general_text + u21_text
@@ -138,28 +164,18 @@ def plot_stacked_distribution_u21_flag(player_df, df, metric_grouping_informatio
             # only keep part before .split('Rank: ')[1] in sorted labels
             # sorted_labels = [label.split('(')[0] for label in sorted_labels]
 
-            axes[i].legend(sorted_lines, sorted_labels, loc='center left', bbox_to_anchor=(1, 0.5), title=f"U21 Percentiles: {player_name.replace('_', ' ').title()} & {competition_name.replace('_', ' ').title()} Players")
+            ax.legend(sorted_lines, sorted_labels, loc='center left', bbox_to_anchor=(1, 0.5), title=f"U21 Percentiles: {player_name.replace('_', ' ').title()} & {competition_name.replace('_', ' ').title()} Players")
         else:
             # combined_text = general_text + "\nPlayer is not under 21."
             combined_text = general_text
-            axes[i].legend(loc='center left', bbox_to_anchor=(1, 0.5), title = f"{player_name.replace('_', ' ').title()}")
+            ax.legend(loc='center left', bbox_to_anchor=(1, 0.5), title = f"{player_name.replace('_', ' ').title()}")
 
-        axes[i].text(0.02, 0.95, combined_text, transform=axes[i].transAxes, verticalalignment='top',
-                     bbox=dict(boxstyle='round', facecolor='white', alpha=0.5))
-
-    # Adjust layout to prevent overlap
-    plt.tight_layout()
-
-    # Save plot as png with a player-specific filename
-    full_path = f'{save_path}/{row["player_name"].replace(" ", "_")}'
-    
-    # Create the directory if it doesn't exist
-    if not os.path.exists(full_path):
-        os.makedirs(full_path)
-        
-    plt.savefig(f"{full_path}/own_league_year_by_year_ranking_.png")
+        ax.text(0.02, 0.95, combined_text, transform=ax.transAxes, verticalalignment='top',
+                bbox=dict(boxstyle='round', facecolor='white', alpha=0.5))
 
-    plt.show()
+    # One subplot per season, on one figure or streamed seasons_per_page at a time, then saved
+    return render_season_report(player_df, rank_season, draw_season, save_path, 'own_league_year_by_year_ranking_',
+                                headless, image_format, dpi, seasons_per_page, report='own_league')
 
 # def get_player_metrics(metric_grouping_information, row):
 #     '''
@@ -0,0 +1,160 @@
+'''
+Multi-core percentile ranking for large cohorts, e.g. the all leagues cohorts and the ranking cube.
+
+rank_percentiles ranks every metric column independently and every segment (cohort) independently, so the work is
+split into blocks of columns and of whole segments. A single column of a single cohort (e.g. the average_rank of an
+all leagues cohort) is split into value ranges instead, see rank_value_ranges_parallel. The metric matrix is copied once into shared memory and every
+worker ranks its block in place there, so workers receive only the shared memory names and block bounds, never a
+pickled copy of the frame, and the results need no gathering.
+'''
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+from percentile_rank_kernel_statsbomb import rank_percentiles
+
+
+# Smaller matrices are ranked in-process, starting workers would cost more than it saves
+PARALLEL_MIN_ROWS = 50_000
+
+
+def _attach_array(name, shape, dtype):
+    # NumPy view of a shared memory block, the block is returned too so it can be closed
+    block = shared_memory.SharedMemory(name=name)
+    return block, np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+
+def _rank_block(task):
+    # Worker: rank rows [row_start, row_stop) and columns [column_start, column_stop) in place
+    values_name, segments_name, shape, row_start, row_stop, column_start, column_stop = task
+
+    values_block, values = _attach_array(values_name, shape, np.float64)
+    segments_block, segment_ids = _attach_array(segments_name, shape[:1], np.int64)
+    try:
+        block = values[row_start:row_stop, column_start:column_stop]
+        block[:] = rank_percentiles(block, segment_ids[row_start:row_stop])
+    finally:
+        del values, segment_ids, block
+        values_block.close()
+        segments_block.close()
+
+
+def get_row_bounds(sorted_segment_ids, n_blocks):
+    # Row boundaries splitting segment-sorted rows into about n_blocks blocks of whole segments
+    segment_starts = np.flatnonzero(np.r_[True, sorted_segment_ids[1:] != sorted_segment_ids[:-1]])
+    target_starts = np.linspace(0, len(sorted_segment_ids), n_blocks + 1)[1:-1]
+
+    inner_bounds = segment_starts[np.clip(np.searchsorted(segment_starts, target_starts), 0, len(segment_starts) - 1)]
+    return np.unique(np.r_[0, inner_bounds[inner_bounds > 0], len(sorted_segment_ids)])
+
+
+def rank_value_ranges_parallel(values, processes):
+    '''
+    Function to rank one unsegmented column across worker processes, same output as rank_percentiles(values).
+
+    The values are split into about processes ranges at their quantiles, equal values always falling in the same
+    range, and every range is ranked as a segment of its own. A value's rank in the column is its rank within its range
+    plus the number of values in lower ranges, converted to a percentile exactly as rank_percentiles does.
+
+    Parameters:
+    values (array): 1-D array of values.
+    processes (int): Number of worker processes.
+
+    Returns:
+    percentiles (array): float64 array with the same shape as values.
+    '''
+    valid = ~np.isnan(values)
+    n_valid = int(valid.sum())
+    percentiles = np.full(len(values), 50.0)
+    if n_valid == 0:
+        return percentiles
+
+    # Range of every value (NaN values sort into the last range), then the percentiles within each range
+    range_bounds = np.unique(np.quantile(values[valid], np.linspace(0, 1, processes + 1)[1:-1]))
+    range_ids = np.searchsorted(range_bounds, values, side='right')
+    range_percentiles = rank_percentiles_parallel(values, range_ids, processes)
+
+    # Ranks within a range are multiples of 0.5, recovered exactly from the percentiles, then offset by lower ranges
+    range_counts = np.bincount(range_ids[valid], minlength=len(range_bounds) + 1)
+    range_offsets = np.concatenate(([0], np.cumsum(range_counts)[:-1]))
+    range_ranks = np.round(range_percentiles[valid] * range_counts[range_ids[valid]] / 50) / 2
+
+    percentiles[valid] = (range_ranks + range_offsets[range_ids[valid]]) / n_valid * 100
+    return percentiles
+
+
+def rank_percentiles_parallel(values, segment_ids=None, processes=None):
+    '''
+    Function to compute rank_percentiles across several worker processes, same output as rank_percentiles.
+
+    Parameters:
+    values (array): 1-D or 2-D array of metric values, one row per player and one column per metric.
+    segment_ids (array, optional): Cohort label for every row, see rank_percentiles.
+    processes (int, optional): Number of worker processes, defaults to the number of CPUs. 1, or fewer rows
+                               than PARALLEL_MIN_ROWS, ranks in-process.
+
+    Returns:
+    percentiles (array): float64 array with the same shape as values.
+    '''
+    values = np.asarray(values, dtype=np.float64)
+    processes = processes or os.cpu_count() or 1
+    if processes == 1 or len(values) < PARALLEL_MIN_ROWS:
+        return rank_percentiles(values, segment_ids)
+
+    # One column of one cohort has neither metrics nor cohorts to split by
+    if segment_ids is None and values.size == len(values):
+        percentiles = rank_value_ranges_parallel(values.reshape(-1), processes)
+        return percentiles.reshape(values.shape)
+
+    is_1d = values.ndim == 1
+    if is_1d:
+        values = values[:, np.newaxis]
+    n_rows, n_metrics = values.shape
+
+    # Rows grouped by segment, so every block of whole segments is a contiguous slice
+    if segment_ids is None:
+        order = None
+        sorted_segment_ids = np.zeros(n_rows, dtype=np.int64)
+    else:
+        _, segment_ids = np.unique(np.asarray(segment_ids), return_inverse=True)
+        order = np.argsort(segment_ids.reshape(-1), kind='stable')
+        sorted_segment_ids = segment_ids.reshape(-1)[order].astype(np.int64)
+
+    # Column blocks first (every metric is independent), then split rows so there are enough blocks for every worker
+    column_bounds = np.unique(np.linspace(0, n_metrics, min(n_metrics, processes) + 1).astype(int))
+    row_bounds = get_row_bounds(sorted_segment_ids, -(-processes // (len(column_bounds) - 1)))
+    if len(column_bounds) == 2 and len(row_bounds) == 2:
+        percentiles = rank_percentiles(values, segment_ids)
+        return percentiles[:, 0] if is_1d else percentiles
+
+    values_block = shared_memory.SharedMemory(create=True, size=values.nbytes)
+    segments_block = shared_memory.SharedMemory(create=True, size=sorted_segment_ids.nbytes)
+    try:
+        shared_values = np.ndarray(values.shape, dtype=np.float64, buffer=values_block.buf)
+        shared_values[:] = values if order is None else values[order]
+        np.ndarray(sorted_segment_ids.shape, dtype=np.int64, buffer=segments_block.buf)[:] = sorted_segment_ids
+
+        tasks = [(values_block.name, segments_block.name, values.shape, row_start, row_stop, column_start, column_stop)
+                 for row_start, row_stop in zip(row_bounds[:-1], row_bounds[1:])
+                 for column_start, column_stop in zip(column_bounds[:-1], column_bounds[1:])]
+
+        mp_context = multiprocessing.get_context('fork' if sys.platform.startswith('linux') else 'spawn')
+        with ProcessPoolExecutor(max_workers=min(processes, len(tasks)), mp_context=mp_context) as executor:
+            list(executor.map(_rank_block, tasks))
+
+        # The only copy out of shared memory, straight back into the original row order
+        percentiles = np.empty(values.shape, dtype=np.float64)
+        if order is None:
+            percentiles[:] = shared_values
+        else:
+            percentiles[order] = shared_values
+        del shared_values
+    finally:
+        values_block.close()
+        values_block.unlink()
+        segments_block.close()
+        segments_block.unlink()
+
+    return percentiles[:, 0] if is_1d else percentiles
@@ -0,0 +1,353 @@
+'''
+Ranked cohorts persisted as memory-mapped NumPy arrays, opened read-only by every process without loading them.
+
+A ranking cube is written as a directory of .npy files, rows stacked cohort by cohort with the cohorts of every
+position group next to each other:
+
+    percentiles-{i}.npy  float64 (group rows x group columns) for the i-th position group in metadata.json: its
+                         '{metric}_percentile' columns, then 'average_rank' and 'average_rank_percentile'.
+    metrics-{i}.npy      float32 or float64 (group rows x group metrics), the raw values of the group's metrics (NaN if missing).
+    row_ids.npy          int64 (rows), index label of every row in the pre-processed frame.
+    cohort_offsets.npy   int64 (cohorts + 1), cohort i is rows cohort_offsets[i]:cohort_offsets[i + 1].
+    rows-{column}.npy    (rows), every METADATA_COLUMNS column of every row. Text and categorical columns are
+                         stored as int32 codes into categories-{column}.npy (-1 for missing).
+    density_edges.npy    float64, histogram bin edges of every cohort's average_rank (see compute_cohort_density),
+                         cohort i's are density_edges[density_offsets[i]:density_offsets[i + 1]].
+    density_counts.npy   int64, bin counts aligned with density_edges, the last slot of every cohort is unused.
+    density_offsets.npy  int64 (cohorts + 1), bounds of every cohort's edges.
+    density_curves.npy   float64 (cohorts x 2 x KDE_GRIDSIZE), KDE support and density of every cohort, NaN if the
+                         cohort has no curve.
+    metadata.json        The columns and metrics of every position group, the (season_id, competition_id, position_group) key
+                         of every cohort, the dtypes of the metadata columns and PERCENTILE_MATRIX_VERSION.
+
+PercentileMatrix opens the arrays with np.load(mmap_mode='r'): nothing is read until a cohort is touched, and every
+process mapping the same files (report workers, the notebook, the service) shares one copy in the OS page cache. Every
+cohort's percentiles and metric values are one contiguous slice of its group's matrices. MappedRankingCube builds the
+cohort DataFrames from the matrix alone, with the metadata columns the reports, leaderboards and similarity search
+read and the raw metric values what-if scoring reads, and reads every cohort's histogram and KDE curve straight from
+the density files.
+'''
+import json
+import os
+import shutil
+from collections import OrderedDict
+from collections.abc import Mapping
+import numpy as np
+import pandas as pd
+from get_position_specific_metrics_statsbomb import as_metric_group_registry
+from ranking_cube_statsbomb import lookup_cohort_density
+from cohort_density_statsbomb import KDE_GRIDSIZE
+
+
+# Bump whenever the layout of the files changes, so persisted matrices are rewritten
+PERCENTILE_MATRIX_VERSION = 4
+
+RANKED_COLUMNS = ['average_rank', 'average_rank_percentile']
+
+# Cohort DataFrames a MappedRankingCube keeps built, a report or service request reads a handful at a time
+DEFAULT_COHORT_CACHE_SIZE = 32
+
+# Per-row columns kept with the percentiles, everything the report plots, leaderboards and similarity search read
+METADATA_COLUMNS = ['player_id', 'player_name', 'team_name', 'competition_id', 'competition_name', 'season_id',
+                    'season_name', 'primary_position', 'age', 'minutes']
+
+
+def get_group_columns(metric_grouping_information, position_group):
+    # Percentile columns of a position group's metrics, then the rank columns, as build_ranking_cube orders them
+    registry = as_metric_group_registry(metric_grouping_information)
+    return [f'{metric}_percentile' for metric in registry.group_to_metrics[position_group]] + RANKED_COLUMNS
+
+
+def encode_metadata_column(values):
+    # Numeric columns as NumPy arrays (float if they have missing values), others as int32 codes and categories
+    if pd.api.types.is_numeric_dtype(values.dtype) and not isinstance(values.dtype, pd.CategoricalDtype):
+        return values.to_numpy(dtype=np.float64 if values.hasnans else None, na_value=np.nan), None
+
+    categorical = values.astype('category')
+    return categorical.cat.codes.to_numpy(dtype=np.int32), np.asarray(categorical.cat.categories, dtype=str)
+
+
+def write_percentile_matrix(ranking_cube, metric_grouping_information, path):
+    '''
+    Function to persist a ranking cube's percentiles and metadata columns as a percentile matrix directory (see the
+    module docstring).
+
+    The directory is written next to path and renamed into place, so readers never see a partial matrix.
+
+    Parameters:
+    ranking_cube (dict): Ranked cohorts from build_ranking_cube.
+    metric_grouping_information (DataFrame or MetricGroupRegistry): Metrics the cube was ranked on.
+    path (str): Directory to write, replaced if it exists.
+    '''
+    # Cohorts of every position group next to each other, in cube order otherwise
+    position_groups = list(dict.fromkeys(position_group for _, _, position_group in ranking_cube))
+    cohort_keys = sorted(ranking_cube, key=lambda key: position_groups.index(key[2]))
+    group_columns = {position_group: get_group_columns(metric_grouping_information, position_group)
+                     for position_group in position_groups}
+    registry = as_metric_group_registry(metric_grouping_information)
+    group_metrics = {position_group: list(registry.group_to_metrics[position_group]) for position_group in position_groups}
+
+    cohort_offsets = np.zeros(len(cohort_keys) + 1, dtype=np.int64)
+    np.cumsum([len(ranking_cube[key]) for key in cohort_keys], out=cohort_offsets[1:])
+
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    os.makedirs(tmp_path)
+    try:
+        # Every group's matrices are filled cohort by cohort straight into their files, never held in memory as a whole
+        for group_position, position_group in enumerate(position_groups):
+            group_keys = [key for key in cohort_keys if key[2] == position_group]
+            for name, columns in [('percentiles', group_columns[position_group]), ('metrics', group_metrics[position_group])]:
+                # Metric values keep the frame's float32 when every metric has it
+                dtype = np.float32 if (ranking_cube[group_keys[0]][columns].dtypes == np.float32).all() else np.float64
+                matrix = np.lib.format.open_memmap(
+                    os.path.join(tmp_path, f'{name}-{group_position}.npy'), mode='w+', dtype=dtype,
+                    shape=(sum(len(ranking_cube[key]) for key in group_keys), len(columns)))
+
+                start = 0
+                for key in group_keys:
+                    cohort_df = ranking_cube[key]
+                    matrix[start:start + len(cohort_df)] = cohort_df[columns].to_numpy(dtype=dtype, na_value=np.nan)
+                    start += len(cohort_df)
+
+                matrix.flush()
+                del matrix
+
+        # Index labels and metadata columns of every row
+        metadata_df = pd.concat([ranking_cube[key][[column for column in METADATA_COLUMNS if column in ranking_cube[key]]]
+                                 for key in cohort_keys])
+        if not pd.api.types.is_integer_dtype(metadata_df.index):
+            raise ValueError('The percentile matrix needs integer index labels, reset the frame\'s index first')
+        np.save(os.path.join(tmp_path, 'row_ids.npy'), metadata_df.index.to_numpy(dtype=np.int64))
+
+        metadata_columns = {}
+        for column in metadata_df.columns:
+            values, categories = encode_metadata_column(metadata_df[column])
+            np.save(os.path.join(tmp_path, f'rows-{column}.npy'), values)
+            if categories is not None:
+                np.save(os.path.join(tmp_path, f'categories-{column}.npy'), categories)
+            # Text columns read back as str, as they are from the Parquet cache whatever the frame held
+            dtype = 'str' if metadata_df[column].dtype == object else str(metadata_df[column].dtype)
+            metadata_columns[column] = {'dtype': dtype, 'categorical': categories is not None}
+
+        np.save(os.path.join(tmp_path, 'cohort_offsets.npy'), cohort_offsets)
+        write_cohort_densities(ranking_cube, cohort_keys, tmp_path)
+
+        metadata = {
+            'version': PERCENTILE_MATRIX_VERSION,
+            'position_groups': group_columns,
+            'group_metrics': group_metrics,
+            'cohorts': [[int(season_id), int(competition_id), position_group]
+                        for season_id, competition_id, position_group in cohort_keys],
+            'metadata_columns': metadata_columns,
+        }
+        with open(os.path.join(tmp_path, 'metadata.json'), 'w') as f:
+            json.dump(metadata, f)
+
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+
+
+def write_cohort_densities(ranking_cube, cohort_keys, path):
+    # Histogram and KDE curve of every cohort (stored with the cube if it has them), stacked in cohort_keys order
+    densities = [lookup_cohort_density(ranking_cube, *key) for key in cohort_keys]
+
+    density_offsets = np.zeros(len(densities) + 1, dtype=np.int64)
+    np.cumsum([len(density['edges']) for density in densities], out=density_offsets[1:])
+    density_edges = np.empty(int(density_offsets[-1]), dtype=np.float64)
+    density_counts = np.zeros(int(density_offsets[-1]), dtype=np.int64)
+    density_curves = np.full((len(densities), 2, KDE_GRIDSIZE), np.nan)
+
+    for position, (start, stop, density) in enumerate(zip(density_offsets[:-1], density_offsets[1:], densities)):
+        density_edges[start:stop] = density['edges']
+        density_counts[start:stop - 1] = density['counts']
+        if density['density'] is not None:
+            density_curves[position] = density['support'], density['density']
+
+    np.save(os.path.join(path, 'density_edges.npy'), density_edges)
+    np.save(os.path.join(path, 'density_counts.npy'), density_counts)
+    np.save(os.path.join(path, 'density_offsets.npy'), density_offsets)
+    np.save(os.path.join(path, 'density_curves.npy'), density_curves)
+
+
+class PercentileMatrix:
+    '''
+    Read-only view of a percentile matrix directory written by write_percentile_matrix. Opening it only reads
+    metadata.json, the arrays are memory-mapped and paged in as cohorts are read.
+
+    Pickling (e.g. to a spawned worker) sends the path only, the worker maps the same files.
+
+    Holds the following:
+    group_percentiles: position_group -> read-only memmap (group rows x group columns)
+    group_columns: position_group -> column names of its matrix
+    group_metric_values: position_group -> read-only memmap (group rows x group metrics) of raw metric values
+    group_metrics: position_group -> its metrics
+    group_starts: position_group -> first row of the group
+    row_ids: read-only memmap (rows), index label of every row
+    cohort_offsets: read-only memmap (cohorts + 1), row bounds of every cohort
+    cohort_keys: (season_id, competition_id, position_group) of every cohort, in row order
+    metadata_values, metadata_categories: column -> read-only memmap of a metadata column, and of its categories
+    density_edges, density_counts, density_offsets, density_curves: read-only memmaps of the cohort densities
+    '''
+
+    def __init__(self, path):
+        self.path = path
+
+        with open(os.path.join(path, 'metadata.json')) as f:
+            metadata = json.load(f)
+        if metadata['version'] != PERCENTILE_MATRIX_VERSION:
+            raise ValueError(f'{path} is a version {metadata["version"]} percentile matrix, '
+                             f'expected version {PERCENTILE_MATRIX_VERSION}')
+
+        self.group_columns = metadata['position_groups']
+        self.group_percentiles = {position_group: self.load_array(f'percentiles-{group_position}')
+                                  for group_position, position_group in enumerate(self.group_columns)}
+        self.group_metrics = metadata['group_metrics']
+        self.group_metric_values = {position_group: self.load_array(f'metrics-{group_position}')
+                                    for group_position, position_group in enumerate(self.group_columns)}
+        self.row_ids = self.load_array('row_ids')
+        self.cohort_offsets = self.load_array('cohort_offsets')
+
+        self.cohort_keys = [tuple(key) for key in metadata['cohorts']]
+        self.cohort_positions = {key: position for position, key in enumerate(self.cohort_keys)}
+        self.group_starts = {}
+        for position, (_, _, position_group) in enumerate(self.cohort_keys):
+            self.group_starts.setdefault(position_group, int(self.cohort_offsets[position]))
+
+        self.metadata_columns = metadata['metadata_columns']
+        self.metadata_values = {column: self.load_array(f'rows-{column}') for column in self.metadata_columns}
+        self.metadata_categories = {column: self.load_array(f'categories-{column}')
+                                    for column, column_info in self.metadata_columns.items() if column_info['categorical']}
+
+        for name in ['density_edges', 'density_counts', 'density_offsets', 'density_curves']:
+            setattr(self, name, self.load_array(name))
+
+    def __reduce__(self):
+        return PercentileMatrix, (self.path,)
+
+    def __len__(self):
+        return len(self.cohort_keys)
+
+    def __contains__(self, key):
+        return key in self.cohort_positions
+
+    def load_array(self, name):
+        return np.load(os.path.join(self.path, f'{name}.npy'), mmap_mode='r')
+
+    def get_cohort_bounds(self, season_id, competition_id, position_group):
+        # Row bounds of a cohort, KeyError if it was not ranked
+        position = self.cohort_positions[(season_id, competition_id, position_group)]
+        return int(self.cohort_offsets[position]), int(self.cohort_offsets[position + 1])
+
+    def get_cohort_percentiles(self, season_id, competition_id, position_group, columns=None):
+        '''
+        Function to read a cohort's percentiles.
+
+        Parameters:
+        season_id, competition_id, position_group: Cohort key, as in the ranking cube.
+        columns (list, optional): Columns of the group's matrix to read, defaults to all of them.
+
+        Returns:
+        row_ids (array): Index label of every row of the cohort, a zero-copy read-only view.
+        percentiles (array): The cohort's rows of its group's matrix, a zero-copy read-only view. Picking columns
+                             copies them out (NumPy fancy indexing).
+        '''
+        start, stop = self.get_cohort_bounds(season_id, competition_id, position_group)
+        group_start = self.group_starts[position_group]
+        percentiles = self.group_percentiles[position_group][start - group_start:stop - group_start]
+        if columns is not None:
+            percentiles = percentiles[:, [self.group_columns[position_group].index(column) for column in columns]]
+
+        return self.row_ids[start:stop], percentiles
+
+    def get_cohort_metric_values(self, season_id, competition_id, position_group):
+        # A cohort's raw values of its group's metrics, a zero-copy read-only view
+        start, stop = self.get_cohort_bounds(season_id, competition_id, position_group)
+        group_start = self.group_starts[position_group]
+        return self.group_metric_values[position_group][start - group_start:stop - group_start]
+
+    def get_cohort_metadata(self, season_id, competition_id, position_group):
+        # A cohort's metadata columns in their original dtypes, indexed by row label
+        start, stop = self.get_cohort_bounds(season_id, competition_id, position_group)
+        index = pd.Index(self.row_ids[start:stop], dtype=np.int64)
+
+        columns = {}
+        for column, column_info in self.metadata_columns.items():
+            values = self.metadata_values[column][start:stop]
+            if column_info['categorical']:
+                values = pd.Categorical.from_codes(values, self.metadata_categories[column])
+            columns[column] = pd.Series(values, index=index).astype(column_info['dtype'])
+
+        return pd.DataFrame(columns, index=index)
+
+    def get_cohort_density(self, season_id, competition_id, position_group):
+        # A cohort's histogram and KDE curve as compute_cohort_density returns them, as read-only views of the files
+        position = self.cohort_positions[(season_id, competition_id, position_group)]
+        start, stop = int(self.density_offsets[position]), int(self.density_offsets[position + 1])
+        support, density = self.density_curves[position]
+        has_curve = not np.isnan(support[0])
+
+        return {'edges': self.density_edges[start:stop], 'counts': self.density_counts[start:stop - 1],
+                'support': support if has_curve else None, 'density': density if has_curve else None}
+
+
+class MappedRankingCube(Mapping):
+    '''
+    Ranking cube backed by a PercentileMatrix alone, for lookup_cohort, lookup_cohort_density, LeaderboardIndex,
+    PlayerSimilarityIndex, build_cohort_scorer and the report plots. Cohort DataFrames are built on access, the
+    cache_size most recently used are kept so the cube never holds more than a few cohorts in memory. A cohort has the index labels, METADATA_COLUMNS, the raw values of its group's metrics, the percentile
+    and rank columns of build_ranking_cube's. Other columns of the pre-processed frame (e.g. other groups' metrics)
+    are not stored, look them up in df by index label.
+
+    Pickling sends the matrix path only, built cohorts are rebuilt from the shared files by whoever unpickles it.
+    '''
+
+    def __init__(self, percentile_matrix, cache_size=DEFAULT_COHORT_CACHE_SIZE):
+        self.percentile_matrix = percentile_matrix
+        self.cache_size = cache_size
+        self.cohorts = OrderedDict()
+
+    def __reduce__(self):
+        return MappedRankingCube, (self.percentile_matrix, self.cache_size)
+
+    def __getitem__(self, key):
+        # Least recently used cohorts are dropped once cache_size are kept
+        if key in self.cohorts:
+            self.cohorts.move_to_end(key)
+            return self.cohorts[key]
+
+        cohort_df = self.build_cohort(*key)
+        if self.cache_size > 0:
+            self.cohorts[key] = cohort_df
+            if len(self.cohorts) > self.cache_size:
+                self.cohorts.popitem(last=False)
+
+        return cohort_df
+
+    def __iter__(self):
+        return iter(self.percentile_matrix.cohort_keys)
+
+    def __len__(self):
+        return len(self.percentile_matrix)
+
+    def __contains__(self, key):
+        return key in self.percentile_matrix
+
+    def get_cohort_density(self, season_id, competition_id, position_group):
+        # Histogram and KDE curve of a cohort's average_rank, stored with the matrix
+        return self.percentile_matrix.get_cohort_density(season_id, competition_id, position_group)
+
+    def build_cohort(self, season_id, competition_id, position_group):
+        # The cohort's metadata columns, its metric values, then its percentile and rank columns as views of the group's matrices
+        cohort_df = self.percentile_matrix.get_cohort_metadata(season_id, competition_id, position_group)
+        metric_values = self.percentile_matrix.get_cohort_metric_values(season_id, competition_id, position_group)
+        metric_df = pd.DataFrame(metric_values, index=cohort_df.index,
+                                 columns=self.percentile_matrix.group_metrics[position_group], copy=False)
+        _, percentiles = self.percentile_matrix.get_cohort_percentiles(season_id, competition_id, position_group)
+        percentile_df = pd.DataFrame(percentiles, index=cohort_df.index,
+                                     columns=self.percentile_matrix.group_columns[position_group], copy=False)
+
+        return pd.concat([cohort_df, metric_df, percentile_df], axis=1)
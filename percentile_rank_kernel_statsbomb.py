@@ -0,0 +1,76 @@
+import numpy as np
+
+
+def rank_percentiles(values, segment_ids=None):
+    '''
+    Function to convert a matrix of metric values to percentiles (ranking) in one vectorized call.
+
+    Every column is ranked independently within each segment (cohort), ties get their average rank and NaN
+    values are left out of the ranking and given 50, exactly as the per-metric rankdata loop does:
+    rankdata(non_nan_values, method='average') / len(non_nan_values) * 100
+
+    Parameters:
+    values (array): 1-D or 2-D array of metric values, one row per player and one column per metric.
+    segment_ids (array, optional): Cohort label for every row, rows sharing a label are ranked together.
+                                   Rows do not need to be grouped by label. Defaults to a single cohort.
+
+    Returns:
+    percentiles (array): float64 array with the same shape as values.
+    '''
+    values = np.asarray(values, dtype=np.float64)
+    is_1d = values.ndim == 1
+    if is_1d:
+        values = values[:, np.newaxis]
+
+    n_rows, n_metrics = values.shape
+    if n_rows == 0:
+        percentiles = np.empty(values.shape, dtype=np.float64)
+        return percentiles[:, 0] if is_1d else percentiles
+
+    # Relabel segments as 0..n_segments-1
+    if segment_ids is None:
+        segment_ids = np.zeros(n_rows, dtype=np.intp)
+        n_segments = 1
+    else:
+        uniques, segment_ids = np.unique(np.asarray(segment_ids), return_inverse=True)
+        segment_ids = segment_ids.reshape(-1)
+        n_segments = len(uniques)
+
+    # Sort every column by segment then value, NaN values sort to the end of their segment
+    segment_matrix = np.broadcast_to(segment_ids[:, np.newaxis], values.shape)
+    order = np.lexsort((values, segment_matrix), axis=0)
+    sorted_values = np.take_along_axis(values, order, axis=0)
+    sorted_segments = segment_ids[order]
+
+    # First sorted position of every segment (the same for every column)
+    segment_sizes = np.bincount(segment_ids, minlength=n_segments)
+    segment_starts = np.concatenate(([0], np.cumsum(segment_sizes)[:-1]))[sorted_segments]
+
+    # Mark the first and last position of every run of tied values
+    positions = np.broadcast_to(np.arange(n_rows)[:, np.newaxis], values.shape)
+    run_starts_mask = np.ones(values.shape, dtype=bool)
+    run_starts_mask[1:] = (sorted_segments[1:] != sorted_segments[:-1]) | (sorted_values[1:] != sorted_values[:-1])
+    run_ends_mask = np.ones(values.shape, dtype=bool)
+    run_ends_mask[:-1] = run_starts_mask[1:]
+
+    run_starts = np.maximum.accumulate(np.where(run_starts_mask, positions, 0), axis=0)
+    run_ends = np.minimum.accumulate(np.where(run_ends_mask, positions, n_rows)[::-1], axis=0)[::-1]
+
+    # Average rank of each tie run, 1-based within the segment
+    ranks = ((run_starts - segment_starts) + (run_ends - segment_starts) + 2) / 2
+
+    # Number of non-NaN values per segment and column
+    valid = ~np.isnan(values)
+    flat_labels = segment_ids[:, np.newaxis] * n_metrics + np.arange(n_metrics)
+    counts = np.bincount(flat_labels[valid], minlength=n_segments * n_metrics).reshape(n_segments, n_metrics)
+    sorted_counts = counts[sorted_segments, np.arange(n_metrics)]
+
+    # Convert to percentage, with 50 given to those who didnt record anything
+    sorted_valid = ~np.isnan(sorted_values)
+    sorted_percentiles = np.full(values.shape, 50.0)
+    sorted_percentiles[sorted_valid] = ranks[sorted_valid] / sorted_counts[sorted_valid] * 100
+
+    percentiles = np.empty(values.shape, dtype=np.float64)
+    np.put_along_axis(percentiles, order, sorted_percentiles, axis=0)
+
+    return percentiles[:, 0] if is_1d else percentiles
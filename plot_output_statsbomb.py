@@ -0,0 +1,216 @@
+import os
+from contextlib import contextmanager
+import numpy as np
+import matplotlib.pyplot as plt
+from matplotlib.backends.backend_pdf import PdfPages
+from instrumentation_statsbomb import record_stage
+
+
+# Height of every season's subplot, in inches
+SEASON_HEIGHT = 4.5
+
+
+# Whether headless reports are being rendered in the caller's own process, see rendering_in_process
+_rendering_state = {'in_process': False}
+
+
+def use_headless_backend():
+    # Switch to the non-interactive Agg backend, switching closes all open figures so only do it when needed, and
+    # never inside rendering_in_process where the caller's backend and figures are kept
+    if _rendering_state['in_process']:
+        return
+
+    if plt.get_backend().lower() != 'agg':
+        plt.switch_backend('Agg')
+
+
+@contextmanager
+def rendering_in_process():
+    '''
+    Render headless reports in the caller's process (e.g. a notebook) without switching its backend, which would
+    close every figure the caller has open and leave it on Agg.
+
+    Interactive mode is off inside the block so GUI backends open no window, and headless reports close their
+    figures once saved, so nothing is shown.
+    '''
+    in_process = _rendering_state['in_process']
+    _rendering_state['in_process'] = True
+    try:
+        with plt.ioff():
+            yield
+    finally:
+        _rendering_state['in_process'] = in_process
+
+
+@contextmanager
+def closing_new_figures():
+    # Close every figure opened inside the block (e.g. by a report that failed part way), the caller's stay open
+    open_figures = set(plt.get_fignums())
+    try:
+        yield
+    finally:
+        for number in set(plt.get_fignums()) - open_figures:
+            plt.close(number)
+
+
+def get_player_directory(save_path, player_name):
+    # Player-specific output folder, created if it doesn't exist
+    full_path = f'{save_path}/{player_name.replace(" ", "_")}'
+    os.makedirs(full_path, exist_ok=True)
+
+    return full_path
+
+
+def save_report_figure(fig, save_path, player_name, file_stem, headless=False, image_format='png', dpi=None):
+    '''
+    Function to save a report figure to a player-specific folder, then show it or close it.
+
+    Parameters:
+    fig (Figure): The report figure.
+    save_path (str): Output directory, a sub-folder is created per player.
+    player_name (str): Player name, spaces are replaced by underscores for the folder name.
+    file_stem (str): File name without extension.
+    headless (bool): Close the figure instead of calling plt.show(), so batch and server runs never block on a
+                     GUI event loop and memory does not grow with every report.
+    image_format (str): Any format supported by savefig, e.g. 'png', 'pdf' or 'svg'.
+    dpi (float, optional): Resolution of raster formats, defaults to matplotlib's savefig.dpi.
+
+    Returns:
+    file_path (str): Path of the saved image.
+    '''
+    file_path = f"{get_player_directory(save_path, player_name)}/{file_stem}.{image_format}"
+    with record_stage('savefig', image_format=image_format):
+        fig.savefig(file_path, format=image_format, dpi=dpi)
+
+    if headless:
+        plt.close(fig)
+    else:
+        plt.show()
+
+    return file_path
+
+
+class ReportPageWriter:
+    '''
+    Writes a report page by page as each page is drawn, closing every page figure once it is written.
+
+    PDF reports are appended to one multi-page PDF ({file_stem}.pdf), other formats are written as numbered files
+    ({file_stem}page_01.png, {file_stem}page_02.png, ...) in the player's folder.
+
+    Holds the following:
+    file_paths: paths written so far (the PDF once, or every numbered page)
+    '''
+
+    def __init__(self, save_path, player_name, file_stem, image_format='png', dpi=None):
+        self.directory = get_player_directory(save_path, player_name)
+        self.file_stem = file_stem
+        self.image_format = image_format
+        self.dpi = dpi
+        self.pdf_pages = None
+        self.page_count = 0
+        self.file_paths = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def save_page(self, fig):
+        self.page_count += 1
+        with record_stage('savefig', image_format=self.image_format, page=self.page_count):
+            if self.image_format == 'pdf':
+                if self.pdf_pages is None:
+                    self.file_paths.append(f'{self.directory}/{self.file_stem}.pdf')
+                    self.pdf_pages = PdfPages(self.file_paths[0])
+                self.pdf_pages.savefig(fig, dpi=self.dpi)
+            else:
+                file_path = f'{self.directory}/{self.file_stem}page_{self.page_count:02d}.{self.image_format}'
+                fig.savefig(file_path, format=self.image_format, dpi=self.dpi)
+                self.file_paths.append(file_path)
+
+        plt.close(fig)
+
+    def close(self):
+        # Finish the PDF, pages written so far stay valid if drawing failed part way
+        if self.pdf_pages is not None:
+            self.pdf_pages.close()
+            self.pdf_pages = None
+
+
+def create_season_axes(n_seasons):
+    # One subplot per season stacked vertically, axes is always iterable
+    fig, axes = plt.subplots(n_seasons, 1, figsize=(8, SEASON_HEIGHT * n_seasons))  # Increased figure size for annotations
+    if not isinstance(axes, np.ndarray):  # If only one subplot, wrap in a list
+        axes = [axes]
+
+    return fig, axes
+
+
+def draw_season_page(page_df, rank_season, draw_season, **figure_tags):
+    '''
+    Function to draw one figure with a subplot per season of page_df.
+
+    Every season is ranked (rank_season) just before it is drawn, so only one season's cohort is held at a time,
+    and only the figure work (creating the axes, drawing every season, the layout) is recorded as the
+    figure_construction stage. The figure is closed if drawing fails.
+    '''
+    with record_stage('figure_construction', step='axes', subplots=len(page_df), **figure_tags):
+        fig, axes = create_season_axes(len(page_df))
+
+    try:
+        for ax, (index, row) in zip(axes, page_df.iterrows()):
+            season = rank_season(index, row)
+            with record_stage('figure_construction', step='season', season_name=row['season_name'], **figure_tags):
+                draw_season(ax, index, row, season)
+
+        # Adjust layout to prevent overlap
+        with record_stage('figure_construction', step='layout', **figure_tags):
+            plt.tight_layout()
+    except BaseException:
+        plt.close(fig)
+        raise
+
+    return fig
+
+
+def render_season_report(player_df, rank_season, draw_season, save_path, file_stem, headless=False, image_format='png',
+                         dpi=None, seasons_per_page=None, report=None):
+    '''
+    Function to draw a report with one subplot per season of player_df and save it.
+
+    By default every season goes on one figure, saved with save_report_figure. With seasons_per_page, seasons are
+    drawn that many at a time and every page is written (see ReportPageWriter) and closed before the next one is
+    drawn, so memory stays bounded however many seasons a career has. Pages are never shown, even when not headless.
+
+    Parameters:
+    player_df (DataFrame): The player's seasons, one subplot per row in row order.
+    rank_season (function): Called as rank_season(index, row) to rank one season, returns what draw_season needs.
+    draw_season (function): Called as draw_season(ax, index, row, season) with rank_season's result to draw one
+                            season on its axes.
+    save_path, file_stem, headless, image_format, dpi: See save_report_figure.
+    seasons_per_page (int, optional): Seasons per page, None for a single figure.
+    report (str, optional): Report name, tagged on the figure_construction stages (instrumentation only).
+
+    Returns:
+    file_paths (list): Paths of the saved images.
+    '''
+    player_name = player_df['player_name'].iloc[-1]
+    figure_tags = dict(report=report, player_id=player_df['player_id'].iloc[0])
+
+    if seasons_per_page is None:
+        fig = draw_season_page(player_df, rank_season, draw_season, **figure_tags)
+
+        # Save plot with a player-specific filename, then show it (or close it when headless)
+        return [save_report_figure(fig, save_path, player_name, file_stem, headless, image_format, dpi)]
+
+    if seasons_per_page < 1:
+        raise ValueError(f'seasons_per_page must be at least 1, got {seasons_per_page}')
+
+    with ReportPageWriter(save_path, player_name, file_stem, image_format, dpi) as page_writer:
+        for start in range(0, len(player_df), seasons_per_page):
+            page_df = player_df.iloc[start:start + seasons_per_page]
+            page_writer.save_page(draw_season_page(page_df, rank_season, draw_season, page=page_writer.page_count + 1,
+                                                   **figure_tags))
+
+    return page_writer.file_paths
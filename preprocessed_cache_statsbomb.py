@@ -0,0 +1,179 @@
+import glob
+import hashlib
+import os
+import shutil
+import pandas as pd
+from aggregate_rank_preprocessing_statsbomb import preprocess_df, PREPROCESSING_VERSION
+from load_season_stats_statsbomb import read_player_season_stats
+from remove_duplicate_rows_statsbomb import remove_duplicate_rows
+from get_position_specific_metrics_statsbomb import as_metric_group_registry
+from ranking_cube_statsbomb import (build_ranking_cube, ranking_cube_to_frame, ranking_cube_from_frame,
+                                    RANKING_CUBE_VERSION)
+from percentile_matrix_statsbomb import (write_percentile_matrix, PercentileMatrix, MappedRankingCube,
+                                        PERCENTILE_MATRIX_VERSION)
+from instrumentation_statsbomb import instrument_stage
+
+
+def get_cache_key(csv_path, hash_contents=False):
+    '''
+    Function to build the cache key for a raw season stats export.
+
+    The key combines the file's size and modification time (or a hash of its contents if hash_contents is True,
+    e.g. when OneDrive re-syncs touch the mtime without changing the data) with PREPROCESSING_VERSION.
+    '''
+    stat = os.stat(csv_path)
+
+    if hash_contents:
+        file_hash = hashlib.sha1()
+        with open(csv_path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                file_hash.update(block)
+        source_key = file_hash.hexdigest()
+    else:
+        source_key = f'{stat.st_size}-{stat.st_mtime_ns}'
+
+    return hashlib.sha1(f'{source_key}-v{PREPROCESSING_VERSION}'.encode()).hexdigest()[:16]
+
+
+@instrument_stage
+def load_preprocessed_season_stats(csv_path, cache_dir=None, hash_contents=False, metric_grouping_information=None):
+    '''
+    Function to load the pre-processed, de-duplicated season stats, using a Parquet cache where possible.
+
+    On a cold start the CSV is read and run through preprocess_df and remove_duplicate_rows, and the result is
+    written to cache_dir. Warm starts read the cached Parquet file directly, skipping CSV parsing and string
+    normalisation. Older cache files for the same CSV are removed when a new one is written.
+
+    Parameters:
+    csv_path (str): Path to player_season_stats.csv.
+    cache_dir (str, optional): Directory for cache files, defaults to a '.cache' folder next to the CSV.
+    hash_contents (bool): Key the cache on a hash of the file contents rather than its size and mtime.
+    metric_grouping_information (DataFrame or MetricGroupRegistry, optional): Only read the metrics these groups
+                                                                              use, the cache is keyed on them too.
+                                                                              Defaults to every column.
+
+    Returns:
+    df (DataFrame): The pre-processed, de-duplicated season stats.
+    '''
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(csv_path)), '.cache')
+
+    stem = os.path.splitext(os.path.basename(csv_path))[0]
+    cache_key = get_cache_key(csv_path, hash_contents)
+    if metric_grouping_information is not None:
+        cache_key = hashlib.sha1(f'{cache_key}-{get_metric_groups_key(metric_grouping_information)}'.encode()).hexdigest()[:16]
+    cache_path = os.path.join(cache_dir, f'{stem}-{cache_key}.parquet')
+
+    # Warm start
+    if os.path.exists(cache_path):
+        return pd.read_parquet(cache_path)
+
+    # Cold start: parse and clean the raw export
+    df = read_player_season_stats(csv_path, metric_grouping_information)
+    df = preprocess_df(df)
+    df = remove_duplicate_rows(df)
+
+    write_cache_file(df, cache_dir, stem, cache_path)
+
+    return df
+
+
+def write_cache_file(df, cache_dir, stem, cache_path):
+    # Remove stale caches with the same stem, then write atomically so a crashed run never leaves a partial file
+    os.makedirs(cache_dir, exist_ok=True)
+    for stale_path in glob.glob(os.path.join(cache_dir, f'{glob.escape(stem)}-{"[0-9a-f]" * 16}.parquet')):
+        os.remove(stale_path)
+
+    tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+    df.to_parquet(tmp_path)
+    os.replace(tmp_path, cache_path)
+
+
+def get_metric_groups_key(metric_grouping_information):
+    # Hash of the position groups, their positions and metrics, so editing the metric groups re-ranks the cache
+    registry = as_metric_group_registry(metric_grouping_information)
+    groups = [(group, registry.group_to_positions[group], registry.group_to_metrics[group])
+              for group in registry.group_to_positions]
+
+    return hashlib.sha1(repr(groups).encode()).hexdigest()[:16]
+
+
+def get_ranking_cube_key(csv_path, metric_grouping_information, hash_contents=False):
+    # Cache key of everything ranked from the export: the source file, the metric groups and RANKING_CUBE_VERSION
+    return hashlib.sha1(f'{get_cache_key(csv_path, hash_contents)}-{get_metric_groups_key(metric_grouping_information)}'
+                        f'-v{RANKING_CUBE_VERSION}'.encode()).hexdigest()[:16]
+
+
+@instrument_stage
+def load_ranked_season_stats(csv_path, metric_grouping_information, cache_dir=None, hash_contents=False, processes=1):
+    '''
+    Function to load the pre-processed season stats together with their ranking cube, using Parquet caches.
+
+    The ranking cube (build_ranking_cube) is cached next to the pre-processed frame, keyed on the same source
+    file plus the metric groups and RANKING_CUBE_VERSION. Warm starts neither parse the CSV nor re-rank.
+
+    Parameters:
+    csv_path (str): Path to player_season_stats.csv.
+    metric_grouping_information (DataFrame or MetricGroupRegistry): Metrics for grouping players.
+    cache_dir (str, optional): Directory for cache files, defaults to a '.cache' folder next to the CSV.
+    hash_contents (bool): Key the caches on a hash of the file contents rather than its size and mtime.
+    processes (int, optional): Worker processes for ranking on a cold start, see build_ranking_cube.
+
+    Returns:
+    df (DataFrame): The pre-processed, de-duplicated season stats.
+    ranking_cube (dict): Ranked cohorts keyed by (season_id, competition_id, position_group).
+    '''
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(csv_path)), '.cache')
+
+    df = load_preprocessed_season_stats(csv_path, cache_dir, hash_contents, metric_grouping_information)
+
+    stem = f'{os.path.splitext(os.path.basename(csv_path))[0]}-ranking_cube'
+    cube_key = get_ranking_cube_key(csv_path, metric_grouping_information, hash_contents)
+    cache_path = os.path.join(cache_dir, f'{stem}-{cube_key}.parquet')
+
+    # Warm start
+    if os.path.exists(cache_path):
+        return df, ranking_cube_from_frame(pd.read_parquet(cache_path), metric_grouping_information)
+
+    # Cold start: rank every cohort once
+    ranking_cube = build_ranking_cube(df, metric_grouping_information, processes)
+    write_cache_file(ranking_cube_to_frame(ranking_cube), cache_dir, stem, cache_path)
+
+    return df, ranking_cube
+
+
+@instrument_stage
+def load_mapped_season_stats(csv_path, metric_grouping_information, cache_dir=None, hash_contents=False, processes=1):
+    '''
+    Function to load the pre-processed season stats together with a ranking cube backed by a memory-mapped
+    percentile matrix (see percentile_matrix_statsbomb).
+
+    Same inputs as load_ranked_season_stats, but a warm start only reads the pre-processed Parquet file and maps the
+    matrix read-only, the ranked cohorts are never read from disk as a whole. On a cold start the cohorts are ranked
+    and written straight to the matrix directory (no ranking cube Parquet file), which is shared by every process
+    that opens it. The cube needs neither df nor the metric groups once written, so it pickles as the matrix path.
+
+    Returns:
+    df (DataFrame): The pre-processed, de-duplicated season stats.
+    ranking_cube (MappedRankingCube): Ranked cohorts keyed by (season_id, competition_id, position_group), with
+                                      the metadata, metric, percentile and rank columns (see MappedRankingCube).
+    '''
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(csv_path)), '.cache')
+
+    stem = f'{os.path.splitext(os.path.basename(csv_path))[0]}-percentile_matrix'
+    cube_key = get_ranking_cube_key(csv_path, metric_grouping_information, hash_contents)
+    matrix_key = hashlib.sha1(f'{cube_key}-v{PERCENTILE_MATRIX_VERSION}'.encode()).hexdigest()[:16]
+    matrix_path = os.path.join(cache_dir, f'{stem}-{matrix_key}')
+
+    df = load_preprocessed_season_stats(csv_path, cache_dir, hash_contents, metric_grouping_information)
+
+    # Cold start: rank every cohort once and write the matrix, replacing stale ones
+    if not os.path.exists(matrix_path):
+        ranking_cube = build_ranking_cube(df, metric_grouping_information, processes)
+        for stale_path in glob.glob(os.path.join(cache_dir, f'{glob.escape(stem)}-{"[0-9a-f]" * 16}')):
+            shutil.rmtree(stale_path, ignore_errors=True)
+        write_percentile_matrix(ranking_cube, metric_grouping_information, matrix_path)
+
+    return df, MappedRankingCube(PercentileMatrix(matrix_path))
@@ -0,0 +1,371 @@
+'''
+Approximate percentiles for all leagues and multi-season pools from mergeable KLL quantile sketches.
+
+Exact ranking (calculate_percentiles_all) needs every row of the pool in memory and re-ranks all of them whenever a
+row changes. A PercentileSketchIndex instead keeps one small KLL sketch per metric per (season, competition,
+position group) cohort. Sketches of any set of leagues and seasons merge into a sketch of the pool, and the
+percentiles of any rows are read off that sketch without touching the pool's raw rows. The index can be updated
+chunk by chunk, so histories larger than memory can be sketched:
+
+    sketches = PercentileSketchIndex(metric_grouping_information)
+    for chunk in pd.read_csv('player_season_stats.csv', chunksize=100_000):
+        sketches.update(preprocess_df(chunk))
+    ranking_df = sketches.calculate_percentiles(player_df, 'winger', season_ids=[235, 281, 317])
+
+Every metric percentile comes with an error bound in percentile points, which holds with the requested confidence.
+
+average_rank_percentile needs the average_rank of every row of the pool, which the metric sketches cannot give, so
+every cohort also keeps a uniform sample of k of its rows (the rows with the k lowest random priorities, which merges
+into a uniform sample of any pool). The sampled rows' average_rank is estimated from the pool's metric sketches and
+rows are ranked against it. Its error is the sampling error (Dvoretzky-Kiefer-Wolfowitz, holding with the requested
+confidence) plus the share of sampled rows whose average_rank is close enough to the row's (within twice
+average_rank_error) that the metric errors could reorder them, an estimate rather than a guarantee.
+
+Pools small enough to never be compacted or sampled (k rows or fewer) are ranked exactly, with the same percentiles
+and average-rank percentiles as calculate_percentiles_all.
+'''
+import math
+import numpy as np
+import pandas as pd
+from get_position_specific_metrics_statsbomb import as_metric_group_registry
+from ranking_cube_statsbomb import COHORT_KEYS
+
+
+# Items kept by the top level of every sketch, the rank error shrinks roughly as 1 / k
+DEFAULT_SKETCH_SIZE = 200
+
+# Capacity of each level relative to the level above it
+LEVEL_CAPACITY_RATIO = 2 / 3
+
+
+class KLLSketch:
+    '''
+    KLL quantile sketch of a stream of values (Karnin, Lang and Liberty, 2016), NaN values are left out.
+
+    Level h holds sorted-then-halved samples that each stand for 2^h values. Every compaction of level h moves
+    every other item (from a random offset) up a level, which shifts any rank by 0 or +-2^h with zero mean, so the
+    sketch tracks the sum of squared compaction weights and bounds the rank error with Hoeffding's inequality.
+    Merging sketches adds their levels, counts and error terms.
+    '''
+
+    def __init__(self, k=DEFAULT_SKETCH_SIZE, seed=None):
+        self.k = k
+        self.rng = np.random.default_rng(seed)
+        self.levels = [np.empty(0, dtype=np.float64)]
+        self.n = 0
+        self.error_variance = 0.0
+        self.sorted_items = None
+
+    def get_capacity(self, level):
+        return max(2, int(math.ceil(self.k * LEVEL_CAPACITY_RATIO ** (len(self.levels) - 1 - level))))
+
+    def compress(self):
+        # Compact over-full levels from the bottom up, a compacted level keeps at most one item
+        level = 0
+        while level < len(self.levels):
+            items = self.levels[level]
+            if len(items) <= self.get_capacity(level):
+                level += 1
+                continue
+
+            if level + 1 == len(self.levels):
+                self.levels.append(np.empty(0, dtype=np.float64))
+
+            # An odd item out stays at this level, the rest are halved
+            items = np.sort(items)
+            n_compacted = len(items) - len(items) % 2
+            promoted = items[self.rng.integers(2):n_compacted:2]
+
+            self.levels[level] = items[n_compacted:]
+            self.levels[level + 1] = np.concatenate([self.levels[level + 1], promoted])
+            self.error_variance += float(2 ** level) ** 2
+
+        self.sorted_items = None
+
+    def update(self, values):
+        '''
+        Add values (any array-like, NaN values are ignored) to the sketch.
+        '''
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[~np.isnan(values)]
+        if not len(values):
+            return self
+
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self.n += len(values)
+        self.compress()
+
+        return self
+
+    def merge(self, other):
+        '''
+        Add every value summarized by another sketch to this one.
+        '''
+        for level, items in enumerate(other.levels):
+            if level == len(self.levels):
+                self.levels.append(np.empty(0, dtype=np.float64))
+            self.levels[level] = np.concatenate([self.levels[level], items])
+
+        self.n += other.n
+        self.error_variance += other.error_variance
+        self.compress()
+
+        return self
+
+    def copy(self):
+        sketch = KLLSketch(self.k)
+        sketch.rng = np.random.default_rng(self.rng.integers(2 ** 63))
+        sketch.levels = [items.copy() for items in self.levels]
+        sketch.n = self.n
+        sketch.error_variance = self.error_variance
+
+        return sketch
+
+    def get_sorted_items(self):
+        # Every item with its weight, sorted by value, and the cumulative weights
+        if self.sorted_items is None:
+            items = np.concatenate(self.levels)
+            weights = np.concatenate([np.full(len(level_items), 2 ** level, dtype=np.float64)
+                                      for level, level_items in enumerate(self.levels)])
+            order = np.argsort(items, kind='stable')
+            self.sorted_items = items[order], np.concatenate([[0.0], np.cumsum(weights[order])])
+
+        return self.sorted_items
+
+    def get_ranks(self, values):
+        '''
+        Function to estimate the average rank (1-based, ties share their average rank) values would have among the
+        sketched values, i.e. the count of smaller values plus half of the equal values and one.
+        '''
+        items, cumulative_weights = self.get_sorted_items()
+        values = np.asarray(values, dtype=np.float64)
+
+        below = cumulative_weights[np.searchsorted(items, values, side='left')]
+        at_or_below = cumulative_weights[np.searchsorted(items, values, side='right')]
+
+        return (below + at_or_below + 1) / 2
+
+    def get_rank_error(self, confidence=0.99):
+        '''
+        Bound on the absolute rank error of any single estimate, holding with probability confidence.
+        '''
+        if self.error_variance == 0:
+            return 0.0
+
+        return math.sqrt(2 * self.error_variance * math.log(2 / (1 - confidence)))
+
+    def get_percentiles(self, values, confidence=0.99):
+        '''
+        Function to estimate the percentiles (rank / count * 100, as rank_percentiles) of values among the sketched
+        values. NaN values get 50, as in the exact ranking.
+
+        Returns:
+        percentiles (array): Estimated percentiles.
+        error (float): Bound on the error of every estimate, in percentile points.
+        '''
+        values = np.asarray(values, dtype=np.float64)
+        if self.n == 0:
+            return np.full(values.shape, 50.0), 0.0
+
+        percentiles = np.where(np.isnan(values), 50.0, self.get_ranks(values) / self.n * 100)
+        return percentiles, min(self.get_rank_error(confidence) / self.n * 100, 100.0)
+
+
+def keep_lowest_priorities(priorities, values, k):
+    # The k rows with the lowest priorities, a uniform sample of k rows when the priorities are uniform random
+    if len(priorities) <= k:
+        return priorities, values
+
+    kept = np.argpartition(priorities, k - 1)[:k]
+    return priorities[kept], values[kept]
+
+
+def get_average_ranks(percentiles):
+    # Mean of every row's metric percentiles, computed exactly as the exact ranking's DataFrame.mean(axis=1)
+    return pd.DataFrame(percentiles).mean(axis=1).to_numpy(dtype=np.float64)
+
+
+class PercentileSketchIndex:
+    '''
+    KLL sketches of every metric of every (season_id, competition_id, position_group) cohort, see the module
+    docstring. Rows are assigned to position groups as build_ranking_cube does (primary_position in the group's
+    comparable positions).
+
+    Holds the following:
+    sketches: (season_id, competition_id, position_group) -> {metric: KLLSketch}
+    samples: (season_id, competition_id, position_group) -> (priorities, metric values) of at most k sampled rows
+    row_counts: (season_id, competition_id, position_group) -> number of rows added
+    '''
+
+    def __init__(self, metric_grouping_information, k=DEFAULT_SKETCH_SIZE, seed=0):
+        self.registry = as_metric_group_registry(metric_grouping_information)
+        self.k = k
+        self.rng = np.random.default_rng(seed)
+        self.sketches = {}
+        self.samples = {}
+        self.row_counts = {}
+
+    def new_sketch(self):
+        return KLLSketch(self.k, self.rng.integers(2 ** 63))
+
+    def update(self, df):
+        '''
+        Function to add pre-processed rows (the whole frame or one chunk of it) to the cohort sketches.
+
+        Rows are not de-duplicated across calls, run remove_duplicate_rows on each chunk and keep chunks free of
+        overlapping player-seasons.
+        '''
+        for position_group in self.registry.position_groups:
+            _, general_metrics, comparable_positions = self.registry.get_group_metrics(position_group)
+            group_df = df[df['primary_position'].isin(comparable_positions)]
+            if group_df.empty:
+                continue
+
+            metric_values = group_df[general_metrics].to_numpy(dtype=np.float64)
+            for (season_id, competition_id), positions in group_df.groupby(COHORT_KEYS, sort=False).indices.items():
+                cohort_sketches = self.sketches.setdefault((season_id, competition_id, position_group), {})
+                for column, metric in enumerate(general_metrics):
+                    if metric not in cohort_sketches:
+                        cohort_sketches[metric] = self.new_sketch()
+                    cohort_sketches[metric].update(metric_values[positions, column])
+
+                self.add_sample((season_id, competition_id, position_group), self.rng.random(len(positions)),
+                                metric_values[positions], len(positions))
+
+        return self
+
+    def add_sample(self, key, priorities, values, n_rows):
+        # Merge sampled rows into a cohort's sample, keeping the k lowest priorities
+        if key in self.samples:
+            sample_priorities, sample_values = self.samples[key]
+            priorities = np.concatenate([sample_priorities, priorities])
+            values = np.concatenate([sample_values, values])
+
+        self.samples[key] = keep_lowest_priorities(priorities, values, self.k)
+        self.row_counts[key] = self.row_counts.get(key, 0) + n_rows
+
+    def merge(self, other):
+        '''
+        Add every cohort sketch of another index (e.g. one built from another export or another machine).
+        '''
+        for key, other_sketches in other.sketches.items():
+            cohort_sketches = self.sketches.setdefault(key, {})
+            for metric, sketch in other_sketches.items():
+                if metric in cohort_sketches:
+                    cohort_sketches[metric].merge(sketch)
+                else:
+                    cohort_sketches[metric] = sketch.copy()
+
+        for key, (priorities, values) in other.samples.items():
+            self.add_sample(key, priorities, values, other.row_counts[key])
+
+        return self
+
+    def get_pool_sketches(self, position_group, season_ids=None, competition_ids=None):
+        '''
+        Function to merge the cohort sketches of a position group over some (default all) seasons and competitions.
+
+        Returns:
+        pool_sketches (dict): metric -> KLLSketch of the pool, in the group's metric order.
+        '''
+        _, general_metrics, _ = self.registry.get_group_metrics(position_group)
+        pool_sketches = {metric: self.new_sketch() for metric in general_metrics}
+
+        for (season_id, competition_id, group), cohort_sketches in self.sketches.items():
+            if group != position_group or (season_ids is not None and season_id not in season_ids) or \
+                    (competition_ids is not None and competition_id not in competition_ids):
+                continue
+            for metric, sketch in cohort_sketches.items():
+                pool_sketches[metric].merge(sketch)
+
+        return pool_sketches
+
+    def get_pool_sample(self, position_group, season_ids=None, competition_ids=None):
+        '''
+        Function to merge the cohort samples of a position group over some (default all) seasons and competitions.
+
+        Returns:
+        values (array): Metric values of at most k uniformly sampled rows of the pool, in the group's metric order.
+        n_rows (int): Number of rows in the pool.
+        '''
+        _, general_metrics, _ = self.registry.get_group_metrics(position_group)
+        priorities, values = np.empty(0), np.empty((0, len(general_metrics)))
+        n_rows = 0
+
+        for (season_id, competition_id, group), (sample_priorities, sample_values) in self.samples.items():
+            if group != position_group or (season_ids is not None and season_id not in season_ids) or \
+                    (competition_ids is not None and competition_id not in competition_ids):
+                continue
+            priorities, values = keep_lowest_priorities(np.concatenate([priorities, sample_priorities]),
+                                                        np.concatenate([values, sample_values]), self.k)
+            n_rows += self.row_counts[(season_id, competition_id, group)]
+
+        return values, n_rows
+
+    def calculate_percentiles(self, df, position_group, season_ids=None, competition_ids=None, confidence=0.99):
+        '''
+        Function to calculate approximate percentiles (ranking) of rows against a pool of leagues and seasons,
+        the sketched counterpart of calculate_percentiles_all.
+
+        Parameters:
+        df (DataFrame): Pre-processed rows to rank, e.g. a player's seasons. They do not need to be in the pool.
+        position_group (str): Position group of the pool, rows outside its comparable positions are dropped.
+        season_ids, competition_ids (list, optional): Seasons and competitions of the pool, defaults to all.
+        confidence (float): Probability with which the reported error bounds hold.
+
+        Returns:
+        ranking_df (DataFrame): Copy of the rows with, for every group metric, '{metric}_percentile' and
+                                '{metric}_percentile_error', then 'average_rank' and 'average_rank_error' (the mean
+                                of the metric bounds), then 'average_rank_percentile' and
+                                'average_rank_percentile_error' (see the module docstring). Errors are +- percentile
+                                points.
+        '''
+        _, general_metrics, comparable_positions = self.registry.get_group_metrics(position_group)
+        ranking_df = df[df['primary_position'].isin(comparable_positions)].copy()
+
+        pool_sketches = self.get_pool_sketches(position_group, season_ids, competition_ids)
+        metric_values = ranking_df[general_metrics].to_numpy(dtype=np.float64)
+
+        errors = []
+        metric_percentiles = np.empty(metric_values.shape)
+        for column, metric in enumerate(general_metrics):
+            metric_percentiles[:, column], error = pool_sketches[metric].get_percentiles(metric_values[:, column],
+                                                                                         confidence)
+            ranking_df[f'{metric}_percentile'] = metric_percentiles[:, column]
+            ranking_df[f'{metric}_percentile_error'] = error
+            errors.append(error)
+
+        ranking_df['average_rank'] = get_average_ranks(metric_percentiles)
+        ranking_df['average_rank_error'] = average_rank_error = float(np.mean(errors)) if errors else 0.0
+
+        # average_rank of the pool's sampled rows, estimated from the same sketches
+        sample_values, n_rows = self.get_pool_sample(position_group, season_ids, competition_ids)
+        sample_percentiles = np.column_stack([pool_sketches[metric].get_percentiles(sample_values[:, column])[0]
+                                              for column, metric in enumerate(general_metrics)])
+        sample_average_ranks = np.sort(get_average_ranks(sample_percentiles))
+
+        # Rank among the sample, ties share their average rank as in rank_percentiles
+        average_ranks = ranking_df['average_rank'].to_numpy()
+        n_sampled = len(sample_average_ranks)
+        if n_sampled == 0:
+            ranking_df['average_rank_percentile'] = 50.0
+            ranking_df['average_rank_percentile_error'] = 0.0
+            return ranking_df
+
+        below = np.searchsorted(sample_average_ranks, average_ranks, side='left')
+        at_or_below = np.searchsorted(sample_average_ranks, average_ranks, side='right')
+        ranking_df['average_rank_percentile'] = (below + at_or_below + 1) / 2 / n_sampled * 100
+
+        # Sampling error (none when the whole pool is sampled), plus the sampled rows the metric errors could reorder
+        sampling_error = 0.0 if n_sampled == n_rows else math.sqrt(math.log(2 / (1 - confidence)) / (2 * n_sampled))
+        close = (np.searchsorted(sample_average_ranks, average_ranks + 2 * average_rank_error, side='right')
+                 - np.searchsorted(sample_average_ranks, average_ranks - 2 * average_rank_error, side='left'))
+        ranking_df['average_rank_percentile_error'] = np.minimum(
+            (sampling_error + np.where(average_rank_error > 0, close, 0) / n_sampled) * 100, 100.0)
+
+        return ranking_df
+
+    def get_pool_sizes(self, position_group, season_ids=None, competition_ids=None):
+        # Number of sketched (non-NaN) values per metric in a pool
+        pool_sketches = self.get_pool_sketches(position_group, season_ids, competition_ids)
+        return pd.Series({metric: sketch.n for metric, sketch in pool_sketches.items()}, dtype='int64')
@@ -0,0 +1,148 @@
+import numpy as np
+import pandas as pd
+from get_position_specific_metrics_statsbomb import as_metric_group_registry
+from parallel_ranking_statsbomb import rank_percentiles_parallel
+from cohort_density_statsbomb import compute_cohort_density
+
+
+COHORT_KEYS = ['season_id', 'competition_id']
+
+# Bump whenever build_ranking_cube changes its output, so persisted cubes are rebuilt
+RANKING_CUBE_VERSION = 1
+
+
+class RankingCube(dict):
+    '''
+    Ranked cohorts keyed by (season_id, competition_id, position_group), as built by build_ranking_cube, together
+    with the histogram and KDE curve of every cohort's average_rank, computed the first time they are asked for and
+    kept with the cube.
+
+    Holds the following:
+    densities: cohort key -> cohort density (see compute_cohort_density)
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.densities = {}
+
+    def get_cohort_density(self, season_id, competition_id, position_group):
+        # Histogram and KDE curve of a cohort's average_rank, KeyError if it was not ranked
+        key = (season_id, competition_id, position_group)
+        if key not in self.densities:
+            self.densities[key] = compute_cohort_density(self[key]['average_rank'])
+
+        return self.densities[key]
+
+
+def build_ranking_cube(df, metric_grouping_information, processes=1):
+    '''
+    Function to rank every (season, competition, position group) cohort in one grouped pass.
+
+    Produces the same per-cohort output as calculate_percentiles, but for every cohort at once, so that
+    report functions can look cohorts up instead of re-filtering and re-ranking df for every player row.
+
+    processes > 1 (or None for every CPU) ranks large position groups in worker processes, split by cohort and
+    metric, see rank_percentiles_parallel.
+
+    Returns the following:
+    ranking_cube: RankingCube (a dict) keyed by (season_id, competition_id, position_group), each value being the
+                  ranked cohort DataFrame (metric percentiles, average_rank and average_rank_percentile)
+    '''
+    ranking_cube = RankingCube()
+
+    registry = as_metric_group_registry(metric_grouping_information)
+
+    # The catch-all group is skipped, get_player_metrics never assigns players to it
+    for position_group in registry.position_groups:
+        _, general_metrics, comparable_positions = registry.get_group_metrics(position_group)
+
+        # Filter for primary_position in comparable_positions
+        general_df = df[df['primary_position'].isin(comparable_positions)].copy()
+        if general_df.empty:
+            continue
+
+        # Label every row with its season and competition cohort
+        cohort_ids = general_df.groupby(COHORT_KEYS, sort=False).ngroup().to_numpy()
+
+        # Convert every metric to a percentile within its cohort, NaN values are not ranked and given 50
+        metric_values = general_df[general_metrics].to_numpy(dtype=np.float64)
+        general_df[[f'{metric}_percentile' for metric in general_metrics]] = rank_percentiles_parallel(metric_values, cohort_ids, processes)
+
+        # Create average rank column (mean across percentile columns)
+        general_df['average_rank'] = general_df[[f'{metric}_percentile' for metric in general_metrics]].mean(axis=1)
+
+        # Convert the average rank to a percentile within each cohort
+        general_df['average_rank_percentile'] = rank_percentiles_parallel(general_df['average_rank'].to_numpy(dtype=np.float64),
+                                                                        cohort_ids, processes)
+
+        # Split into cohorts
+        for (season_id, competition_id), cohort_df in general_df.groupby(COHORT_KEYS, sort=False):
+            ranking_cube[(season_id, competition_id, position_group)] = cohort_df
+
+    return ranking_cube
+
+
+def lookup_cohort(ranking_cube, season_id, competition_id, position_group):
+    '''
+    Function to fetch a ranked cohort from a ranking cube built by build_ranking_cube.
+
+    Returns the same DataFrame calculate_percentiles would return for the cohort, or an empty DataFrame
+    if nobody in the cohort passed pre-processing.
+    '''
+    return ranking_cube.get((season_id, competition_id, position_group), pd.DataFrame())
+
+
+def lookup_cohort_density(ranking_cube, season_id, competition_id, position_group):
+    '''
+    Function to fetch the histogram and KDE curve of a ranked cohort's average_rank (see compute_cohort_density).
+
+    Densities are stored with a RankingCube or MappedRankingCube and computed once per cube, for a plain dict of
+    cohorts they are computed on every call. A cohort missing from the cube gets the density of no values, as
+    lookup_cohort gives it an empty DataFrame.
+    '''
+    if (season_id, competition_id, position_group) not in ranking_cube:
+        return compute_cohort_density(np.empty(0))
+
+    if hasattr(ranking_cube, 'get_cohort_density'):
+        return ranking_cube.get_cohort_density(season_id, competition_id, position_group)
+
+    return compute_cohort_density(ranking_cube[(season_id, competition_id, position_group)]['average_rank'])
+
+
+def ranking_cube_to_frame(ranking_cube):
+    '''
+    Function to flatten a ranking cube into one DataFrame (e.g. to persist it as Parquet).
+
+    Cohorts are stacked in cube order with a 'position_group' column, percentile columns of other groups' metrics
+    are left empty. ranking_cube_from_frame reverses this.
+    '''
+    if not ranking_cube:
+        return pd.DataFrame(columns=['position_group'])
+
+    return pd.concat([cohort_df.assign(position_group=position_group)
+                      for (_, _, position_group), cohort_df in ranking_cube.items()])
+
+
+def ranking_cube_from_frame(cube_df, metric_grouping_information):
+    '''
+    Function to split a DataFrame written by ranking_cube_to_frame back into a ranking cube.
+
+    Every cohort gets back exactly the columns build_ranking_cube gave it, in the same order.
+    '''
+    ranking_cube = RankingCube()
+    if cube_df.empty:
+        return ranking_cube
+
+    registry = as_metric_group_registry(metric_grouping_information)
+    ranked_columns = {'position_group', 'average_rank', 'average_rank_percentile'}
+    ranked_columns.update(f'{metric}_percentile' for metrics in registry.group_to_metrics.values() for metric in metrics)
+    data_columns = [column for column in cube_df.columns if column not in ranked_columns]
+
+    for position_group, group_df in cube_df.groupby('position_group', sort=False):
+        general_metrics = registry.group_to_metrics[position_group]
+        columns = data_columns + [f'{metric}_percentile' for metric in general_metrics] + ['average_rank', 'average_rank_percentile']
+
+        for (season_id, competition_id), cohort_df in group_df[columns].groupby(COHORT_KEYS, sort=False):
+            ranking_cube[(season_id, competition_id, position_group)] = cohort_df
+
+    return ranking_cube
@@ -0,0 +1,479 @@
+'''
+Local HTTP/JSON ranking service: loads the pre-processed data and ranking cube once, keeps the League One and all
+leagues cohorts it has ranked in memory, and answers where a player sits in their own league, in League One and
+across all leagues. When the CSV or the metric groups file changes the data is reloaded by the first request that
+notices it, concurrent requests keep being answered from the previous data until the reload is done.
+
+Endpoints (GET):
+    /health                                         rows, cohorts and when the data was loaded
+    /rank?player_id=31663[&season_id=...]           rank, percentile and age band ranks for every season row
+    /plot?player_id=31663&report=own_league         rendered report (own_league, league_one or all_leagues),
+         [&format=png][&dpi=100]                    as image bytes
+    /similar?player_id=31663[&k=10][&season_id=...] most similar player-seasons across every league, filtered by
+         [&min_age=..][&max_age=..][&min_minutes=..] age, minutes, competition and season (ids comma separated)
+         [&competition_ids=..][&season_ids=..]
+    /leaderboard?season_id=..&competition_id=..     top players of an own league cohort, optionally U21 or
+         &position_group=..[&n=10][&age_cutoff=22]  one team only
+         [&team_name=lincoln_city]
+
+Errors are answered as JSON {"error": ...}: 404 for an unknown player, an unranked cohort or nothing rendered, 400
+for a missing or malformed query parameter and 500 (logged) for anything else.
+
+Runs with the standard library only, e.g.
+
+    python aggregate_rank_cli_statsbomb.py serve --data data/player_season_stats.csv \
+        --metric-groups cross_platform/statsbomb_metric_groups.csv --port 8050
+'''
+import json
+import os
+import tempfile
+import threading
+import time
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import numpy as np
+import pandas as pd
+from get_position_specific_metrics_statsbomb import MetricGroupRegistry
+from preprocessed_cache_statsbomb import load_mapped_season_stats
+from ranking_cube_statsbomb import lookup_cohort
+from aggregate_rank_league_one_statsbomb import calculate_percentiles_league_one
+from age_band_ranking_statsbomb import AGE_BANDS
+from percentile_rank_kernel_statsbomb import rank_percentiles
+from own_league_plot import plot_stacked_distribution_u21_flag
+from league_one_plot import plot_distribution_league_one_u21
+from all_league_plot import plot_distribution_all_leagues
+from plot_output_statsbomb import use_headless_backend, closing_new_figures
+from season_index_statsbomb import SeasonIndex
+from leaderboard_statsbomb import LeaderboardIndex
+from similarity_search_statsbomb import PlayerSimilarityIndex
+
+
+REPORTS = ['own_league', 'league_one', 'all_leagues']
+
+# Columns of every /leaderboard player entry, besides rank
+LEADERBOARD_COLUMNS = ['player_id', 'player_name', 'team_name', 'age', 'average_rank', 'average_rank_percentile']
+
+IMAGE_CONTENT_TYPES = {'png': 'image/png', 'svg': 'image/svg+xml', 'pdf': 'application/pdf', 'jpg': 'image/jpeg'}
+
+
+class NotFoundError(LookupError):
+    # A player, cohort or report the service has nothing for, answered with a 404
+    pass
+
+
+class BadRequestError(ValueError):
+    # A missing or malformed query parameter, answered with a 400
+    pass
+
+
+def parse_ids(value):
+    # Comma separated ids, e.g. '2,4,7'
+    return [int(id_value) for id_value in value.split(',')]
+
+
+def get_query_value(query, name, parse=str, default=None, required=False):
+    # Query parameter parsed with parse, BadRequestError if it is required and missing or does not parse
+    if name not in query:
+        if required:
+            raise BadRequestError(f'Missing query parameter {name}')
+        return default
+
+    try:
+        return parse(query[name])
+    except ValueError:
+        raise BadRequestError(f'Invalid value for {name}: {query[name]!r}') from None
+
+
+def filter_positions(df, comparable_positions):
+    # Rows whose primary_position is in comparable_positions
+    return df[df['primary_position'].isin(comparable_positions)]
+
+
+def summarize_cohort_position(cohort_df, index, age_bands=AGE_BANDS):
+    '''
+    Rank (1 = highest average_rank, ties share the lowest rank), cohort size, average_rank and
+    average_rank_percentile of row label index, plus the same within every age band the player is in.
+
+    Gives the same numbers as rank_age_bands, but only for the one player and without copying the cohort.
+    Raises NotFoundError if the row is not in the cohort.
+    '''
+    if index not in cohort_df.index:
+        raise NotFoundError(f'Row {index} is not in its ranked cohort')
+
+    position = cohort_df.index.get_loc(index)
+    average_rank = cohort_df['average_rank'].to_numpy(dtype=np.float64)
+    ages = cohort_df['age'].to_numpy(dtype=np.float64)
+    player_average_rank = average_rank[position]
+
+    summary = {
+        'rank': int((average_rank > player_average_rank).sum()) + 1,
+        'total': len(cohort_df),
+        'average_rank': float(player_average_rank),
+        'average_rank_percentile': float(cohort_df['average_rank_percentile'].iloc[position]),
+        'age_bands': {},
+    }
+
+    for band, cutoff in age_bands.items():
+        if not ages[position] < cutoff:
+            continue
+
+        band_average_rank = average_rank[ages < cutoff]
+        band_percentiles = rank_percentiles(band_average_rank)
+        summary['age_bands'][band] = {
+            'rank': int((band_average_rank > player_average_rank).sum()) + 1,
+            'total': len(band_average_rank),
+            'percentile': float(band_percentiles[np.flatnonzero(ages < cutoff) == position][0]),
+        }
+
+    return summary
+
+
+class RankingService:
+    '''
+    In-memory ranking state for the service, reloaded as a whole when the data or metric groups files change.
+
+    Own league cohorts come from the cached ranking cube, memory-mapped (load_mapped_season_stats) so a reload only
+    maps the new percentile matrix and cohorts are built as they are queried. League One and all leagues cohorts are
+    ranked with calculate_percentiles_league_one the first time they are asked for and kept until the next reload; a
+    player from outside League One is appended to the League One cohort and re-ranked, exactly as the League One plot
+    does.
+
+    Worker processes (processes) are only used to rank the cube on the first load, before the server's threads start.
+    Requests and the reloads they trigger rank in-process, forking from a threaded server can deadlock the workers on
+    locks other threads held.
+    '''
+
+    def __init__(self, csv_path, metric_groups_path, season_information_path=None, cache_dir=None,
+                 hash_contents=False, reload_interval=5.0, processes=1):
+        self.csv_path = csv_path
+        self.metric_groups_path = metric_groups_path
+        self.season_information_path = season_information_path
+        self.cache_dir = cache_dir
+        self.hash_contents = hash_contents
+        self.reload_interval = reload_interval
+
+        self.state = None
+        self.last_checked = 0.0
+        self.reload_lock = threading.Lock()
+        self.cohort_lock = threading.Lock()
+
+        # matplotlib's pyplot state is global, render one report at a time
+        self.plot_lock = threading.Lock()
+
+        self.reload(processes)
+
+    def get_source_signature(self):
+        # Size and modification time of every input file, any change triggers a reload
+        paths = [self.csv_path, self.metric_groups_path, self.season_information_path]
+        return tuple((os.stat(path).st_size, os.stat(path).st_mtime_ns) for path in paths if path)
+
+    def reload(self, processes=1):
+        # Build the new state completely before swapping it in, requests in flight keep using the old one
+        signature = self.get_source_signature()
+        metric_grouping_information = MetricGroupRegistry.from_csv(self.metric_groups_path)
+        df, ranking_cube = load_mapped_season_stats(self.csv_path, metric_grouping_information, self.cache_dir,
+                                                    self.hash_contents, processes)
+
+        chronological_season_ids = None
+        if self.season_information_path:
+            chronological_season_ids = pd.read_csv(self.season_information_path)['statsbomb_season_id']
+
+        self.state = {
+            'signature': signature,
+            'loaded_at': time.time(),
+            'df': df,
+            'metric_grouping_information': metric_grouping_information,
+            'ranking_cube': ranking_cube,
+            'chronological_season_ids': chronological_season_ids,
+            'season_index': SeasonIndex(df),
+            'league_one_cohorts': {},
+            'all_league_cohorts': {},
+            'similarity_index': None,
+            'leaderboards': LeaderboardIndex(ranking_cube),
+        }
+
+    def get_state(self):
+        '''
+        Current state, reloaded first if a source file changed (checked at most every reload_interval seconds).
+        '''
+        now = time.monotonic()
+        if now - self.last_checked >= self.reload_interval and self.reload_lock.acquire(blocking=False):
+            try:
+                self.last_checked = now
+                if self.get_source_signature() != self.state['signature']:
+                    self.reload()
+            finally:
+                self.reload_lock.release()
+
+        return self.state
+
+    def get_cached_cohort(self, state, cache_name, key, build):
+        # Rank a cohort once per loaded state
+        cohorts = state[cache_name]
+        if key not in cohorts:
+            cohort_df = build()
+            with self.cohort_lock:
+                cohorts.setdefault(key, cohort_df)
+
+        return cohorts[key]
+
+    def get_own_league_cohort(self, state, row, position_group):
+        # A season row's own league cohort, NotFoundError if nobody in it passed pre-processing
+        own_league_df = lookup_cohort(state['ranking_cube'], row['season_id'], row['competition_id'], position_group)
+        if own_league_df.empty:
+            raise NotFoundError(f"No ranked own league cohort for season_id {row['season_id']}, competition_id "
+                                f"{row['competition_id']} and position_group {position_group}")
+
+        return own_league_df
+
+    def rank_player(self, player_id, season_id=None, competition_id=None):
+        '''
+        Own league, League One and all leagues rankings of every season row of a player.
+
+        Returns None if the player has no rows, otherwise a dict with the player and one entry per season row.
+        Raises NotFoundError if a season row has no ranked own league cohort.
+        '''
+        state = self.get_state()
+        registry = state['metric_grouping_information']
+        season_index = state['season_index']
+
+        player_df = season_index.get_player_rows(player_id)
+        if season_id is not None:
+            player_df = player_df[player_df['season_id'] == season_id]
+        if competition_id is not None:
+            player_df = player_df[player_df['competition_id'] == competition_id]
+        if player_df.empty:
+            return None
+
+        seasons = []
+        for index, row in player_df.iterrows():
+            position_group, general_metrics, comparable_positions = registry.get_player_metrics(row)
+            summer_season_name, winter_season_name = season_index.get_paired_season_names(row['season_name'])
+
+            # Own league, straight from the ranking cube
+            own_league_df = self.get_own_league_cohort(state, row, position_group)
+
+            # Only the columns ranking and summarize_cohort_position need are kept, so re-ranking stays cheap
+            columns = ['age', 'primary_position'] + list(general_metrics)
+
+            # League One in the winter season, with the player appended and re-ranked if they play elsewhere
+            league_one_df = self.get_cached_cohort(
+                state, 'league_one_cohorts', (winter_season_name, position_group),
+                lambda: filter_positions(season_index.get_league_one_rows(winter_season_name), comparable_positions)[columns])
+            if row['competition_name'] == 'league_one':
+                league_one_df = self.get_cached_cohort(
+                    state, 'league_one_cohorts', (winter_season_name, position_group, 'ranked'),
+                    lambda: calculate_percentiles_league_one(league_one_df, comparable_positions, general_metrics))
+            else:
+                league_one_df = calculate_percentiles_league_one(pd.concat([league_one_df, pd.DataFrame([row[columns]])]),
+                                                                 comparable_positions, general_metrics)
+
+            # All leagues playing the summer season or the winter season starting that year
+            all_league_df = self.get_cached_cohort(
+                state, 'all_league_cohorts', (summer_season_name, winter_season_name, position_group),
+                lambda: calculate_percentiles_league_one(season_index.get_calendar_rows(winter_season_name)[columns],
+                                                         comparable_positions, general_metrics))
+
+            seasons.append({
+                'season_id': int(row['season_id']),
+                'season_name': row['season_name'],
+                'competition_id': int(row['competition_id']),
+                'competition_name': row['competition_name'],
+                'team_name': row['team_name'],
+                'age': None if pd.isna(row['age']) else int(row['age']),
+                'position_group': position_group,
+                'own_league': summarize_cohort_position(own_league_df, index),
+                'league_one': summarize_cohort_position(league_one_df, index),
+                'all_leagues': summarize_cohort_position(all_league_df, index),
+            })
+
+        return {'player_id': int(player_id), 'player_name': player_df['player_name'].iloc[0], 'seasons': seasons}
+
+    def find_similar_players(self, player_id, k=10, **filters):
+        '''
+        Most similar player-seasons to a player, see PlayerSimilarityIndex.search_player for k and filters.
+
+        Returns None if the player has no ranked rows, otherwise a dict with the player and the matches.
+        '''
+        state = self.get_state()
+        if state['similarity_index'] is None:
+            similarity_index = PlayerSimilarityIndex(state['ranking_cube'], state['metric_grouping_information'])
+            with self.cohort_lock:
+                if state['similarity_index'] is None:
+                    state['similarity_index'] = similarity_index
+
+        try:
+            matches_df = state['similarity_index'].search_player(player_id, k, **filters)
+        except KeyError:
+            return None
+
+        matches_df = matches_df.astype(object).where(matches_df.notna(), None)
+        return {'player_id': int(player_id), 'matches': matches_df.to_dict(orient='records')}
+
+    def get_leaderboard(self, season_id, competition_id, position_group, n=10, age_cutoff=None, team_name=None):
+        '''
+        Top n players of an own league cohort, see CohortLeaderboard.top for age_cutoff and team_name.
+
+        Returns None if the cohort does not exist, otherwise a dict with the cohort, pool size and players.
+        '''
+        state = self.get_state()
+        if (season_id, competition_id, position_group) not in state['ranking_cube']:
+            return None
+
+        with self.cohort_lock:
+            leaderboard = state['leaderboards'].get_leaderboard(season_id, competition_id, position_group)
+            leaderboard_df = leaderboard.top(n, age_cutoff, team_name, LEADERBOARD_COLUMNS)
+            total = leaderboard.get_total(age_cutoff)
+
+        leaderboard_df = leaderboard_df.astype(object).where(leaderboard_df.notna(), None)
+        players = leaderboard_df[['rank', *LEADERBOARD_COLUMNS]].to_dict(orient='records')
+
+        return {'season_id': season_id, 'competition_id': competition_id, 'position_group': position_group,
+                'total': total, 'players': players}
+
+    def render_plot(self, player_id, report, image_format='png', dpi=None):
+        '''
+        Render one report for a player headless and return the image bytes, None if the player has no rows.
+        Raises NotFoundError if a season row has no ranked own league cohort or nothing was rendered.
+        '''
+        state = self.get_state()
+        df = state['df']
+        player_df = state['season_index'].get_player_rows(player_id)
+        if player_df.empty:
+            return None
+
+        # The own league report looks every season's cohort up in the cube, check they were all ranked before drawing
+        registry = state['metric_grouping_information']
+        if report == 'own_league':
+            for _, row in player_df.iterrows():
+                self.get_own_league_cohort(state, row, registry.get_player_metrics(row)[0])
+
+        render_options = dict(headless=True, image_format=image_format, dpi=dpi)
+        with self.plot_lock, tempfile.TemporaryDirectory() as save_path:
+            use_headless_backend()
+            with closing_new_figures():
+                if report == 'own_league':
+                    file_paths = plot_stacked_distribution_u21_flag(player_df, df, registry, save_path,
+                                                                    ranking_cube=state['ranking_cube'], **render_options)
+                elif report == 'league_one':
+                    file_paths = plot_distribution_league_one_u21(player_df, df, registry, save_path,
+                                                                  state['chronological_season_ids'],
+                                                                  season_index=state['season_index'],
+                                                                  **render_options)
+                else:
+                    file_paths = plot_distribution_all_leagues(player_df, df, registry, save_path,
+                                                               season_index=state['season_index'],
+                                                               **render_options)
+
+            # The plot functions return the images they wrote, a single one as every season goes on one figure
+            if not file_paths:
+                raise NotFoundError(f'Nothing was rendered for player_id {player_id}')
+            with open(file_paths[0], 'rb') as f:
+                return f.read()
+
+
+class RankingRequestHandler(BaseHTTPRequestHandler):
+    # The RankingService is attached to the server as server.ranking_service
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        service = self.server.ranking_service
+
+        try:
+            if url.path == '/health':
+                state = service.get_state()
+                self.send_json(200, {'status': 'ok', 'rows': len(state['df']), 'cohorts': len(state['ranking_cube']),
+                                     'loaded_at': state['loaded_at']})
+
+            elif url.path == '/rank':
+                result = service.rank_player(get_query_value(query, 'player_id', int, required=True),
+                                             get_query_value(query, 'season_id', int),
+                                             get_query_value(query, 'competition_id', int))
+                if result is None:
+                    self.send_json(404, {'error': f"No rows for player_id {query['player_id']}"})
+                else:
+                    self.send_json(200, result)
+
+            elif url.path == '/plot':
+                report = query.get('report', 'own_league')
+                image_format = query.get('format', 'png')
+                if report not in REPORTS or image_format not in IMAGE_CONTENT_TYPES:
+                    self.send_json(400, {'error': f'report must be one of {REPORTS} and format one of {list(IMAGE_CONTENT_TYPES)}'})
+                    return
+
+                image = service.render_plot(get_query_value(query, 'player_id', int, required=True), report,
+                                            image_format, get_query_value(query, 'dpi', float))
+                if image is None:
+                    self.send_json(404, {'error': f"No rows for player_id {query['player_id']}"})
+                    return
+
+                self.send_response(200)
+                self.send_header('Content-Type', IMAGE_CONTENT_TYPES[image_format])
+                self.send_header('Content-Length', str(len(image)))
+                self.end_headers()
+                self.wfile.write(image)
+
+            elif url.path == '/similar':
+                filters = {name: get_query_value(query, name, int)
+                           for name in ['season_id', 'competition_id', 'min_age', 'max_age'] if name in query}
+                if 'min_minutes' in query:
+                    filters['min_minutes'] = get_query_value(query, 'min_minutes', float)
+                for name in ['competition_ids', 'season_ids']:
+                    if name in query:
+                        filters[name] = get_query_value(query, name, parse_ids)
+
+                result = service.find_similar_players(get_query_value(query, 'player_id', int, required=True),
+                                                      get_query_value(query, 'k', int, 10), **filters)
+                if result is None:
+                    self.send_json(404, {'error': f"No ranked rows for player_id {query['player_id']}"})
+                else:
+                    self.send_json(200, result)
+
+            elif url.path == '/leaderboard':
+                result = service.get_leaderboard(get_query_value(query, 'season_id', int, required=True),
+                                                 get_query_value(query, 'competition_id', int, required=True),
+                                                 get_query_value(query, 'position_group', required=True),
+                                                 get_query_value(query, 'n', int, 10),
+                                                 get_query_value(query, 'age_cutoff', int),
+                                                 query.get('team_name'))
+                if result is None:
+                    self.send_json(404, {'error': 'No ranked cohort for season_id {season_id}, competition_id '
+                                                  '{competition_id} and position_group {position_group}'.format(**query)})
+                else:
+                    self.send_json(200, result)
+
+            else:
+                self.send_json(404, {'error': f'Unknown path {url.path}'})
+
+        except NotFoundError as e:
+            self.send_json(404, {'error': str(e)})
+        except BadRequestError as e:
+            self.send_json(400, {'error': str(e)})
+        except Exception as e:
+            # Anything else is a bug or bad data, log it and answer instead of dropping the connection
+            self.log_error('%s', traceback.format_exc())
+            self.send_json(500, {'error': f'{type(e).__name__}: {e}'})
+
+
+def serve(ranking_service, host='127.0.0.1', port=8050):
+    '''
+    Serve ranking_service over HTTP until interrupted. Binds to localhost by default, the service has no auth.
+    '''
+    server = ThreadingHTTPServer((host, port), RankingRequestHandler)
+    server.ranking_service = ranking_service
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -1,8 +1,82 @@
+import numpy as np
+import pandas as pd
+from instrumentation_statsbomb import instrument_stage
+
+
+# Columns identifying a player-season row, duplicates share all of them
+DEDUPLICATION_KEYS = ['player_id', 'season_id', 'competition_id', 'team_name']
+
+
+def get_key_codes(df, keys=DEDUPLICATION_KEYS):
+    '''
+    Function to encode the key columns of every row as a single int64, equal for equal keys (missing values count
+    as equal) and ordered like the keys: ascending column by column, missing values last.
+
+    Every column is factorized to sorted integer codes, which are combined in mixed radix, or ranked with
+    np.lexsort when the combined range would not fit in an int64.
+    '''
+    column_codes = []
+    for key in keys:
+        codes, uniques = pd.factorize(df[key], sort=True)
+        column_codes.append((np.where(codes < 0, len(uniques), codes).astype(np.int64), len(uniques) + 1))
+
+    radix_product = 1
+    for _, radix in column_codes:
+        radix_product *= radix
+
+    if radix_product < 2 ** 63:
+        key_codes = np.zeros(len(df), dtype=np.int64)
+        for codes, radix in column_codes:
+            key_codes = key_codes * radix + codes
+        return key_codes
+
+    # Dense rank of every row's keys
+    order = np.lexsort([codes for codes, _ in column_codes][::-1])
+    is_new_key = np.ones(len(df), dtype=bool)
+    is_new_key[1:] = np.any([np.diff(codes[order]) != 0 for codes, _ in column_codes], axis=0)
+
+    key_codes = np.empty(len(df), dtype=np.int64)
+    key_codes[order] = np.cumsum(is_new_key) - 1
+    return key_codes
+
+
+def get_max_minutes_positions(minutes, key_codes):
+    '''
+    Function to find the row with the highest minutes for every key, by hashing rather than sorting.
+
+    Ties keep the first row and keys where minutes are missing for every row keep their first row, exactly as
+    sorting by minutes (descending, stable) and keeping the first row does.
+
+    Returns:
+    positions (array): Row positions of the kept rows, in their original order.
+    '''
+    minutes = np.asarray(minutes, dtype=np.float64)
+
+    # Rows holding their key's highest minutes, or every row of a key without minutes
+    max_minutes = pd.Series(minutes).groupby(key_codes).transform('max').to_numpy()
+    candidates = np.flatnonzero((minutes == max_minutes) | np.isnan(max_minutes))
+
+    # First candidate per key
+    return candidates[~pd.Series(key_codes[candidates]).duplicated().to_numpy()]
+
+
+def get_deduplicated_positions(df, key_codes=None):
+    '''
+    Function to find the rows remove_duplicate_rows keeps, as row positions ordered by the deduplication keys.
+    key_codes from get_key_codes can be passed in if they are needed elsewhere too.
+    '''
+    if key_codes is None:
+        key_codes = get_key_codes(df)
+    positions = get_max_minutes_positions(df['minutes'], key_codes)
+
+    return positions[np.argsort(key_codes[positions], kind='stable')]
+
+
+@instrument_stage
 def remove_duplicate_rows(df):
     # Function to remove duplicate rows after concatenating legacy ccfc and subscribed lcfc statsbomb data
-    # Sort by player_id, season_id, competition_id, team_name, and minutes.
-    # Keep the row with the highest minutes when duplicates exist for the same player, season, competition, and team.
-    df = df.sort_values(by=['player_id', 'season_id', 'competition_id', 'team_name', 'minutes'],
-                        ascending=[True, True, True, True, False])
-    df = df.drop_duplicates(subset=['player_id', 'season_id', 'competition_id', 'team_name'], keep='first')
-    return df
\ No newline at end of file
+    # Keep the row with the highest minutes when duplicates exist for the same player, season, competition, and team,
+    # ordered by player_id, season_id, competition_id and team_name.
+    # Same result as sorting the whole frame on the keys and minutes and dropping duplicates, but the kept rows are
+    # found by hashing and only their int64 key codes are sorted.
+    return df.iloc[get_deduplicated_positions(df)]
@@ -0,0 +1,77 @@
+import numpy as np
+
+
+def get_paired_season_names(season_name):
+    '''
+    Function to pair a season with the season played over the same calendar year, as the League One and all
+    leagues plots do: summer season 'YYYY' <-> winter season 'YYYY/YYYY+1'.
+
+    Returns (summer_season_name, winter_season_name).
+    '''
+    if '/' not in season_name:
+        return season_name, season_name + '/' + str(int(season_name) + 1)
+
+    return season_name.split('/')[0], season_name
+
+
+class SeasonIndex:
+    '''
+    Season lookups for a pre-processed frame, built once so that per-season filtering is an array lookup instead of
+    a string comparison over the whole frame. Build it once per frame and pass it to the League One and all leagues
+    plots, they only build their own when none is given.
+
+    Holds the following:
+    season_pairs: season_name -> (summer_season_name, winter_season_name), computed once per distinct season
+    season_positions: season_name -> row positions in df
+    league_one_positions: season_name -> row positions of League One rows in df
+    player_positions: player_id -> row positions in df
+
+    Row positions are kept in df order, so the frames returned match what boolean filtering of df returns.
+    '''
+
+    def __init__(self, df):
+        self.df = df
+
+        season_names = df['season_name']
+        self.season_positions = dict(df.groupby(season_names, sort=False, observed=True).indices)
+        self.season_pairs = {season_name: get_paired_season_names(season_name) for season_name in self.season_positions}
+
+        league_one_positions = np.flatnonzero((df['competition_name'] == 'league_one').to_numpy())
+        league_one_seasons = season_names.iloc[league_one_positions]
+        self.league_one_positions = {
+            season_name: league_one_positions[positions]
+            for season_name, positions in league_one_seasons.groupby(league_one_seasons, sort=False, observed=True).indices.items()
+        }
+
+        self.player_positions = dict(df.groupby('player_id', sort=False).indices)
+
+    def get_paired_season_names(self, season_name):
+        # Cached pairing for seasons in df, worked out on the fly for any other season
+        return self.season_pairs.get(season_name) or get_paired_season_names(season_name)
+
+    def get_rows(self, positions):
+        # Rows of df at positions (in df order), always a new frame
+        return self.df.iloc[positions]
+
+    def get_season_rows(self, *season_names):
+        '''
+        Rows of df playing any of season_names, in df order.
+        '''
+        empty = np.empty(0, dtype=np.intp)
+        positions = [self.season_positions.get(season_name, empty) for season_name in dict.fromkeys(season_names)]
+
+        return self.get_rows(np.sort(np.concatenate(positions)))
+
+    def get_calendar_rows(self, season_name):
+        '''
+        Rows of df playing season_name or its paired season, i.e. every league over the same calendar year.
+        '''
+        return self.get_season_rows(*self.get_paired_season_names(season_name))
+
+    def get_league_one_rows(self, season_name):
+        # League One rows of one season, in df order
+        return self.get_rows(self.league_one_positions.get(season_name, np.empty(0, dtype=np.intp)))
+
+    def get_player_rows(self, player_id):
+        # Every season row of one player, in df order
+        return self.get_rows(self.player_positions.get(player_id, np.empty(0, dtype=np.intp)))
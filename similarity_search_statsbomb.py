@@ -0,0 +1,159 @@
+import numpy as np
+import pandas as pd
+from get_position_specific_metrics_statsbomb import as_metric_group_registry
+
+
+# Player-season details returned with every match
+PROFILE_COLUMNS = ['player_id', 'player_name', 'team_name', 'competition_id', 'competition_name', 'season_id',
+                   'season_name', 'primary_position', 'age', 'minutes', 'average_rank', 'average_rank_percentile']
+
+# Rows compared per NumPy block, bounds the temporary (rows x metrics) difference array
+BLOCK_SIZE = 65_536
+
+
+class PlayerSimilarityIndex:
+    '''
+    "Players like X" search over the metric percentile profiles in a ranking cube.
+
+    Every position group is indexed separately as a float32 matrix of its '{metric}_percentile' columns (percentiles
+    within each player's own league and season, from build_ranking_cube), so players are only compared on the
+    metrics chosen for their position. Searches are blocked brute force in NumPy: filters are applied first, then
+    Euclidean distances are computed block by block and the k nearest kept with np.argpartition.
+
+    Holds the following:
+    profiles: position group -> DataFrame of PROFILE_COLUMNS, one row per player-season
+    percentiles: position group -> float32 array (rows x metrics), aligned with profiles
+    general_metrics: position group -> metrics, in the column order of percentiles
+    '''
+
+    def __init__(self, ranking_cube, metric_grouping_information):
+        registry = as_metric_group_registry(metric_grouping_information)
+
+        cohorts_by_group = {}
+        for (_, _, position_group), cohort_df in ranking_cube.items():
+            cohorts_by_group.setdefault(position_group, []).append(cohort_df)
+
+        self.profiles = {}
+        self.percentiles = {}
+        self.general_metrics = {}
+        for position_group, cohort_dfs in cohorts_by_group.items():
+            general_metrics = registry.group_to_metrics[position_group]
+            group_df = pd.concat(cohort_dfs)
+
+            self.general_metrics[position_group] = general_metrics
+            self.percentiles[position_group] = group_df[[f'{metric}_percentile' for metric in general_metrics]].to_numpy(dtype=np.float32)
+            self.profiles[position_group] = group_df[[column for column in PROFILE_COLUMNS if column in group_df.columns]]
+
+    def find_player(self, player_id, season_id=None, competition_id=None):
+        '''
+        Position group and row of a player's profile, the row with the most minutes if several seasons match.
+        '''
+        matches = []
+        for position_group, profile_df in self.profiles.items():
+            is_match = profile_df['player_id'] == player_id
+            if season_id is not None:
+                is_match &= profile_df['season_id'] == season_id
+            if competition_id is not None:
+                is_match &= profile_df['competition_id'] == competition_id
+            for position in np.flatnonzero(is_match.to_numpy()):
+                matches.append((profile_df['minutes'].iloc[position], position_group, position))
+
+        if not matches:
+            raise KeyError(f'No ranked season for player_id {player_id} (season_id {season_id}, competition_id {competition_id})')
+
+        _, position_group, position = max(matches, key=lambda match: match[0])
+        return position_group, position
+
+    def get_candidate_mask(self, position_group, min_age=None, max_age=None, min_minutes=None, competition_ids=None,
+                           season_ids=None):
+        # Rows of a position group passing every filter
+        profile_df = self.profiles[position_group]
+        mask = np.ones(len(profile_df), dtype=bool)
+
+        if min_age is not None:
+            mask &= (profile_df['age'] >= min_age).to_numpy()
+        if max_age is not None:
+            mask &= (profile_df['age'] <= max_age).to_numpy()
+        if min_minutes is not None:
+            mask &= (profile_df['minutes'] >= min_minutes).to_numpy()
+        if competition_ids is not None:
+            mask &= profile_df['competition_id'].isin(competition_ids).to_numpy()
+        if season_ids is not None:
+            mask &= profile_df['season_id'].isin(season_ids).to_numpy()
+
+        return mask
+
+    def search_profile(self, position_group, profile, k=10, candidate_mask=None):
+        '''
+        Function to find the k player-seasons of a position group closest to a percentile profile.
+
+        Parameters:
+        position_group (str): Position group to search.
+        profile (array or dict): Percentile per metric, in general_metrics order or as metric -> percentile.
+        k (int): Number of matches.
+        candidate_mask (array, optional): Boolean mask of rows that may be returned, e.g. from get_candidate_mask.
+
+        Returns:
+        matches_df (DataFrame): PROFILE_COLUMNS plus 'distance' (Euclidean, in percentile points) and 'similarity'
+                                (100 = identical profile, 0 = as far apart as possible), closest first.
+        '''
+        if k < 1:
+            raise ValueError(f'k must be at least 1, got {k}')
+
+        general_metrics = self.general_metrics[position_group]
+        if isinstance(profile, dict):
+            profile = [profile[metric] for metric in general_metrics]
+        profile = np.asarray(profile, dtype=np.float32)
+
+        percentiles = self.percentiles[position_group]
+        candidates = np.flatnonzero(candidate_mask) if candidate_mask is not None else np.arange(len(percentiles))
+
+        # Nearest k of every block, then the nearest k overall
+        best_positions = []
+        best_distances = []
+        for start in range(0, len(candidates), BLOCK_SIZE):
+            block = candidates[start:start + BLOCK_SIZE]
+            differences = percentiles[block] - profile
+            distances = np.einsum('ij,ij->i', differences, differences)
+
+            if len(block) > k:
+                nearest = np.argpartition(distances, k - 1)[:k]
+                block, distances = block[nearest], distances[nearest]
+            best_positions.append(block)
+            best_distances.append(distances)
+
+        positions = np.concatenate(best_positions) if best_positions else np.empty(0, dtype=np.intp)
+        distances = np.sqrt(np.concatenate(best_distances)) if best_distances else np.empty(0, dtype=np.float32)
+        order = np.lexsort((positions, distances))[:k]
+
+        matches_df = self.profiles[position_group].iloc[positions[order]].copy()
+        matches_df['distance'] = distances[order].astype(np.float64)
+        matches_df['similarity'] = 100 * (1 - matches_df['distance'] / (100 * np.sqrt(len(general_metrics))))
+
+        return matches_df
+
+    def search_player(self, player_id, k=10, season_id=None, competition_id=None, min_age=None, max_age=None,
+                      min_minutes=None, competition_ids=None, season_ids=None, include_same_player=False):
+        '''
+        Function to find the k player-seasons most similar to one of a player's seasons, across every league.
+
+        Parameters:
+        player_id (int): Player to find replacements for.
+        k (int): Number of matches.
+        season_id, competition_id (int, optional): Which of the player's seasons to match, defaults to the one with
+                                                   the most minutes.
+        min_age, max_age (int, optional): Age range of candidates (inclusive).
+        min_minutes (float, optional): Minimum minutes played by candidates.
+        competition_ids, season_ids (list, optional): Leagues and seasons to search, defaults to all.
+        include_same_player (bool): Also return the player's own other seasons.
+
+        Returns:
+        matches_df (DataFrame): See search_profile.
+        '''
+        position_group, position = self.find_player(player_id, season_id, competition_id)
+
+        candidate_mask = self.get_candidate_mask(position_group, min_age, max_age, min_minutes, competition_ids, season_ids)
+        if not include_same_player:
+            candidate_mask &= (self.profiles[position_group]['player_id'] != player_id).to_numpy()
+
+        return self.search_profile(position_group, self.percentiles[position_group][position], k, candidate_mask)
@@ -0,0 +1,250 @@
+'''
+Append-only, versioned store for repeated player_season_stats exports.
+
+Every ingested snapshot gets the next version number. Only rows that are new or changed since the previous
+version are written, one Parquet file per (season_id, competition_id) partition, and rows that disappeared are
+recorded as tombstones. Reading "as of" a date replays the versions up to that date, so an old scouting report
+can be reproduced from exactly the data it was made with:
+
+    store = SnapshotStore('statsbomb_snapshots')
+    store.ingest('data/player_season_stats.csv', as_of='2024-03-04')
+    df = store.read(as_of='2024-03-10')
+
+Layout:
+    snapshots.jsonl                                       one line per version, written last (the commit point)
+    season_id=<id>/competition_id=<id>/v<version>.parquet          new and changed rows
+    season_id=<id>/competition_id=<id>/v<version>-deleted.parquet  keys of removed rows
+'''
+import glob
+import json
+import os
+import re
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from aggregate_rank_preprocessing_statsbomb import preprocess_df, PREPROCESSING_VERSION
+from load_season_stats_statsbomb import read_player_season_stats, concat_with_aligned_categories
+from remove_duplicate_rows_statsbomb import remove_duplicate_rows, get_key_codes, DEDUPLICATION_KEYS
+
+
+PARTITION_KEYS = ['season_id', 'competition_id']
+
+# Column the store adds to every stored row
+ROW_HASH_COLUMN = '_row_hash'
+
+PARTITION_FILE_PATTERN = re.compile(r'v(\d+)(-deleted)?\.parquet$')
+
+
+def get_row_hashes(df):
+    # One uint64 per row over every column, equal rows hash equally whatever their index. Float columns are hashed
+    # with one NaN and one zero, preprocess_df's negated metrics hold -NaN and -0.0 which Parquet reads back unsigned
+    float_columns = df.select_dtypes('float').columns
+    df = df.assign(**{column: df[column].where(df[column].notna(), np.nan) + 0.0 for column in float_columns})
+
+    return pd.util.hash_pandas_object(df, index=False).to_numpy()
+
+
+class SnapshotStore:
+    '''
+    Versioned store of pre-processed, de-duplicated season stats snapshots, see the module docstring.
+
+    Rows are stored as load_preprocessed_season_stats returns them, so reads need no pre-processing. Rows are
+    identified by DEDUPLICATION_KEYS (the remove_duplicate_rows keys) and a row counts as changed when any of its
+    values differ.
+    '''
+
+    def __init__(self, root):
+        self.root = root
+        self.manifest_path = os.path.join(root, 'snapshots.jsonl')
+
+    def list_snapshots(self):
+        '''
+        Ingested versions, oldest first: version, as_of, source, rows, changed_rows, deleted_rows and
+        preprocessing_version.
+        '''
+        if not os.path.exists(self.manifest_path):
+            return pd.DataFrame(columns=['version', 'as_of', 'source', 'rows', 'changed_rows', 'deleted_rows',
+                                         'preprocessing_version'])
+
+        with open(self.manifest_path) as f:
+            return pd.DataFrame([json.loads(line) for line in f if line.strip()])
+
+    def get_version(self, as_of=None):
+        # Latest version with an as_of date on or before as_of (the latest version if None), None if there is none
+        snapshots = self.list_snapshots()
+        if as_of is not None:
+            snapshots = snapshots[pd.to_datetime(snapshots['as_of']) <= pd.Timestamp(as_of)]
+
+        return None if snapshots.empty else int(snapshots['version'].max())
+
+    def get_partition_dir(self, season_id, competition_id):
+        return os.path.join(self.root, f'season_id={season_id}', f'competition_id={competition_id}')
+
+    def list_partition_files(self, version, season_ids=None, competition_ids=None):
+        '''
+        Files of every partition up to version, as a list of (version, is_deleted, path) in version order.
+        '''
+        partition_files = []
+        for path in glob.glob(os.path.join(self.root, 'season_id=*', 'competition_id=*', 'v*.parquet')):
+            match = PARTITION_FILE_PATTERN.search(os.path.basename(path))
+            file_version = int(match.group(1))
+            if file_version > version:
+                continue
+
+            competition_dir = os.path.dirname(path)
+            season_id = int(os.path.basename(os.path.dirname(competition_dir)).split('=')[1])
+            competition_id = int(os.path.basename(competition_dir).split('=')[1])
+            if (season_ids is not None and season_id not in season_ids) or \
+                    (competition_ids is not None and competition_id not in competition_ids):
+                continue
+
+            partition_files.append((file_version, bool(match.group(2)), path))
+
+        return sorted(partition_files)
+
+    def read_stored_rows(self, version, season_ids=None, competition_ids=None, columns=None):
+        '''
+        Latest stored version of every live row up to version, with the store's row hash column.
+
+        Files are read as Arrow tables and converted to one DataFrame at the end, so the cost is one Parquet read
+        per file rather than a pandas concat per partition.
+        '''
+        row_tables, row_versions = [], []
+        deleted_tables, deleted_versions = [], []
+        for file_version, is_deleted, path in self.list_partition_files(version, season_ids, competition_ids):
+            if is_deleted:
+                deleted_tables.append(pq.read_table(path, columns=DEDUPLICATION_KEYS))
+                deleted_versions.append(np.full(deleted_tables[-1].num_rows, file_version))
+            else:
+                row_tables.append(pq.read_table(path, columns=columns))
+                row_versions.append(np.full(row_tables[-1].num_rows, file_version))
+
+        if not row_tables:
+            return pd.DataFrame(columns=columns)
+
+        # Category codes may be stored with different widths per file, permissive promotion unifies them
+        rows = pa.concat_tables(row_tables, promote_options='permissive').to_pandas()
+        deleted = (pa.concat_tables(deleted_tables, promote_options='permissive').to_pandas() if deleted_tables
+                   else rows[DEDUPLICATION_KEYS].iloc[:0])
+
+        # Replay: the event with the highest version per key wins, tombstones remove the row
+        event_versions = np.concatenate(row_versions + deleted_versions)
+        is_deleted = np.arange(len(event_versions)) >= len(rows)
+        key_codes = get_key_codes(concat_with_aligned_categories([rows[DEDUPLICATION_KEYS], deleted]))
+
+        order = np.argsort(event_versions, kind='stable')
+        is_latest = np.zeros(len(event_versions), dtype=bool)
+        is_latest[order] = ~pd.Series(key_codes[order]).duplicated(keep='last').to_numpy()
+
+        return rows[(is_latest & ~is_deleted)[:len(rows)]].reset_index(drop=True)
+
+    def read(self, as_of=None, season_ids=None, competition_ids=None):
+        '''
+        Function to materialize the season stats as they were at as_of.
+
+        Parameters:
+        as_of (str or Timestamp, optional): Date (and time), defaults to the latest version.
+        season_ids (list, optional): Only read these seasons' partitions.
+        competition_ids (list, optional): Only read these competitions' partitions.
+
+        Returns:
+        df (DataFrame): Pre-processed, de-duplicated season stats, ordered as remove_duplicate_rows orders them.
+        '''
+        version = self.get_version(as_of)
+        if version is None:
+            raise ValueError(f'No snapshot in {self.root} as of {as_of}')
+
+        df = self.read_stored_rows(version, season_ids, competition_ids)
+        df = df.drop(columns=[ROW_HASH_COLUMN], errors='ignore')
+
+        return df.iloc[np.argsort(get_key_codes(df), kind='stable')].reset_index(drop=True)
+
+    def ingest(self, source, as_of=None, preprocessed=False, partial=False):
+        '''
+        Function to add a snapshot as the next version, storing only new and changed rows and tombstones.
+
+        Parameters:
+        source (str or DataFrame): Path to a player_season_stats export, or an already loaded frame.
+        as_of (str or Timestamp, optional): Date the export was taken, defaults to today. Must not be earlier
+                                            than the latest version's.
+        preprocessed (bool): Whether a DataFrame source has already been through preprocess_df and
+                             remove_duplicate_rows.
+        partial (bool): The snapshot only covers the partitions it has rows for, others are left as they are
+                        instead of being deleted.
+
+        Returns:
+        snapshot (dict): The manifest entry of the new version.
+        '''
+        if isinstance(source, str):
+            df = remove_duplicate_rows(preprocess_df(read_player_season_stats(source)))
+        else:
+            df = source if preprocessed else remove_duplicate_rows(preprocess_df(source.copy()))
+
+        as_of = pd.Timestamp(as_of) if as_of is not None else pd.Timestamp.today().normalize()
+        snapshots = self.list_snapshots()
+        if not snapshots.empty and as_of < pd.to_datetime(snapshots['as_of']).max():
+            raise ValueError(f"as_of {as_of} is earlier than the latest snapshot's ({snapshots['as_of'].iloc[-1]})")
+
+        previous_version = -1 if snapshots.empty else int(snapshots['version'].max())
+        version = previous_version + 1
+
+        # Remove files of a version that was never committed to the manifest (an interrupted ingest)
+        for path in glob.glob(os.path.join(self.root, 'season_id=*', 'competition_id=*', f'v{version:06d}*.parquet')):
+            os.remove(path)
+
+        df = df.reset_index(drop=True)
+        df[ROW_HASH_COLUMN] = get_row_hashes(df)
+
+        # Keys and hashes of the live rows as of the previous version
+        previous_df = self.read_stored_rows(previous_version, columns=[*DEDUPLICATION_KEYS, ROW_HASH_COLUMN])
+        if previous_df.empty:
+            is_changed = np.ones(len(df), dtype=bool)
+            is_deleted = np.zeros(0, dtype=bool)
+        else:
+            key_codes = get_key_codes(concat_with_aligned_categories([df[DEDUPLICATION_KEYS], previous_df[DEDUPLICATION_KEYS]]))
+            new_codes, previous_codes = key_codes[:len(df)], key_codes[len(df):]
+
+            # New keys and rows whose values changed
+            previous_positions = pd.Index(previous_codes).get_indexer(new_codes)
+            previous_hashes = previous_df[ROW_HASH_COLUMN].to_numpy(dtype=np.uint64)
+            is_changed = (previous_positions < 0) | (previous_hashes[previous_positions] != df[ROW_HASH_COLUMN].to_numpy())
+
+            # Keys missing from the snapshot, only within the partitions it covers if partial
+            is_deleted = ~np.isin(previous_codes, new_codes)
+            if partial:
+                snapshot_partitions = pd.MultiIndex.from_frame(df[PARTITION_KEYS])
+                is_deleted &= pd.MultiIndex.from_frame(previous_df[PARTITION_KEYS]).isin(snapshot_partitions)
+
+        changed_df = df[is_changed]
+        deleted_df = previous_df.loc[is_deleted, DEDUPLICATION_KEYS] if len(previous_df) else previous_df
+
+        partitions = set()
+        for rows, suffix in [(changed_df, ''), (deleted_df, '-deleted')]:
+            for (season_id, competition_id), partition_df in rows.groupby(PARTITION_KEYS, sort=False):
+                partition_dir = self.get_partition_dir(season_id, competition_id)
+                os.makedirs(partition_dir, exist_ok=True)
+
+                path = os.path.join(partition_dir, f'v{version:06d}{suffix}.parquet')
+                tmp_path = f'{path}.{os.getpid()}.tmp'
+                partition_df.to_parquet(tmp_path, index=False)
+                os.replace(tmp_path, path)
+                partitions.add((int(season_id), int(competition_id)))
+
+        snapshot = {
+            'version': version,
+            'as_of': as_of.isoformat(),
+            'source': source if isinstance(source, str) else None,
+            'rows': len(df),
+            'changed_rows': len(changed_df),
+            'deleted_rows': len(deleted_df),
+            'partitions': len(partitions),
+            'preprocessing_version': PREPROCESSING_VERSION,
+        }
+
+        # Committing the version is a single appended line, readers never see a half-written snapshot
+        os.makedirs(self.root, exist_ok=True)
+        with open(self.manifest_path, 'a') as f:
+            f.write(json.dumps(snapshot) + '\n')
+
+        return snapshot
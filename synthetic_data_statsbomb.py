@@ -0,0 +1,146 @@
+import numpy as np
+import pandas as pd
+
+
+# StatsBomb primary positions, grouped the same way as statsbomb_metric_groups.csv
+SYNTHETIC_POSITION_GROUPS = {
+    'goalkeeper': ['Goalkeeper'],
+    'full_back': ['Right Back', 'Left Back', 'Right Wing Back', 'Left Wing Back'],
+    'centre_back': ['Right Centre Back', 'Left Centre Back', 'Centre Back'],
+    'midfielder': ['Right Defensive Midfielder', 'Left Defensive Midfielder', 'Centre Defensive Midfielder',
+                   'Right Centre Midfielder', 'Left Centre Midfielder', 'Centre Attacking Midfielder'],
+    'winger': ['Right Wing', 'Left Wing', 'Right Midfielder', 'Left Midfielder'],
+    'striker': ['Centre Forward', 'Right Centre Forward', 'Left Centre Forward'],
+}
+
+# Per 90 metrics and the fraction of rows with no value recorded (NaN)
+SYNTHETIC_METRICS = {
+    'np_xg_90': 0.0, 'npga_90': 0.0, 'assists_90': 0.0, 'xa_90': 0.05, 'key_passes_90': 0.05,
+    'dribbles_90': 0.15, 'dribbled_past_90': 0.1, 'errors_90': 0.6, 'tackles_90': 0.1, 'interceptions_90': 0.1,
+    'aerial_wins_90': 0.2, 'pressures_90': 0.3, 'deep_progressions_90': 0.25, 'obv_90': 0.4, 'save_ratio_90': 0.9,
+}
+
+SYNTHETIC_GROUP_METRICS = {
+    'goalkeeper': ['save_ratio_90', 'errors_90', 'aerial_wins_90'],
+    'full_back': ['tackles_90', 'interceptions_90', 'xa_90', 'deep_progressions_90', 'dribbled_past_90'],
+    'centre_back': ['tackles_90', 'interceptions_90', 'aerial_wins_90', 'errors_90', 'dribbled_past_90'],
+    'midfielder': ['key_passes_90', 'pressures_90', 'deep_progressions_90', 'obv_90', 'interceptions_90'],
+    'winger': ['np_xg_90', 'xa_90', 'dribbles_90', 'key_passes_90', 'np_goals_less_xg_90'],
+    'striker': ['np_xg_90', 'np_goals_less_xg_90', 'aerial_wins_90', 'pressures_90', 'obv_90'],
+}
+
+
+def generate_player_season_stats(n_rows=100_000, n_players=None, n_seasons=6, n_competitions=20, n_positions=None,
+                                 summer_fraction=0.25, duplicate_fraction=0.02, seed=0):
+    '''
+    Function to generate a synthetic frame shaped like StatsBomb's player_season_stats.csv export.
+
+    Column names are raw ('player_season_' prefixes, spaces in values), 'League One' is always competition 1 with
+    Lincoln City in it, summer leagues use 'YYYY' season names and winter leagues 'YYYY/YYYY+1', metrics have
+    realistic NaN rates, and duplicate_fraction of the rows are repeated with fewer minutes as happens when the
+    legacy and subscribed exports are concatenated.
+
+    Parameters:
+    n_rows (int): Number of rows before duplicates are added.
+    n_players (int, optional): Number of distinct players, defaults to n_rows // 4.
+    n_seasons (int): Number of season years (each gives a winter and a summer season).
+    n_competitions (int): Number of competitions.
+    n_positions (int, optional): Number of distinct primary positions, defaults to all of them.
+    summer_fraction (float): Fraction of competitions played over a calendar year.
+    duplicate_fraction (float): Fraction of rows duplicated with fewer minutes.
+    seed (int): Random seed.
+
+    Returns:
+    df (DataFrame): Raw player season stats.
+    '''
+    rng = np.random.default_rng(seed)
+    n_players = n_players or max(n_rows // 4, 1)
+
+    positions = [position for group_positions in SYNTHETIC_POSITION_GROUPS.values() for position in group_positions]
+    positions = positions[:n_positions] if n_positions else positions
+
+    # Players keep their name, birth year and usual position across rows
+    player_birth_years = rng.integers(1985, 2007, n_players)
+    player_positions = rng.integers(0, len(positions), n_players)
+
+    player_index = rng.integers(0, n_players, n_rows)
+    position_index = np.where(rng.random(n_rows) < 0.9, player_positions[player_index], rng.integers(0, len(positions), n_rows))
+
+    # Competitions: competition 1 is League One, a share of the others are summer leagues
+    competition_index = rng.integers(0, n_competitions, n_rows)
+    competition_names = np.array(['League One'] + [f'Competition {c}' for c in range(2, n_competitions + 1)])
+    is_summer_competition = np.arange(n_competitions) >= n_competitions * (1 - summer_fraction)
+    is_summer_competition[0] = False
+    is_summer = is_summer_competition[competition_index]
+
+    # Seasons: ids 1..n_seasons are winter seasons, n_seasons+1.. are the summer ones
+    first_year = 2024 - n_seasons
+    year_index = rng.integers(0, n_seasons, n_rows)
+    winter_names = np.array([f'{first_year + y}/{first_year + y + 1}' for y in range(n_seasons)])
+    summer_names = np.array([f'{first_year + y}' for y in range(n_seasons)])
+    season_id = np.where(is_summer, n_seasons + 1 + year_index, 1 + year_index)
+    season_name = np.where(is_summer, summer_names[year_index], winter_names[year_index])
+
+    # 24 teams per competition, Lincoln City are team 0 of League One
+    team_index = rng.integers(0, 24, n_rows)
+    team_id = competition_index * 24 + team_index + 1
+    team_name = np.char.add(np.char.add('Team ', competition_index.astype(str)), np.char.add('-', team_index.astype(str)))
+    team_name[(competition_index == 0) & (team_index == 0)] = 'Lincoln City'
+
+    df = pd.DataFrame({
+        'player_id': player_index + 1,
+        'player_name': np.char.add('Player ', (player_index + 1).astype(str)),
+        'team_id': team_id,
+        'team_name': team_name,
+        'competition_id': competition_index + 1,
+        'competition_name': competition_names[competition_index],
+        'season_id': season_id,
+        'season_name': season_name,
+        'birth_date': np.char.add(player_birth_years[player_index].astype(str), '-06-15'),
+        'primary_position': np.array(positions)[position_index],
+        'player_season_minutes': np.round(rng.uniform(0, 3600, n_rows), 1),
+        'player_season_appearances': rng.integers(1, 46, n_rows),
+    })
+
+    for metric, nan_fraction in SYNTHETIC_METRICS.items():
+        values = np.round(rng.gamma(2.0, 0.15, n_rows), 3)
+        values[rng.random(n_rows) < nan_fraction] = np.nan
+        df[f'player_season_{metric}'] = values
+
+    # npga_90 includes assists
+    df['player_season_npga_90'] = df['player_season_npga_90'] + df['player_season_assists_90']
+
+    # Duplicated rows with fewer minutes, as after concatenating legacy and subscribed exports
+    duplicates = df.sample(frac=duplicate_fraction, random_state=seed)
+    duplicates['player_season_minutes'] = np.round(duplicates['player_season_minutes'] * rng.uniform(0.3, 0.9, len(duplicates)), 1)
+
+    return pd.concat([df, duplicates], ignore_index=True)
+
+
+def generate_metric_grouping_information(n_positions=None):
+    '''
+    Function to generate a parsed metric_grouping_information frame matching generate_player_season_stats.
+
+    Positions are cleaned as preprocess_df cleans primary_position, and the catch-all 'all' group is included.
+    '''
+    positions = [position for group_positions in SYNTHETIC_POSITION_GROUPS.values() for position in group_positions]
+    positions = set(positions[:n_positions] if n_positions else positions)
+
+    rows = []
+    for position_group, group_positions in SYNTHETIC_POSITION_GROUPS.items():
+        group_positions = [position.lower().replace(' ', '_') for position in group_positions if position in positions]
+        if group_positions:
+            rows.append({'position_groups': position_group, 'positions_statsbomb': group_positions,
+                         'statsbomb_metrics': SYNTHETIC_GROUP_METRICS[position_group]})
+
+    rows.append({'position_groups': 'all',
+                 'positions_statsbomb': [position for row in rows for position in row['positions_statsbomb']],
+                 'statsbomb_metrics': ['np_xg_90', 'xa_90', 'obv_90']})
+
+    return pd.DataFrame(rows)
+
+
+def generate_chronological_season_ids(n_seasons=6):
+    # Season ids latest first, as statsbomb_season_id in season_information.csv
+    return pd.Series([season_id for year in range(n_seasons, 0, -1) for season_id in (year, n_seasons + year)],
+                     name='statsbomb_season_id')
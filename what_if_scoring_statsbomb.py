@@ -0,0 +1,73 @@
+import numpy as np
+import pandas as pd
+
+
+def build_cohort_scorer(cohort_df, general_metrics):
+    '''
+    Function to pre-sort a ranked cohort so candidate stat lines can be scored against it by binary search.
+
+    Parameters:
+    cohort_df (DataFrame): Ranked cohort, e.g. from calculate_percentiles_league_one or lookup_cohort.
+    general_metrics (list): Metrics the cohort was ranked on.
+
+    Returns:
+    cohort_scorer (dict): Sorted non-NaN values of every metric and the sorted cohort average_rank.
+    '''
+    sorted_metric_values = {}
+    for metric in general_metrics:
+        values = cohort_df[metric].to_numpy(dtype=np.float64)
+        sorted_metric_values[metric] = np.sort(values[~np.isnan(values)])
+
+    return {
+        'general_metrics': list(general_metrics),
+        'sorted_metric_values': sorted_metric_values,
+        'sorted_average_rank': np.sort(cohort_df['average_rank'].to_numpy(dtype=np.float64)),
+    }
+
+
+def percentile_against_sorted(sorted_values, values):
+    # Percentile each value would get if it alone were added to sorted_values and the set re-ranked (average ties)
+    n_less = np.searchsorted(sorted_values, values, side='left')
+    n_equal = np.searchsorted(sorted_values, values, side='right') - n_less
+
+    # Average of the positions n_less + 1 ... n_less + n_equal + 1
+    average_rank = (2 * n_less + n_equal + 2) / 2
+
+    return average_rank / (len(sorted_values) + 1) * 100
+
+
+def score_candidates(cohort_scorer, candidates_df):
+    '''
+    Function to score one or many candidate stat lines (trialists, edited projections, players from other leagues)
+    against a fixed cohort, without adding them to the cohort or re-ranking it.
+
+    Each candidate is scored as if it alone were appended to the cohort and ranked, matching what
+    plot_distribution_league_one_u21 does for a non-League One player. Metric percentiles are exact, the aggregate
+    percentile compares the candidate's average_rank with the cohort's existing average_rank values.
+    NaN metrics are given 50, as in the ranking functions.
+
+    Parameters:
+    cohort_scorer (dict): Pre-sorted cohort from build_cohort_scorer.
+    candidates_df (DataFrame): Candidate rows holding the cohort's general metrics.
+
+    Returns:
+    scores_df (DataFrame): '{metric}_percentile', 'average_rank' and 'average_rank_percentile' per candidate,
+                           with the same index as candidates_df.
+    '''
+    general_metrics = cohort_scorer['general_metrics']
+
+    percentiles = np.empty((len(candidates_df), len(general_metrics)))
+    for j, metric in enumerate(general_metrics):
+        values = candidates_df[metric].to_numpy(dtype=np.float64)
+        nan_mask = np.isnan(values)
+
+        percentiles[:, j] = 50.0
+        percentiles[~nan_mask, j] = percentile_against_sorted(cohort_scorer['sorted_metric_values'][metric], values[~nan_mask])
+
+    scores_df = pd.DataFrame(percentiles, index=candidates_df.index, columns=[f'{metric}_percentile' for metric in general_metrics])
+
+    # Create average rank column (mean across percentile columns) and place it in the cohort's distribution
+    scores_df['average_rank'] = scores_df.mean(axis=1)
+    scores_df['average_rank_percentile'] = percentile_against_sorted(cohort_scorer['sorted_average_rank'], scores_df['average_rank'].to_numpy())
+
+    return scores_df